@@ -0,0 +1,178 @@
+"""
+Converts videos to midi without opening any window, for running on servers.
+
+usage: py -m algo.batch_convert SOURCE [SOURCE ...] [-o DIRECTORY] [-j WORKERS] [--summary PATH] [--overwrite] [--stream] [--streaming-midi]
+
+A source is a video file, a directory searched for videos, a glob pattern or a video or playlist url.
+"""
+import argparse
+import glob
+import itertools
+import json
+import os
+import pathlib
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+from algo import utils
+from algo.download_videos import get_playlist_urls, is_url_format
+from algo.processing_class import ProcessingClass, ProcessStates
+from algo.threshold_profiles import ThresholdModes
+from p2m import p2m_constants, p2m_path
+from p2m.p2m_types import *
+
+VIDEO_EXTENSIONS = (".mp4", ".mkv", ".webm", ".mov", ".avi")    # files a directory source is searched for
+SUMMARY_NAME = "batch_summary.json"                             # written to the output directory by default
+
+
+class BatchItem:
+    """One video of a batch and the title its midi is saved under"""
+    def __init__(self, src_str: str, title: str):
+        self.src_str: str = src_str
+        self.title: str = title
+
+    def __repr__(self):
+        return f"BatchItem(title={self.title}, src_str={self.src_str})"
+
+    def get_save_path(self, directory: str) -> str:
+        return os.path.join(directory, self.title).rstrip(".") + ".mid"
+
+
+def expand_source(source: str) -> list[BatchItem]:
+    """Videos of one command line source, urls are expanded as playlists, a single video url gives one item"""
+    if is_url_format(source):
+        return [BatchItem(data.url, utils.clean_filename(data.title)) for data in get_playlist_urls(source)]
+    if os.path.isdir(source):
+        paths = [os.path.join(root, file) for root, _, files in os.walk(source)
+                 for file in files if file.lower().endswith(VIDEO_EXTENSIONS)]
+    elif os.path.isfile(source):
+        paths = [source]
+    else:
+        paths = [path for path in glob.glob(source, recursive=True) if os.path.isfile(path)]
+    return [BatchItem(os.path.abspath(path), utils.clean_filename(pathlib.Path(path).stem)) for path in sorted(paths)]
+
+
+def collect_items(sources: list[str]) -> list[BatchItem]:
+    """Videos of every source in order, each once, titles numbered where two videos share one"""
+    items = []
+    seen_sources = set()
+    used_titles = set()
+    for source in sources:
+        for item in expand_source(source):
+            if item.src_str in seen_sources:
+                continue
+            seen_sources.add(item.src_str)
+            title = item.title
+            for i in itertools.count(1):
+                if title.lower() not in used_titles:
+                    break
+                title = f"{item.title}_{i}"
+            used_titles.add(title.lower())
+            item.title = title
+            items.append(item)
+    return items
+
+
+def convert_item(src_str: str, title: str, save_path: str,
+                 threshold_mode: str = p2m_constants.THRESHOLD_MODE,
+                 stream_input: bool = p2m_constants.STREAM_DOWNLOADS,
+                 streaming_midi: bool = p2m_constants.STREAMING_MIDI) -> dict:
+    """Worker side of run_batch, every failure is reported in the returned result instead of raised"""
+    start = time.perf_counter()
+    result = {"source": src_str, "title": title, "output": save_path}
+    processor = ProcessingClass(src_str, threshold_mode=threshold_mode, stream_input=stream_input,
+                                streaming_midi=streaming_midi)
+    processor.title = title
+    try:
+        processor.state = ProcessStates.RUNNING
+        processor.save_as(save_path)
+        result.update(status="converted", dpf_cache_hit=processor.dpf_cache_hit)
+    except Exception as exc:
+        result.update(status="failed", state=processor.state, error=f"{type(exc).__name__}: {exc}")
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def run_batch(items: list[BatchItem], directory: str, workers: Optional[int] = None, overwrite: bool = False,
+              threshold_mode: str = p2m_constants.THRESHOLD_MODE,
+              stream_input: bool = p2m_constants.STREAM_DOWNLOADS,
+              streaming_midi: bool = p2m_constants.STREAMING_MIDI) -> dict:
+    """
+    Converts items in a pool of worker processes, one ProcessingClass job per item.
+
+    :param workers: worker processes, defaults to the core count
+    :param overwrite: convert items whose midi already exists in directory instead of skipping them
+    :param stream_input: process url items while they are downloaded, see ProcessingClass
+    :param streaming_midi: decide notes while every item is processed without keeping its dpf, see ProcessingClass
+    :return: summary with one result per item in item order, see convert_item
+    """
+    workers = workers or os.cpu_count() or 1
+    started = datetime.now().isoformat(timespec="seconds")
+    start = time.perf_counter()
+    results: list[Optional[dict]] = [None] * len(items)
+    os.makedirs(directory, exist_ok=True)
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        futures = {}
+        for idx, item in enumerate(items):
+            save_path = item.get_save_path(directory)
+            if not overwrite and os.path.exists(save_path):
+                results[idx] = {"source": item.src_str, "title": item.title, "output": save_path,
+                                "status": "skipped", "seconds": 0.0}
+                continue
+            futures[executor.submit(convert_item, item.src_str, item.title, save_path, threshold_mode,
+                                    stream_input, streaming_midi)] = idx
+        for done, future in enumerate(as_completed(futures), 1):
+            idx = futures[future]
+            try:
+                results[idx] = future.result()
+            except Exception as exc:  # the worker process died
+                results[idx] = {"source": items[idx].src_str, "title": items[idx].title, "status": "failed",
+                                "error": f"{type(exc).__name__}: {exc}", "seconds": None}
+            print(f"[{done}/{len(futures)}] {results[idx]['status']} {items[idx].title}")
+    except KeyboardInterrupt:
+        print("cancelled, waiting for running jobs")
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    for idx, item in enumerate(items):
+        if results[idx] is None:
+            results[idx] = {"source": item.src_str, "title": item.title, "status": "cancelled", "seconds": None}
+    counts = {status: sum(result["status"] == status for result in results)
+              for status in ("converted", "skipped", "failed", "cancelled")}
+    return {"started": started, "seconds": round(time.perf_counter() - start, 3), "workers": workers,
+            "output_directory": os.path.abspath(directory), **counts, "items": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert piano videos to midi without a gui")
+    parser.add_argument("sources", nargs="+", help="video files, directories, glob patterns or playlist urls")
+    parser.add_argument("-o", "--output", default=p2m_path.DATA_DIR, help="directory the midi files are saved in")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="worker processes, defaults to the core count")
+    parser.add_argument("--summary", default=None, help=f"json summary path, defaults to OUTPUT/{SUMMARY_NAME}")
+    parser.add_argument("--overwrite", action="store_true", help="convert videos whose midi already exists")
+    parser.add_argument("--threshold-mode", default=p2m_constants.THRESHOLD_MODE,
+                        choices=[ThresholdModes.GLOBAL, ThresholdModes.KEY_CLASS, ThresholdModes.KEY])
+    parser.add_argument("--stream", action="store_true", default=p2m_constants.STREAM_DOWNLOADS,
+                        help="process urls while they are downloaded instead of after")
+    parser.add_argument("--streaming-midi", action="store_true", default=p2m_constants.STREAMING_MIDI,
+                        help="decide notes while videos are processed, memory stays bounded but no dpf is saved")
+    args = parser.parse_args()
+
+    items = collect_items(args.sources)
+    print(f"{len(items)} video(s) found")
+    summary = run_batch(items, args.output, args.workers, args.overwrite, args.threshold_mode, args.stream,
+                        args.streaming_midi)
+    summary_path = args.summary or os.path.join(args.output, SUMMARY_NAME)
+    pathlib.Path(summary_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(summary_path, "w") as f:
+        json.dump(summary, f, indent=2)
+    print(f"{summary['converted']} converted, {summary['skipped']} skipped, {summary['failed']} failed, "
+          f"{summary['cancelled']} cancelled in {summary['seconds']:.1f}s, summary saved as {summary_path}")
+    if summary["failed"] or summary["cancelled"]:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
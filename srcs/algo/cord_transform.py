@@ -0,0 +1,39 @@
+import numpy as np
+from p2m.p2m_types import *
+
+
+class CordTransform:
+    """
+    Maps coordinates of the resized frame (where keys are detected) to pixel indices of the source frame.
+
+    Key rectangles and watch cords always stay in resized frame coordinates, this is only applied
+    when sampling so frames never need to be resized just to be read.
+    """
+    def __init__(self, scale: float = 1.0, source_offset: CordType = (0, 0),
+                 source_size: Optional[tuple[int, int]] = None):
+        """
+        :param scale: source to resized frame scale factor
+        :param source_offset: top left of the sampled source image, for frames cropped to a region of interest
+        :param source_size: (width, height) of the sampled source image, indices are clipped to it
+        """
+        self.scale: float = scale
+        self.source_offset: CordType = source_offset
+        self.source_size: Optional[tuple[int, int]] = source_size
+
+    def __repr__(self):
+        return f"CordTransform(scale={self.scale}, source_offset={self.source_offset}, source_size={self.source_size})"
+
+    def is_identity(self) -> bool:
+        return self.scale == 1.0 and self.source_offset == (0, 0)
+
+    def to_source(self, xs: np.ndarray, ys: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Pixel indices of the source image whose centre is nearest to the centre of resized pixels (xs, ys)"""
+        xs = np.asarray(xs)
+        ys = np.asarray(ys)
+        if not self.is_identity():
+            xs = np.floor((xs + 0.5) / self.scale).astype(np.intp) - self.source_offset[0]
+            ys = np.floor((ys + 0.5) / self.scale).astype(np.intp) - self.source_offset[1]
+        if self.source_size is not None:
+            xs = np.clip(xs, 0, self.source_size[0] - 1)
+            ys = np.clip(ys, 0, self.source_size[1] - 1)
+        return xs.astype(np.intp), ys.astype(np.intp)
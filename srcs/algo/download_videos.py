@@ -1,10 +1,16 @@
 import json
 import logging
+import sys
 import yt_dlp as youtube_dl
 from typing import Callable, Any, Optional
 import re
 import os
 from algo import utils
+from p2m import p2m_constants
+from p2m.p2m_exception import OperationCancelledException
+
+MERGED_FORMAT = 'bestvideo[height<=720]+bestaudio/best[height<=720]'  # waits for the audio and the merge
+VIDEO_ONLY_FORMAT = 'bestvideo[height<=720]/best[height<=720]'        # one file, the audio is never used
 
 
 class UrlData:
@@ -39,13 +45,22 @@ def get_playlist_urls(playlist_url: str) -> list[UrlData]:
             return []
 
 
-def download_video(url: str, directory: str, title: str, progress_hook_func: Callable[[float], Any] = lambda d: None):
+def download_video(url: str, directory: str, title: str, progress_hook_func: Callable[[float], Any] = lambda d: None,
+                   rate_limit: Optional[float] = None, is_running_func: Callable[[], bool] = lambda: True,
+                   video_only: bool = p2m_constants.DOWNLOAD_VIDEO_ONLY):
+    """
+    :param rate_limit: bytes per second, None for no limit
+    :param is_running_func: polled on every progress update, the download is aborted once it returns False
+    :param video_only: skip the audio track and the merge with it
+    """
     downloaded_file_path: Optional[str] = None
     dst_basename = os.path.join(directory, title)
     dst_basename = utils.unique_basename(dst_basename)
 
     def _progress_hook(d):
         nonlocal downloaded_file_path
+        if not is_running_func():
+            raise OperationCancelledException("Terminated")
         # print(json.dumps(d, indent=2))
         if d['status'] == 'finished':
             progress_hook_func(1.0)
@@ -56,12 +71,13 @@ def download_video(url: str, directory: str, title: str, progress_hook_func: Cal
             progress_hook_func(0.0)
 
     ydl_opts = {
-        'format': 'bestvideo[height<=720]+bestaudio/best[height<=720]',
+        'format': VIDEO_ONLY_FORMAT if video_only else MERGED_FORMAT,
         'outtmpl': f"{dst_basename}.%(ext)s",
         'quiet': True,  # Suppress console output
         'progress_hooks': [_progress_hook],
         'logger': logging.Logger("quiet", level=60),
-        'postprocessors': []
+        'postprocessors': [],
+        'ratelimit': rate_limit,
     }
     with youtube_dl.YoutubeDL(ydl_opts) as ydl:
         ydl.download([url])
@@ -70,6 +86,48 @@ def download_video(url: str, directory: str, title: str, progress_hook_func: Cal
     return downloaded_file_path
 
 
+def get_stream_command(url: str, rate_limit: Optional[float] = None) -> list[str]:
+    """
+    yt-dlp command writing the video only format of url to its stdout, see video_stream.StreamVideoClass
+
+    :param rate_limit: bytes per second, None for no limit
+    """
+    command = [sys.executable, "-m", "yt_dlp", "--quiet", "--no-warnings", "--no-playlist",
+               "--format", VIDEO_ONLY_FORMAT, "--output", "-"]
+    if rate_limit is not None:
+        command += ["--limit-rate", str(int(rate_limit))]
+    return command + ["--", url]
+
+
+def get_video_info(url: str) -> dict:
+    """
+    Metadata of the video at url with the fields of the format get_stream_command streams, one request
+    for the title, uploader and stream info, playlist entries are not resolved
+    """
+    ydl_opts = {
+        'format': VIDEO_ONLY_FORMAT,
+        'quiet': True,  # Suppress console output
+        'extract_flat': 'in_playlist',  # Resolve a single video, only list the videos of a playlist
+        'noplaylist': True,
+        'logger': logging.Logger("quiet", 60)
+    }
+
+    with youtube_dl.YoutubeDL(ydl_opts) as ydl:
+        try:
+            return ydl.extract_info(url, download=False)
+        except youtube_dl.utils.DownloadError as exc:
+            raise ValueError(exc)
+
+
+def get_stream_info(info_dict: dict) -> tuple[float, int]:
+    """
+    :param info_dict: see get_video_info
+    :return: (fps, frame count) of the format get_stream_command streams, 0 where the site doesn't tell
+    """
+    fps = float(info_dict.get('fps') or 0.0)
+    return fps, int(fps * float(info_dict.get('duration') or 0.0))
+
+
 def get_video_title(url: str) -> Optional[str]:
     """
     Retrieves the title of the video from the given URL.
@@ -88,6 +146,29 @@ def get_video_title(url: str) -> Optional[str]:
             raise ValueError(exc)
 
 
+def get_video_uploader(url: str) -> Optional[str]:
+    """
+    Retrieves the channel the video was uploaded by, None if the site doesn't tell.
+    """
+    ydl_opts = {
+        'quiet': True,  # Suppress console output
+        'extract_flat': True,  # Extract only URLs, no metadata
+        'logger': logging.Logger("quiet", 60)
+    }
+
+    with youtube_dl.YoutubeDL(ydl_opts) as ydl:
+        try:
+            info_dict = ydl.extract_info(url, download=False)
+        except youtube_dl.utils.DownloadError as exc:
+            raise ValueError(exc)
+    return get_uploader(info_dict)
+
+
+def get_uploader(info_dict: dict) -> Optional[str]:
+    """Channel of the video of info_dict, None if the site doesn't tell"""
+    return info_dict.get('channel_id') or info_dict.get('uploader_id') or info_dict.get('uploader')
+
+
 def is_url_format(_str: str) -> bool:
     """
     Checks if the provided string is a valid URL using regex.
@@ -1,36 +1,80 @@
 import math
 import os
+from typing import Optional
 
 import matplotlib.pyplot as plt
 from collections import Counter
 import json
 import numpy as np
-from scipy.optimize import fsolve
-from sklearn.mixture import GaussianMixture
+from scipy.special import logsumexp
+from sklearn.cluster import KMeans
 from sklearn.preprocessing import StandardScaler
 
-from srcs.p2m.p2m_types import DpfType
+from srcs.algo.dpf_file import load_dpf, list_dpf_files, DPF_DTYPE
+from srcs.p2m.p2m_types import DpfType, Union
 from srcs.p2m import p2m_path
 
 
 N_COMPONENTS = 5
+MAX_TRIGGER_RATE = 0.05     # share of a key's values a note threshold may fire on, more means it sits in the noise
+ONLINE_MIN_FRAMES = 90      # rows an OnlineThresholdEstimator counts before its first fit
+ONLINE_REFIT_FRAMES = 300   # rows between its refits
+NOISE_SIGMAS = 3            # standard deviations of the neutral gaussian a plausible threshold lies beyond
+FIT_TOLERANCE = 0.2         # thresholds of the histogram fit and sklearn's may differ by this, see benchmark
+
+def weighted_log_density(gaussians: np.ndarray, x: np.ndarray) -> np.ndarray:
+    """log(weight * N(x; mean, variance)) of (..., 3) arrays of (mean, variance, weight), broadcast against x"""
+    mean, var, weight = np.moveaxis(np.asarray(gaussians, dtype=float), -1, 0)
+    return np.log(weight) - 0.5 * np.log(2 * np.pi * var) - (x - mean) ** 2 / (2 * var)
+
+
+def gaussian_boundaries(gaussians1: np.ndarray, gaussians2: np.ndarray) -> np.ndarray:
+    """
+    Decision boundary of every pair of weighted gaussians, where both have the same weighted density.
+    Equating the log densities leaves a quadratic, the root between the two means is returned.
+
+    :param gaussians1: (..., 3) array of (mean, variance, weight), broadcast against gaussians2
+    :param gaussians2: (..., 3) array of (mean, variance, weight)
+    :return: boundaries, clipped to the means if the gaussians only cross outside them, where their log
+        densities come closest if they never cross
+    """
+    mean1, var1, weight1 = np.moveaxis(np.asarray(gaussians1, dtype=float), -1, 0)
+    mean2, var2, weight2 = np.moveaxis(np.asarray(gaussians2, dtype=float), -1, 0)
+    # a x^2 + b x + c = 0, from log(weight1) - log(var1) / 2 - (x - mean1)^2 / (2 var1) = same for 2
+    a = 1 / (2 * var2) - 1 / (2 * var1)
+    b = mean1 / var1 - mean2 / var2
+    c = (mean2 ** 2 / (2 * var2) - mean1 ** 2 / (2 * var1)
+         + np.log(weight1 / weight2) + 0.5 * (np.log(var2) - np.log(var1)))
+    low, high = np.minimum(mean1, mean2), np.maximum(mean1, mean2)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sqrt_discriminant = np.sqrt(np.maximum(b ** 2 - 4 * a * c, 0))
+        # numerically stable roots, c / q is the linear root -c / b when the variances are equal
+        q = -0.5 * (b + np.copysign(sqrt_discriminant, b))
+        roots = np.stack(np.broadcast_arrays(q / a, c / q))
+
+    # a root between the means is always closer to their midpoint than one outside
+    midpoint = (low + high) / 2
+    distance = np.where(np.isfinite(roots), np.abs(roots - midpoint), np.inf)
+    closest = np.take_along_axis(roots, np.argmin(distance, axis=0)[None], axis=0)[0]
+    return np.clip(np.where(np.isfinite(closest), closest, midpoint), low, high)
+
 
 class BoundaryFinder:
     def __init__(self, gaussian_list: list[tuple]):
         self.gaussian_list: list[tuple] = gaussian_list
         self.gaussian_list.sort(key=lambda x: x[0])
+        gaussians = np.array(self.gaussian_list, dtype=float).reshape(-1, 3)
+        # boundaries[i, j] between gaussian i and j, every pair at once
+        self.boundaries: np.ndarray = gaussian_boundaries(gaussians[:, None], gaussians[None, :])
 
     def _decision_boundary(self, x, mean1, var1, weight1, mean2, var2, weight2):
-        lhs = np.log(weight1 / weight2) + 0.5 * (np.log(var2) - np.log(var1))
-        rhs = (x - mean2) ** 2 / (2 * var2) - (x - mean1) ** 2 / (2 * var1)
-        return lhs - rhs
+        """Difference of the weighted log densities at x, 0 on the boundary"""
+        return (weighted_log_density((mean1, var1, weight1), x)
+                - weighted_log_density((mean2, var2, weight2), x))
 
     def _calculate_boundary(self, gaussian1, gaussian2):
-        x_boundary = fsolve(self._decision_boundary, 0, args=(
-            *gaussian1,
-            *gaussian2,
-        ))
-        return float(x_boundary[0])
+        return float(gaussian_boundaries(np.array(gaussian1), np.array(gaussian2)))
 
     def find_neutral_index(self) -> int:
         means: list[tuple[int, int]] = [(i, e[0]) for i, e in enumerate(self.gaussian_list)]
@@ -39,19 +83,13 @@ class BoundaryFinder:
 
     def find_note_on_decision_boundary(self):
         note_on_index = self.find_neutral_index() + 1
-        note_on_gaussian = self.gaussian_list[note_on_index]
-        possible_boundaries = [
-            self._calculate_boundary(x, note_on_gaussian) for x in self.gaussian_list[:note_on_index]
-        ]
-        return max(possible_boundaries)
+        possible_boundaries = self.boundaries[:note_on_index, note_on_index]
+        return float(possible_boundaries.max())
 
     def find_note_off_decision_boundary(self):
         note_on_index = self.find_neutral_index() - 1
-        note_on_gaussian = self.gaussian_list[note_on_index]
-        possible_boundaries = [
-            self._calculate_boundary(x, note_on_gaussian) for x in self.gaussian_list[note_on_index + 1:]
-        ]
-        return min(possible_boundaries)
+        possible_boundaries = self.boundaries[note_on_index + 1:, note_on_index]
+        return float(possible_boundaries.min())
 
 
 def flatten_list(data) -> list:
@@ -65,40 +103,236 @@ def flatten_list(data) -> list:
     return flat_list
 
 
+def _weighted_m_step(x: np.ndarray, weighted_resp: np.ndarray, reg_covar: float
+                     ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    nk = weighted_resp.sum(axis=0) + 10 * np.finfo(weighted_resp.dtype).eps
+    means = weighted_resp.T @ x / nk
+    variances = (weighted_resp * (x[:, None] - means) ** 2).sum(axis=0) / nk + reg_covar
+    return means, variances, nk / nk.sum()
+
+
+def _weighted_e_step(x: np.ndarray, means: np.ndarray, variances: np.ndarray, mix_weights: np.ndarray
+                     ) -> tuple[np.ndarray, np.ndarray]:
+    """:return: (log likelihood of every value, log responsibilities)"""
+    log_prob = (-0.5 * (np.log(2 * np.pi * variances) + (x[:, None] - means) ** 2 / variances)
+                + np.log(mix_weights))
+    log_prob_norm = logsumexp(log_prob, axis=1)
+    return log_prob_norm, log_prob - log_prob_norm[:, None]
+
+
+def fit_weighted_gmm(values: np.ndarray, weights: np.ndarray, n_components: int = N_COMPONENTS,
+                     random_state: int = 42, reg_covar: float = 1e-4, tol: float = 1e-3, max_iter: int = 100,
+                     initial_gaussians: Optional[np.ndarray] = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    1d GaussianMixture fit on a histogram, the same EM as sklearn on np.repeat(values, weights)
+    but every step costs O(unique values) instead of O(samples). Initialised by a weighted k-means
+    with restarts, a single seeding of the flat damped histogram can miss the neutral component.
+
+    :param values: distinct sample values
+    :param weights: occurrences of every value
+    :param initial_gaussians: (n_components, 3) array of (mean, variance, weight) to warm start from
+        instead of k-means, e.g. a previous fit of similar data
+    :return: (means, variances, mixture weights)
+    """
+    x = np.asarray(values, dtype=float)
+    w = np.asarray(weights, dtype=float)
+    if initial_gaussians is not None:
+        means, variances, mix_weights = np.asarray(initial_gaussians, dtype=float).T
+    else:
+        labels = KMeans(n_clusters=n_components, n_init=10, random_state=random_state).fit(
+            x.reshape(-1, 1), sample_weight=w).labels_
+        resp = np.zeros((len(x), n_components))
+        resp[np.arange(len(x)), labels] = 1
+        means, variances, mix_weights = _weighted_m_step(x, resp * w[:, None], reg_covar)
+
+    lower_bound = -np.inf
+    for _ in range(max_iter):
+        log_prob_norm, log_resp = _weighted_e_step(x, means, variances, mix_weights)
+        means, variances, mix_weights = _weighted_m_step(x, np.exp(log_resp) * w[:, None], reg_covar)
+        prev_lower_bound, lower_bound = lower_bound, np.average(log_prob_norm, weights=w)
+        if abs(lower_bound - prev_lower_bound) < tol:
+            break
+    return means, variances, mix_weights
+
+
+def damp_counts(counts: np.ndarray) -> np.ndarray:
+    """Sample weight of every histogram bin, at most 100 and 0 for values seen 10 times or less"""
+    max_freq = 1000
+    with np.errstate(divide="ignore"):
+        return np.maximum(np.round(- max_freq / np.asarray(counts, dtype=float) + max_freq // 10), 0).astype(int)
+
+
+def fit_weighted_gmm_batch(values: np.ndarray, weights: np.ndarray, initial_gaussians: np.ndarray,
+                           reg_covar: float = 1e-4, tol: float = 1e-3, max_iter: int = 100
+                           ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    fit_weighted_gmm of many histograms in lockstep, a histogram stops updating once it converged.
+
+    :param values: (histograms, bins), rows padded with any value
+    :param weights: (histograms, bins), 0 for padding
+    :param initial_gaussians: (histograms, n_components, 3) of (mean, variance, weight)
+    :return: (means, variances, mixture weights), each (histograms, n_components)
+    """
+    x = np.asarray(values, dtype=float)[:, :, None]
+    w = np.asarray(weights, dtype=float)[:, :, None]
+    w_total = w.sum(axis=(1, 2))
+    means, variances, mix_weights = np.moveaxis(np.array(initial_gaussians, dtype=float), -1, 0)[:, :, None]
+    eps = 10 * np.finfo(float).eps
+    lower_bound = np.full(len(x), -np.inf)
+    active = np.arange(len(x))
+    for _ in range(max_iter):
+        xa, wa = x[active], w[active]
+        mean, variance, mix_weight = means[active], variances[active], mix_weights[active]
+        with np.errstate(divide="ignore"):
+            log_prob = -0.5 * (np.log(2 * np.pi * variance) + (xa - mean) ** 2 / variance) + np.log(mix_weight)
+        log_prob_max = log_prob.max(axis=2, keepdims=True)
+        log_prob_norm = np.log(np.exp(log_prob - log_prob_max).sum(axis=2, keepdims=True)) + log_prob_max
+        resp = np.exp(log_prob - log_prob_norm) * wa
+        nk = resp.sum(axis=1, keepdims=True) + eps
+        mean = (resp * xa).sum(axis=1, keepdims=True) / nk
+        means[active] = mean
+        variances[active] = (resp * (xa - mean) ** 2).sum(axis=1, keepdims=True) / nk + reg_covar
+        mix_weights[active] = nk / nk.sum(axis=2, keepdims=True)
+
+        prev_lower_bound = lower_bound[active]
+        lower_bound[active] = (log_prob_norm * wa).sum(axis=(1, 2)) / w_total[active]
+        active = active[np.abs(lower_bound[active] - prev_lower_bound) >= tol]
+        if not len(active):
+            break
+    return means[:, 0], variances[:, 0], mix_weights[:, 0]
+
+
+def find_key_thresholds(difference_per_frame: Union[DpfType, np.ndarray], cord_type: np.ndarray,
+                        per_key: bool = False, n_components: int = N_COMPONENTS) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Note thresholds fitted separately for white and black keys, so dimmer black key highlights get their own.
+    With per_key every key is refined by its own fit, all keys at once with fit_weighted_gmm_batch warm
+    started from their class's mixture. A threshold that fires on more than MAX_TRIGGER_RATE of its values,
+    or a key without enough data for a fit, falls back to the class's, and a class's to the global one,
+    which is only fitted when a class needs it.
+
+    :param cord_type: key class of every dpf column, 0 white and 1 black as in process_video_func
+    :return: (note_off, note_on) arrays with one threshold per dpf column
+    """
+    dpf = np.asarray(difference_per_frame, dtype=int).reshape(len(difference_per_frame), -1)
+    cord_type = np.asarray(cord_type)
+    note_off = np.zeros(dpf.shape[1])
+    note_on = np.zeros(dpf.shape[1])
+    class_gaussians = np.zeros((dpf.shape[1], n_components, 3))
+    global_thresholds: Optional[tuple[float, float]] = None
+    for key_class in np.unique(cord_type):
+        columns = cord_type == key_class
+        # bins are damped by how often a value shows up across the whole keyboard
+        values, counts = np.unique(dpf[:, columns], return_counts=True)
+        analyser = Analyser()
+        analyser.set_histogram(values, counts * dpf.shape[1] / np.count_nonzero(columns))
+        class_note_off, class_note_on = analyser.find_note_thresholds()
+        class_note_off = _checked_threshold(dpf[:, columns], class_note_off, None, is_note_on=False)
+        class_note_on = _checked_threshold(dpf[:, columns], class_note_on, None, is_note_on=True)
+        if global_thresholds is None and (class_note_off is None or class_note_on is None):
+            global_thresholds = Analyser(dpf).find_note_thresholds()
+        note_off[columns] = class_note_off if class_note_off is not None else global_thresholds[0]
+        note_on[columns] = class_note_on if class_note_on is not None else global_thresholds[1]
+        class_gaussians[columns] = analyser.gaussian_list
+    if not per_key:
+        return note_off, note_on
+
+    # one histogram row per key over the value range of the dpf
+    low = dpf.min()
+    n_bins = dpf.max() - low + 1
+    counts = np.bincount((dpf - low + np.arange(dpf.shape[1]) * n_bins).ravel(),
+                         minlength=dpf.shape[1] * n_bins).reshape(dpf.shape[1], n_bins)
+    weights = damp_counts(counts * dpf.shape[1])
+    usable = np.count_nonzero(weights, axis=1) >= 2 * n_components
+    if not usable.any():
+        return note_off, note_on
+    weights = weights[usable]
+    # pack every row's nonzero bins to the front
+    order = np.argsort(weights == 0, axis=1, kind="stable")[:, :np.count_nonzero(weights, axis=1).max()]
+    values = np.take_along_axis(np.broadcast_to(np.arange(n_bins) + low, weights.shape), order, axis=1)
+    weights = np.take_along_axis(weights, order, axis=1)
+
+    # fit in scaled space like Analyser.find_gmm
+    mean = np.average(values, axis=1, weights=weights)[:, None]
+    std = np.sqrt(np.average((values - mean) ** 2, axis=1, weights=weights))[:, None]
+    std[std == 0] = 1
+    initial = class_gaussians[usable].copy()
+    initial[..., 0] = (initial[..., 0] - mean) / std
+    initial[..., 1] /= std ** 2
+    means, variances, mix_weights = fit_weighted_gmm_batch((values - mean) / std, weights, initial)
+    gaussians = np.stack([means * std + mean, variances * std ** 2, mix_weights], axis=-1)
+
+    for key_idx, key_gaussians in zip(np.flatnonzero(usable), gaussians):
+        try:
+            bf = BoundaryFinder([tuple(g) for g in key_gaussians])
+            key_note_on = bf.find_note_on_decision_boundary()
+            key_note_off = bf.find_note_off_decision_boundary()
+        except IndexError:  # no component above or below the neutral one
+            continue
+        key_values = dpf[:, key_idx]
+        note_off[key_idx] = _checked_threshold(key_values, key_note_off, note_off[key_idx], is_note_on=False)
+        note_on[key_idx] = _checked_threshold(key_values, key_note_on, note_on[key_idx], is_note_on=True)
+    return note_off, note_on
+
+
+def _checked_threshold(values: np.ndarray, threshold: float, fallback: Optional[float], is_note_on: bool
+                       ) -> Optional[float]:
+    """threshold, or fallback if it is on the wrong side of 0 or fires on more than MAX_TRIGGER_RATE of values"""
+    if not np.isfinite(threshold) or (threshold <= 0 if is_note_on else threshold >= 0):
+        return fallback
+    trigger_rate = np.mean(values > threshold) if is_note_on else np.mean(values < threshold)
+    return threshold if trigger_rate <= MAX_TRIGGER_RATE else fallback
+
+
 class Analyser:
-    def __init__(self, raw_data: list[int] | list[list[int]] | None=None):
+    def __init__(self, raw_data: list[int] | list[list[int]] | np.ndarray | None=None):
         self.scaler: StandardScaler = StandardScaler()
-        self.raw_data: list[int] = [] if raw_data is None else flatten_list(raw_data)
-        self._data: list[int] = []
+        # flattened dpf of every loaded source
+        self.raw_data: list[np.ndarray] = [] if raw_data is None else [np.ravel(raw_data)]
+        self._values: np.ndarray = np.array([], dtype=int)     # distinct dpf values
+        self._weights: np.ndarray = np.array([], dtype=int)    # their damped frequencies, see set_histogram
         self.gaussian_list: list[tuple] = []
         self.generate_data_from_raw()
 
+    @property
+    def _data(self) -> list[int]:
+        """Samples the gmm is fitted on, every value repeated by its weight"""
+        return np.repeat(self._values, self._weights).tolist()
+
     def generate_data_from_raw(self):
+        if not self.raw_data:
+            self.set_histogram(np.array([], dtype=int), np.array([], dtype=int))
+            return
+        values = np.concatenate(self.raw_data).astype(int, copy=False)
+        counts = np.bincount(values - values.min())
+        distinct = np.flatnonzero(counts)
+        self.set_histogram(distinct + values.min(), counts[distinct])
+
+    def set_value_counts(self, value_counts: Counter):
+        """Fit on a histogram {dpf value: occurrences} instead of raw_data, for callers that never keep the dpf"""
+        self.set_histogram(np.fromiter(value_counts.keys(), dtype=int, count=len(value_counts)),
+                           np.fromiter(value_counts.values(), dtype=int, count=len(value_counts)))
+
+    def set_histogram(self, values: np.ndarray, counts: np.ndarray):
+        """
+        :param values: distinct dpf values
+        :param counts: occurrences of every value, damped so the few huge neutral counts don't drown the rest
+        """
         self.gaussian_list = []
-        self._data = []
-
-        data_counter = Counter(flatten_list(self.raw_data))
-
-        for k, i in data_counter.items():
-            max_freq = 1000
-            val = round(- max_freq / i + max_freq // 10)
-            data_counter[k] = val if val >= 0 else 0
-
-        # frequencies = sorted(list(data_counter.values()))
-
-        for val, frequency in data_counter.items():
-            self._data += [val] * frequency
+        weights = damp_counts(counts)
+        keep = weights > 0
+        self._values = np.asarray(values, dtype=int)[keep]
+        self._weights = weights[keep]
 
     def set_data(self, new_data):
-        self.raw_data = new_data
+        self.raw_data = [np.ravel(new_data)]
         self.generate_data_from_raw()
 
     def _load_data_from_file(self, file_path: str):
         try:
-            with open(file_path, 'r') as json_file:
-                json_data = json.load(json_file)
-                self.raw_data += json_data["dpf"]
-        except (json.decoder.JSONDecodeError, KeyError):
+            _, dpf, _ = load_dpf(file_path)
+            self.raw_data.append(np.ravel(dpf))
+        except (json.decoder.JSONDecodeError, KeyError, ValueError):
             pass
 
     def load_data_from_file(self, file_path: str):
@@ -107,47 +341,52 @@ class Analyser:
 
     def load_data_from_history(self, directory_path: str):
         self.raw_data = []  # Clear any previous data
-        for root, _, files in os.walk(directory_path):
-            for file in files:
-                if not file.endswith(".json"):
-                    continue
-                file_path = os.path.join(root, file)
-                self._load_data_from_file(file_path)
+        for file_path in list_dpf_files(directory_path):
+            self._load_data_from_file(file_path)
         self.generate_data_from_raw()
 
     def plot_data(self):
-        if not self._data:
+        if not len(self._values):
             raise RuntimeError("No data to process. Please load data first.")
-        data_counter = Counter(self._data)
-        unique_values = list(data_counter.keys())
-        frequencies = list(data_counter.values())
-        plt.bar(unique_values, frequencies)
+        plt.bar(self._values, self._weights)
         plt.xlabel("Value")
         plt.ylabel("Frequency")
         plt.title("Frequency of Unique Values")
         plt.show()
 
-    def find_gmm(self, n_components=N_COMPONENTS):
+    def find_gmm(self, n_components=N_COMPONENTS, initial_gaussians: Optional[list[tuple]] = None):
+        """
+        :param initial_gaussians: [(mean, covariance, weight), ...] to warm start the fit from, usually the
+            gaussian_list of a similar video
+        """
         if self.gaussian_list and len(self.gaussian_list) == n_components:
             return self.gaussian_list
-        if not self._data:
+        if not len(self._values):
             raise RuntimeError("No data to process. Please load data first.")
 
-        data_array = np.array(self._data).reshape(-1, 1)
-        data_scaled = self.scaler.fit_transform(data_array)
-
-        # Fit Gaussian mixture model with adjusted regularization
-        gmm = GaussianMixture(
-            n_components=n_components,
+        data_array = self._values.reshape(-1, 1).astype(float)
+        data_scaled = self.scaler.fit_transform(data_array, sample_weight=self._weights).flatten()
+
+        # Fit Gaussian mixture model with adjusted regularization on the histogram
+        if initial_gaussians is not None and len(initial_gaussians) == n_components:
+            initial_means, initial_covariances, initial_weights = np.array(initial_gaussians, dtype=float).T
+            initial_gaussians = np.stack([
+                self.scaler.transform(initial_means.reshape(-1, 1)).flatten(),
+                initial_covariances / self.scaler.var_[0],
+                initial_weights,
+            ], axis=1)
+        else:
+            initial_gaussians = None
+        gmm_means, gmm_covariances, weights = fit_weighted_gmm(
+            data_scaled, self._weights, n_components,
             random_state=42,
             reg_covar=1e-4,
+            initial_gaussians=initial_gaussians,
         )
-        gmm.fit(data_scaled)
 
         # Reverse scaling to interpret results
-        means = self.scaler.inverse_transform(gmm.means_).flatten()
-        covariances = gmm.covariances_.flatten() * self.scaler.var_[0]  # Adjust covariances
-        weights = gmm.weights_
+        means = self.scaler.inverse_transform(gmm_means.reshape(-1, 1)).flatten()
+        covariances = gmm_covariances * self.scaler.var_[0]  # Adjust covariances
 
         self.gaussian_list = list(zip(means, covariances, weights))
         return self.gaussian_list
@@ -160,21 +399,16 @@ class Analyser:
         for idx, entry in enumerate(self.gaussian_list):
             print(f"{idx:>3}){entry[0]:>11.2f}{entry[1]:>15.2f}{entry[2]:>15.2f}")
 
-        # Prepare the histogram with frequencies
-        data_counter = Counter(self._data)
-        unique_values = list(data_counter.keys())
-        frequencies = list(data_counter.values())
-
         # Plot the histogram with frequencies
         bin_width = 1
-        plt.bar(unique_values, frequencies, width=bin_width, alpha=0.5, label="Data histogram", color="gray")
+        plt.bar(self._values, self._weights, width=bin_width, alpha=0.5, label="Data histogram", color="gray")
 
         # Generate x values for GMM PDF
-        x = np.linspace(min(self._data), max(self._data), 1000).reshape(-1, 1)
+        x = np.linspace(self._values.min(), self._values.max(), 1000).reshape(-1, 1)
 
         for mean, cov, weight in self.gaussian_list:
             gaussian = (
-                    weight * len(self._data) * (1 / np.sqrt(2 * np.pi * cov))
+                    weight * self._weights.sum() * (1 / np.sqrt(2 * np.pi * cov))
                     * np.exp(-0.5 * ((x - mean) ** 2 / cov))
             )
             plt.plot(x, gaussian, linestyle="--", label=f"Gaussian {mean:6.2f} cov={cov:6.2f}")
@@ -192,13 +426,14 @@ class Analyser:
         with open(path, 'w+') as file:
             file.write(json.dumps(self._data))
 
-    def find_note_thresholds(self, plot=False):
+    def find_note_thresholds(self, plot=False, initial_gaussians: Optional[list[tuple]] = None):
         """
         Finds the decision boundary between note on (mean > 0) and other distributions
         :param plot: shows graph if set to true
+        :param initial_gaussians: warm start for find_gmm
         :return: tuple (note_off_bounds, note_on_bounds)
         """
-        self.find_gmm()
+        self.find_gmm(initial_gaussians=initial_gaussians)
         bf = BoundaryFinder(self.gaussian_list)
         note_on_bounds = bf.find_note_on_decision_boundary()
         note_off_bounds = bf.find_note_off_decision_boundary()
@@ -209,6 +444,82 @@ class Analyser:
         return note_off_bounds, note_on_bounds
 
 
+class OnlineThresholdEstimator:
+    """
+    Note thresholds of a dpf that is still being produced. Rows are counted into a histogram over the
+    whole dpf value range as they arrive and the mixture is refitted on it when due, so current thresholds
+    are available at any time. A refit costs a few milliseconds however many rows were counted.
+    """
+    def __init__(self, min_frames: int = ONLINE_MIN_FRAMES, refit_interval: int = ONLINE_REFIT_FRAMES,
+                 reject_noisy_fits: bool = True):
+        """
+        :param min_frames: rows counted before the first fit, thresholds are None until then
+        :param refit_interval: rows between refits after the first fit, 0 to never refit
+        :param reject_noisy_fits: keep the last thresholds instead of a fit with a threshold inside the noise,
+            as fits on the first seconds of a video with only a few notes often have
+        """
+        self.min_frames: int = min_frames
+        self.refit_interval: int = refit_interval
+        self.reject_noisy_fits: bool = reject_noisy_fits
+        self.frame_count: int = 0
+        self.note_off_threshold: Optional[float] = None
+        self.note_on_threshold: Optional[float] = None
+        self.gaussian_list: list[tuple] = []
+        self._offset: int = -int(np.iinfo(DPF_DTYPE).min)
+        self._counts: np.ndarray = np.zeros(1 << np.iinfo(DPF_DTYPE).bits, dtype=np.int64)
+
+    @property
+    def thresholds(self) -> Optional[tuple[float, float]]:
+        """(note_off_threshold, note_on_threshold) of the last accepted fit, None before the first one"""
+        if self.note_on_threshold is None:
+            return None
+        return self.note_off_threshold, self.note_on_threshold
+
+    def is_fit_due(self) -> bool:
+        if self.frame_count < self.min_frames:
+            return False
+        # until a fit is accepted, retry every min_frames rows
+        if self.note_on_threshold is None:
+            return self.frame_count % max(self.min_frames, 1) == 0
+        return bool(self.refit_interval) and self.frame_count % self.refit_interval == 0
+
+    def add(self, frame_diff: np.ndarray):
+        """Count the next row of the dpf without fitting"""
+        np.add.at(self._counts, np.asarray(frame_diff, dtype=int) + self._offset, 1)
+        self.frame_count += 1
+
+    def push(self, frame_diff: np.ndarray):
+        """Count the next row of the dpf and refit if it is due"""
+        self.add(frame_diff)
+        if self.is_fit_due():
+            self.fit()
+
+    @staticmethod
+    def is_noisy_fit(gaussian_list: list[tuple], note_off: float, note_on: float) -> bool:
+        """True if a threshold lies within NOISE_SIGMAS of the neutral gaussian, which then got split in two"""
+        neutral_mean, neutral_var, _ = gaussian_list[BoundaryFinder(gaussian_list).find_neutral_index()]
+        noise = NOISE_SIGMAS * math.sqrt(neutral_var)
+        return not note_off < neutral_mean - noise or not note_on > neutral_mean + noise
+
+    def fit(self) -> Optional[tuple[float, float]]:
+        """
+        Refit on every row counted so far, skipped while the histogram has fewer bins than components
+
+        :return: thresholds, see the property
+        """
+        values = np.flatnonzero(self._counts)
+        analyser = Analyser()
+        analyser.set_histogram(values - self._offset, self._counts[values])
+        if len(analyser._values) < N_COMPONENTS:
+            return self.thresholds
+        note_off, note_on = analyser.find_note_thresholds()
+        if self.reject_noisy_fits and self.is_noisy_fit(analyser.gaussian_list, note_off, note_on):
+            return self.thresholds
+        self.gaussian_list = analyser.gaussian_list
+        self.note_off_threshold, self.note_on_threshold = float(note_off), float(note_on)
+        return self.thresholds
+
+
 def main():
     directory_path = os.path.join(p2m_path.DATA_DIR, "dpf", "Eula Flickering Candlelight.dpf.json")  # Adjust the directory path
     analyser = Analyser()
@@ -226,5 +537,68 @@ def main():
     # plotter.export("dpf_data.json")
     # print(plotter.data.__len__())
 
+def check_boundaries(n_pairs=2000):
+    """Checks that both weighted densities are equal at the boundary of random pairs crossing between their means"""
+    rng = np.random.default_rng(0)
+    gaussians1 = np.stack([rng.uniform(-200, 200, n_pairs), rng.uniform(1, 2000, n_pairs),
+                           rng.uniform(0.01, 1, n_pairs)], axis=1)
+    gaussians2 = np.stack([rng.uniform(-200, 200, n_pairs), rng.uniform(1, 2000, n_pairs),
+                           rng.uniform(0.01, 1, n_pairs)], axis=1)
+    boundaries = gaussian_boundaries(gaussians1, gaussians2)
+    low = np.minimum(gaussians1[:, 0], gaussians2[:, 0])
+    high = np.maximum(gaussians1[:, 0], gaussians2[:, 0])
+    at_low = weighted_log_density(gaussians1, low) - weighted_log_density(gaussians2, low)
+    at_high = weighted_log_density(gaussians1, high) - weighted_log_density(gaussians2, high)
+    crossing = np.sign(at_low) != np.sign(at_high)
+    difference = weighted_log_density(gaussians1, boundaries) - weighted_log_density(gaussians2, boundaries)
+    if not np.allclose(difference[crossing], 0, atol=1e-8):
+        raise RuntimeError("Weighted densities differ at a boundary")
+    print(f"{np.count_nonzero(crossing)} of {n_pairs} pairs cross between their means, all at their boundary")
+
+
+def benchmark(n_frames=20000, n_keys=88):
+    """
+    Times the histogram fit against sklearn's GaussianMixture on the expanded samples of a random song
+    and checks both give the same thresholds within FIT_TOLERANCE. The k-means seeding differs, so on a
+    dpf that is mostly noise or has few distinct values, e.g. 3000 frames of 40 keys, the mixture likelihood
+    is flat and the two fits can settle on different mixtures and thresholds, as sklearn's own fit does with
+    another random_state.
+    """
+    import time
+    from sklearn.mixture import GaussianMixture
+    from srcs.algo.utils import make_synthetic_dpf
+
+    check_boundaries()
+    difference_per_frame = make_synthetic_dpf(n_frames, n_keys)
+
+    start = time.perf_counter()
+    analyser = Analyser(difference_per_frame)
+    note_off_bounds, note_on_bounds = analyser.find_note_thresholds()
+    histogram_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    data_counter = Counter(flatten_list(difference_per_frame.tolist()))
+    expanded = Analyser()
+    expanded.set_value_counts(data_counter)
+    data_scaled = StandardScaler().fit_transform(np.array(expanded._data).reshape(-1, 1))
+    gmm = GaussianMixture(n_components=N_COMPONENTS, random_state=42, reg_covar=1e-4).fit(data_scaled)
+    expanded_time = time.perf_counter() - start
+
+    print(f"{difference_per_frame.size} values, {len(analyser._values)} distinct, {len(analyser._data)} samples")
+    print(f"Histogram means: {np.sort([g[0] for g in analyser.gaussian_list]).round(2)}")
+    print(f"Expanded means:  {np.sort(analyser.scaler.inverse_transform(gmm.means_).flatten()).round(2)}")
+    print(f"Note On Boundary: {note_on_bounds:.2f}, Note Off Boundary: {note_off_bounds:.2f}")
+    print(f"Expanded samples: {expanded_time:>7.3f}s")
+    print(f"Histogram:        {histogram_time:>7.3f}s ({expanded_time / histogram_time:.1f}x)")
+
+    means = analyser.scaler.inverse_transform(gmm.means_).flatten()
+    covariances = gmm.covariances_.flatten() * analyser.scaler.var_[0]
+    bf = BoundaryFinder(list(zip(means, covariances, gmm.weights_)))
+    expanded_bounds = np.array([bf.find_note_off_decision_boundary(), bf.find_note_on_decision_boundary()])
+    if np.abs(expanded_bounds - [note_off_bounds, note_on_bounds]).max() > FIT_TOLERANCE:
+        raise RuntimeError(f"Histogram thresholds {note_off_bounds:.2f}, {note_on_bounds:.2f} differ from the "
+                           f"expanded ones {expanded_bounds[0]:.2f}, {expanded_bounds[1]:.2f}")
+
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
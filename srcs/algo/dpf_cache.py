@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import time
+from typing import Optional
+
+from algo.dpf_file import DpfData, list_dpf_files, dpf_file_paths, DPF_SUFFIX
+from algo.get_watch_cords import DEFAULT_GRID
+from p2m import p2m_constants, p2m_path
+from p2m.p2m_types import *
+
+ALGORITHM_VERSION = 1                   # bump whenever a change to key sampling changes the dpf of a video
+FINGERPRINT_CHUNK_SIZE = 1 << 20        # bytes hashed at the start, middle and end of a video
+MAX_CACHE_BYTES = 2 * 1024 ** 3
+
+
+def video_fingerprint(video_path: str) -> str:
+    """Hash of the file size and three 1MB chunks, fast enough for multi GB videos"""
+    size = os.path.getsize(video_path)
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(video_path, "rb") as f:
+        for offset in (0, (size - FINGERPRINT_CHUNK_SIZE) // 2, size - FINGERPRINT_CHUNK_SIZE):
+            f.seek(max(0, offset))
+            digest.update(f.read(FINGERPRINT_CHUNK_SIZE))
+    return digest.hexdigest()
+
+
+def layout_fingerprint(keys: list[RectType], black_keys: list[RectType]) -> str:
+    """Hash of the key rectangles in dpf column order and which of them are black"""
+    layout = json.dumps([[list(key) for key in keys], sorted(list(key) for key in black_keys)])
+    return hashlib.blake2b(layout.encode(), digest_size=16).hexdigest()
+
+
+class DpfCache:
+    """
+    Content addressed dpf store, entries are keyed by video content, key layout and ALGORITHM_VERSION
+    so renamed videos hit and different videos with the same title never collide.
+
+    Every dpf file in the directory (including title named history) counts towards max_bytes,
+    the least recently used ones are evicted first.
+    """
+    def __init__(self, directory: str = p2m_path.DPF_DIR, max_bytes: int = MAX_CACHE_BYTES):
+        self.directory: str = directory
+        self.max_bytes: int = max_bytes
+
+    @staticmethod
+    def get_key(video_path: str, keys: list[RectType], black_keys: list[RectType],
+                grid: int = p2m_constants.WATCH_CORD_GRID) -> str:
+        """:param grid: watch cords per key side the dpf is sampled with, see get_watch_cord_arrays"""
+        key_source = f"{ALGORITHM_VERSION}:{video_fingerprint(video_path)}:{layout_fingerprint(keys, black_keys)}"
+        if grid != DEFAULT_GRID:  # keys of dpfs cached before the grid was configurable stay valid
+            key_source += f":grid={grid}"
+        return hashlib.blake2b(key_source.encode(), digest_size=20).hexdigest()
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}{DPF_SUFFIX}")
+
+    def contains(self, key: str) -> bool:
+        return os.path.exists(self.get_path(key))
+
+    def _touch(self, key: str):
+        now = time.time()
+        for path in dpf_file_paths(self.get_path(key)):
+            os.utime(path, (now, now))
+
+    def load(self, key: str, mmap: bool = True) -> Optional[DpfData]:
+        """:return: the cached dpf or None on a miss"""
+        try:
+            ret = DpfData.load(self.get_path(key), mmap)
+        except (FileNotFoundError, ValueError, KeyError, json.decoder.JSONDecodeError):
+            return None
+        self._touch(key)
+        return ret
+
+    def store(self, key: str, dpf: DpfData, extra_meta: Optional[dict] = None):
+        """:param dpf: stored with its keys, see get_key"""
+        if self.contains(key):
+            self._touch(key)
+            return
+        meta = {"cache_key": key, "algorithm_version": ALGORITHM_VERSION, **(extra_meta or {})}
+        dpf.save(self.get_path(key), meta)
+        self.evict(keep=key)
+
+    def get_size(self) -> int:
+        return sum(os.path.getsize(path) for dpf_path in list_dpf_files(self.directory)
+                   for path in dpf_file_paths(dpf_path))
+
+    def evict(self, keep: Optional[str] = None):
+        """Removes least recently used dpf files until the directory fits in max_bytes"""
+        keep_path = self.get_path(keep) if keep is not None else None
+        entries = []
+        for dpf_path in list_dpf_files(self.directory):
+            paths = dpf_file_paths(dpf_path)
+            entries.append((max(os.path.getmtime(p) for p in paths), sum(os.path.getsize(p) for p in paths),
+                            dpf_path, paths))
+        total_size = sum(entry[1] for entry in entries)
+        for _, size, dpf_path, paths in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            if dpf_path == keep_path:
+                continue
+            try:
+                for path in paths:
+                    os.remove(path)
+            except OSError:  # still memory mapped by another job
+                continue
+            total_size -= size
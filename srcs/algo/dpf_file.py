@@ -0,0 +1,223 @@
+import json
+import os
+import pathlib
+from typing import Optional
+
+import numpy as np
+
+from p2m.p2m_types import *
+
+DPF_SUFFIX = ".dpf.npy"             # int16 array, frames x keys, loadable with np.load(mmap_mode='r')
+META_SUFFIX = ".dpf.meta.json"      # fps and key layout of the array next to it
+LEGACY_SUFFIX = ".dpf.json"         # {"fps": float, "dpf": [[int, ...], ...]}
+DPF_FORMAT_VERSION = 1
+DPF_DTYPE = np.int16
+
+
+def dpf_base_path(path: str) -> str:
+    """Path without any dpf suffix, the same for the binary, metadata and legacy files of one video"""
+    for suffix in (DPF_SUFFIX, META_SUFFIX, LEGACY_SUFFIX):
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+
+def find_dpf_file(path: str) -> Optional[str]:
+    """Existing dpf file for path, the binary format is preferred over the legacy json"""
+    base_path = dpf_base_path(path)
+    for suffix in (DPF_SUFFIX, LEGACY_SUFFIX):
+        if os.path.exists(base_path + suffix):
+            return base_path + suffix
+    return None
+
+
+def _write_atomic(path: str, write_func):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        write_func(f)
+    os.replace(tmp_path, path)
+
+
+def save_dpf(path: str, fps: float, dpf: Union[DpfType, np.ndarray],
+             keys: Optional[list[RectType]] = None, black_keys: Optional[list[RectType]] = None,
+             extra_meta: Optional[dict] = None) -> str:
+    """
+    Writes the difference per frame in the binary format.
+
+    :param path: destination, any dpf suffix is replaced
+    :param keys: key rectangles in column order of dpf
+    :param black_keys: the black ones among keys
+    :param extra_meta: json serializable entries added to the metadata
+    :return: path of the written array
+    """
+    base_path = dpf_base_path(path)
+    pathlib.Path(base_path).parent.mkdir(parents=True, exist_ok=True)
+    array = np.asarray(dpf)
+    if array.size == 0:
+        array = array.reshape(0, len(keys) if keys else 0)
+    info = np.iinfo(DPF_DTYPE)
+    if array.size and (array.min() < info.min or array.max() > info.max):
+        raise ValueError(f"dpf values out of {np.dtype(DPF_DTYPE).name} range")
+    array = array.astype(DPF_DTYPE, copy=False)
+
+    meta = {
+        "version": DPF_FORMAT_VERSION,
+        "fps": fps,
+        "shape": list(array.shape),
+        "keys": [list(key) for key in keys] if keys is not None else None,
+        "black_keys": [list(key) for key in black_keys] if black_keys is not None else None,
+        **(extra_meta or {}),
+    }
+    # metadata first, an array is never found without its metadata
+    _write_atomic(base_path + META_SUFFIX, lambda f: f.write(json.dumps(meta).encode()))
+    _write_atomic(base_path + DPF_SUFFIX, lambda f: np.save(f, array))
+    return base_path + DPF_SUFFIX
+
+
+def load_dpf(path: str, mmap: bool = True) -> tuple[float, np.ndarray, dict]:
+    """
+    Reads a dpf file in either format.
+
+    :param path: binary, metadata or legacy json path, or the path without suffix
+    :param mmap: memory map the binary format instead of reading it
+    :return: (fps, dpf array of frames x keys, metadata), metadata is empty for legacy files
+    """
+    dpf_path = find_dpf_file(path)
+    if dpf_path is None:
+        raise FileNotFoundError(f"No dpf file for {path}")
+    if dpf_path.endswith(LEGACY_SUFFIX):
+        with open(dpf_path, "r") as f:
+            data = json.load(f)
+        return data["fps"], np.asarray(data["dpf"], dtype=DPF_DTYPE), {}
+
+    with open(dpf_base_path(dpf_path) + META_SUFFIX, "r") as f:
+        meta = json.load(f)
+    dpf = np.load(dpf_path, mmap_mode="r" if mmap else None)
+    return meta["fps"], dpf, meta
+
+
+class DpfData:
+    """
+    Difference per frame of a video with the fps and the key of every column, passed between processing,
+    threshold fitting, midi conversion and the dpf files. np.asarray(dpf_data) is the frames x keys array,
+    nested lists are only built by tolist for callers that still expect DpfType.
+    """
+    def __init__(self, array: Union[DpfType, np.ndarray], fps: float,
+                 keys: Optional[list[RectType]] = None, black_keys: Optional[list[RectType]] = None,
+                 meta: Optional[dict] = None):
+        """
+        :param array: frames x keys, kept as is if it already is DPF_DTYPE (e.g. memory mapped)
+        :param keys: key rectangles in column order
+        :param meta: metadata of the file it was loaded from
+        """
+        array = np.asarray(array).astype(DPF_DTYPE, copy=False)
+        if array.ndim != 2:
+            array = array.reshape(len(array), -1 if array.size else len(keys or ()))
+        self.array: np.ndarray = array
+        self.fps: float = fps
+        self.keys: Optional[list[RectType]] = keys
+        self.black_keys: Optional[list[RectType]] = black_keys
+        self.meta: dict = meta or {}
+
+    def __repr__(self):
+        return f"DpfData({len(self)} frames x {self.n_keys} keys, {self.fps} fps, {self.array.nbytes / 1024:.0f}KB)"
+
+    def __len__(self):
+        return len(self.array)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.array if dtype is None else self.array.astype(dtype, copy=False)
+
+    @property
+    def n_keys(self) -> int:
+        return self.array.shape[1]
+
+    def tolist(self) -> DpfType:
+        return self.array.tolist()
+
+    def save(self, path: str, extra_meta: Optional[dict] = None) -> str:
+        """see save_dpf"""
+        return save_dpf(path, self.fps, self.array, self.keys, self.black_keys, extra_meta)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "DpfData":
+        """see load_dpf, keys are None for legacy files"""
+        fps, array, meta = load_dpf(path, mmap)
+        keys, black_keys = meta.get("keys"), meta.get("black_keys")
+        return cls(array, fps, [tuple(key) for key in keys] if keys is not None else None,
+                   [tuple(key) for key in black_keys] if black_keys is not None else None, meta)
+
+
+def dpf_file_paths(path: str) -> list[str]:
+    """Every existing file that belongs to the dpf of path"""
+    base_path = dpf_base_path(path)
+    return [base_path + suffix for suffix in (DPF_SUFFIX, META_SUFFIX, LEGACY_SUFFIX)
+            if os.path.exists(base_path + suffix)]
+
+
+def list_dpf_files(directory: str) -> list[str]:
+    """One dpf file per video in directory and its subdirectories, see find_dpf_file"""
+    base_paths = set()
+    for root, _, files in os.walk(directory):
+        for file in files:
+            if file.endswith(DPF_SUFFIX) or file.endswith(LEGACY_SUFFIX):
+                base_paths.add(dpf_base_path(os.path.join(root, file)))
+    return sorted(find_dpf_file(base_path) for base_path in base_paths)
+
+
+def migrate_dpf_dir(directory: str, remove_legacy: bool = False) -> list[str]:
+    """
+    Converts every legacy .dpf.json in directory that has no binary version yet.
+
+    :param remove_legacy: delete the json once it is converted
+    :return: paths of the converted json files
+    """
+    migrated = []
+    for dpf_path in list_dpf_files(directory):
+        if not dpf_path.endswith(LEGACY_SUFFIX):
+            continue
+        try:
+            fps, dpf, _ = load_dpf(dpf_path)
+        except (json.decoder.JSONDecodeError, KeyError, ValueError, OverflowError) as exc:
+            print(f"Skipped {dpf_path}: {exc}")
+            continue
+        save_dpf(dpf_path, fps, dpf)
+        if remove_legacy:
+            os.remove(dpf_path)
+        migrated.append(dpf_path)
+    return migrated
+
+
+def benchmark(n_frames=7200, n_keys=88, fps=30.0):
+    """
+    Memory and time of one song from dpf to midi, as the nested lists generate_diff_per_frame used to
+    return against DpfData. 7200 frames is 4 minutes of 30 fps video.
+    """
+    import io
+    import time
+    import tracemalloc
+    from algo.dpf_to_midi import dpf_data_to_midi
+    from algo.utils import make_synthetic_dpf
+
+    dpf = make_synthetic_dpf(n_frames, n_keys).astype(DPF_DTYPE)
+
+    midis = {}
+    for name, make_dpf in (("nested lists", lambda: dpf.astype(int).tolist()), ("DpfData", lambda: DpfData(dpf.copy(), fps))):
+        tracemalloc.start()
+        start = time.perf_counter()
+        song = make_dpf()
+        dpf_size = tracemalloc.get_traced_memory()[0]
+        midi = dpf_data_to_midi(fps, song)
+        duration = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        midis[name] = io.BytesIO()
+        midi.save(file=midis[name])
+        print(f"{name:<13} dpf {dpf_size / 1024 ** 2:>6.2f}MB, peak {peak / 1024 ** 2:>6.2f}MB, "
+              f"to midi {duration * 1000:>7.1f}ms")
+    if midis["nested lists"].getvalue() != midis["DpfData"].getvalue():
+        raise RuntimeError("DpfData midi differs from the nested lists midi")
+
+
+if __name__ == '__main__':
+    benchmark()
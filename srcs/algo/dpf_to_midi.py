@@ -1,13 +1,89 @@
 import mido
 import statistics
-from srcs.algo.dpf_analyser import Analyser
+from collections import Counter
+from typing import Optional, Union
+import numpy as np
+from srcs.algo.dpf_analyser import Analyser, OnlineThresholdEstimator
+from srcs.algo.dpf_file import DpfData
+from srcs.algo.frame_buffer import FrameBuffer
+
+BASE_NOTE = 24              # Low C, note of key index 0
+WARMUP_SECONDS = 10.0       # video time the streaming converter buffers before deciding any note
+REFIT_SECONDS = 30.0        # video time between threshold refits of the streaming converter
+DEFAULT_TEMPO = 500000      # microseconds per beat, mido's 120 bpm, when no note ended to find a beat in
+
+
+def find_note_events(difference_per_frame: Union[DpfData, np.ndarray, list[list[int]]],
+                     note_on_threshold: Union[float, np.ndarray], note_off_threshold: Union[float, np.ndarray]
+                     ) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Note on and off messages of the whole dpf at once.
+
+    A value above note_on_threshold starts a note, ending the key's sounding note first, a value below
+    note_off_threshold ends the sounding note. Both only look at the previous on/off value of the same key.
+    Thresholds are either scalars or one per key.
+
+    :return: (frame index, note, is note on) of every message in track order, and the length in frames
+     of every note ended by a note off value
+    """
+    dpf = np.asarray(difference_per_frame)
+    if dpf.ndim != 2:
+        dpf = dpf.reshape(len(dpf), -1)
+    # transposed so nonzero walks key by key in frame order
+    on_values = (dpf > note_on_threshold).T
+    key_idx, frame_idx = np.nonzero(on_values | (dpf < note_off_threshold).T)
+    is_on = on_values[key_idx, frame_idx]
+
+    # the key is sounding when its previous on/off value was a note on
+    was_on = np.zeros(len(is_on), dtype=bool)
+    was_on[1:] = (key_idx[1:] == key_idx[:-1]) & is_on[:-1]
+    note_lengths = (frame_idx[1:] - frame_idx[:-1])[(was_on & ~is_on)[1:]]
+
+    # a note off for every sounding key, followed by the note on if there is one
+    frames = np.concatenate([frame_idx[was_on], frame_idx[is_on]])
+    keys = np.concatenate([key_idx[was_on], key_idx[is_on]])
+    is_note_on = np.repeat([False, True], [np.count_nonzero(was_on), np.count_nonzero(is_on)])
+    order = np.lexsort((is_note_on, keys, frames))
+    return frames[order], keys[order] + BASE_NOTE, is_note_on[order], note_lengths
+
+
+def format_threshold(threshold: Union[float, np.ndarray]) -> str:
+    if np.ndim(threshold) == 0:
+        return f"{threshold:.2f}"
+    return f"{np.min(threshold):.2f} - {np.max(threshold):.2f} (per key)"
+
+
+def get_dominant_note_length(note_lengths: np.ndarray) -> int:
+    """The most common note length, the smallest one on ties like statistics.multimode(sorted(...))[0]"""
+    lengths, counts = np.unique(note_lengths, return_counts=True)
+    if len(lengths) == 0:
+        raise statistics.StatisticsError("no note lengths")
+    return int(lengths[np.argmax(counts)])
+
+
+def append_note_events(track: mido.MidiTrack, frames: np.ndarray, notes: np.ndarray, is_note_on: np.ndarray,
+                       time_per_frame: int, note_on_velocity: int = 64, note_off_velocity: int = 0):
+    """Writes the events of find_note_events to track, the first event has zero time"""
+    times = np.diff(np.asarray(frames), prepend=frames[0] if len(frames) else 0) * time_per_frame
+    notes = np.asarray(notes)
+    if len(notes) and (notes.min() < 0 or notes.max() > 127 or times.min() < 0):
+        raise ValueError("note events out of midi range")
+    prototypes = {True: mido.Message('note_on', note=0, velocity=note_on_velocity),
+                  False: mido.Message('note_off', note=0, velocity=note_off_velocity)}
+    track.extend(prototypes[on].copy(note=note, time=time)
+                 for note, on, time in zip(notes.tolist(), np.asarray(is_note_on).tolist(), times.tolist()))
+
 
-# TODO
-#  separate black keys and white keys threshold completely
 class DpfToMidiConverter:
-    def __init__(self, source_video_fps: float, difference_per_frame: list[list[int]]):
+    def __init__(self, source_video_fps: float, difference_per_frame: Union[DpfData, np.ndarray, list[list[int]]],
+                 thresholds: Optional[tuple[float, float]] = None):
+        """
+        :param thresholds: (note_off, note_on) to use instead of fitting them on difference_per_frame,
+            either floats or arrays with one threshold per key
+        """
         self.source_video_fps = source_video_fps
         self.difference_per_frame = difference_per_frame
+        self.dpf_array: np.ndarray = np.asarray(difference_per_frame)
         self.midi = mido.MidiFile()
         self.track = mido.MidiTrack()
         self.midi.tracks.append(self.track)
@@ -17,25 +93,16 @@ class DpfToMidiConverter:
         self.note_on_record: dict[int, bool] = {}
         self.note_times: list[int] = []
         self.future_look_frames = 0
-        self.note_off_threshold, self.note_on_threshold = Analyser(difference_per_frame).find_note_thresholds()
-        print(f"  Note On Boundary: {self.note_on_threshold:.2f}")
-        print(f"  Note Off Boundary: {self.note_off_threshold:.2f}")
+        if thresholds is None:
+            thresholds = Analyser(self.dpf_array).find_note_thresholds()
+        self.note_off_threshold, self.note_on_threshold = thresholds
+        print(f"  Note On Boundary: {format_threshold(self.note_on_threshold)}")
+        print(f"  Note Off Boundary: {format_threshold(self.note_off_threshold)}")
 
     def get_note_times(self):
-        record = {}
-        note_times = []
-
-        for frame_idx, frame_diff in enumerate(self.difference_per_frame):
-            for key in record:
-                record[key] += 1
-            for key_idx, brightness_diff in enumerate(frame_diff):
-                if brightness_diff > self.note_on_threshold:
-                    record[key_idx] = 0
-                elif brightness_diff < self.note_off_threshold and key_idx in record:
-                    note_times.append(record[key_idx])
-                    del record[key_idx]
-
-        return note_times
+        _, _, _, note_lengths = find_note_events(self.dpf_array, self.note_on_threshold,
+                                                 self.note_off_threshold)
+        return note_lengths.tolist()
 
     def add_note_off(self, note: int):
         if not self.note_on_record.get(note, False):
@@ -52,7 +119,7 @@ class DpfToMidiConverter:
 
     # deprecated
     def add_future_note_on(self, frame_idx, key_idx, note):
-        for frame_diff in self.difference_per_frame[frame_idx: frame_idx + self.future_look_frames]:
+        for frame_diff in self.dpf_array[frame_idx: frame_idx + self.future_look_frames]:
             brightness_diff = frame_diff[key_idx]  # Adjust index for note range
             if brightness_diff > self.note_on_threshold:
                 self.add_note_on(note)
@@ -61,14 +128,17 @@ class DpfToMidiConverter:
                 return
 
     def convert_to_midi(self):
-        note_times = sorted(self.get_note_times())
-
-        dominant_note_length = statistics.multimode(note_times)[0]
-        spf = 1 / self.source_video_fps
-        seconds_per_beat = dominant_note_length * spf
-        bpm = 60 / seconds_per_beat
+        frames, notes, is_note_on, note_lengths = find_note_events(
+            self.dpf_array, self.note_on_threshold, self.note_off_threshold)
 
-        tempo = mido.bpm2tempo(bpm)
+        if len(note_lengths):
+            dominant_note_length = get_dominant_note_length(note_lengths)
+            spf = 1 / self.source_video_fps
+            seconds_per_beat = dominant_note_length * spf
+            bpm = 60 / seconds_per_beat
+            tempo = mido.bpm2tempo(bpm)
+        else:
+            tempo = DEFAULT_TEMPO
         self.track.append(mido.MetaMessage('set_tempo', tempo=tempo))
 
         fps = self.source_video_fps
@@ -77,26 +147,191 @@ class DpfToMidiConverter:
         # deprecated, it dont even activate
         self.future_look_frames = round(fps / 15)
 
-        for frame_idx, frame_diff in enumerate(self.difference_per_frame):
-            self.time_bucket += time_per_frame
-            for key_idx, brightness_diff in enumerate(frame_diff):
-                note = 24 + key_idx  # Low C (24) as the base note
+        append_note_events(self.track, frames, notes, is_note_on, time_per_frame,
+                           self.note_on_velocity, self.note_off_velocity)
+        return self.midi
 
-                if brightness_diff > self.note_on_threshold:
-                    self.add_note_on(note)
-                elif brightness_diff < self.note_off_threshold:
-                    self.add_note_off(note)
-                    # self.add_future_note_on(frame_idx, key_idx, note)
 
-        # Ensure the first event has zero time
-        for msg in self.track:
-            msg.time = 0
-            if msg.type == 'note_on':
-                break
+class StreamingDpfToMidiConverter:
+    """
+    Converts the dpf one frame at a time as it is produced, memory is O(keys + notes) instead of
+    O(frames x keys).
 
-        return self.midi
+    Thresholds are fitted on a histogram of the first warmup_frames frames, which are buffered until
+    then, and refitted on the histogram of every frame seen every refit_interval frames, see estimator.
+    With both covering the whole video the midi is identical to DpfToMidiConverter's.
+    """
+    def __init__(self, source_video_fps: float, warmup_frames: Optional[int] = None,
+                 refit_interval: Optional[int] = None, thresholds: Optional[tuple[float, float]] = None):
+        """
+        :param warmup_frames: frames buffered before the first fit, defaults to WARMUP_SECONDS of video
+        :param refit_interval: frames between refits, defaults to REFIT_SECONDS of video, 0 to never refit
+        :param thresholds: fixed (note_off, note_on), frames are then decided as they arrive and never refitted
+        """
+        self.source_video_fps = source_video_fps
+        self.warmup_frames: int = warmup_frames if warmup_frames is not None \
+            else round(source_video_fps * WARMUP_SECONDS)
+        self.refit_interval: int = refit_interval if refit_interval is not None \
+            else round(source_video_fps * REFIT_SECONDS)
+        self.note_on_threshold: Optional[float] = None
+        self.note_off_threshold: Optional[float] = None
+        if thresholds is not None:
+            self.note_off_threshold, self.note_on_threshold = thresholds
+            self.refit_interval = 0
+        self.frame_count: int = 0
+        # fitted on the converter's schedule, every fit is used as is like DpfToMidiConverter does
+        self.estimator: OnlineThresholdEstimator = OnlineThresholdEstimator(
+            self.warmup_frames, self.refit_interval, reject_noisy_fits=False)
+        self._warmup_buffer: list[np.ndarray] = []
+        self._note_starts: dict[int, int] = {}      # key index: frame of its last note on
+        self._note_lengths: Counter = Counter()     # note length in frames: occurrences
+        self._is_on: dict[int, bool] = {}
+        self._events: list[tuple[int, bool, int]] = []  # (frame index, is note on, note)
 
+    def fit_thresholds(self):
+        """Refit the thresholds on every value pushed so far"""
+        thresholds = self.estimator.fit()
+        if thresholds is None:
+            raise ValueError("Too few distinct dpf values to fit note thresholds")
+        self.note_off_threshold, self.note_on_threshold = thresholds
+
+    def push(self, frame_diff: np.ndarray):
+        """Feed the next row of the dpf"""
+        frame_diff = np.asarray(frame_diff)
+        self.estimator.add(frame_diff)
+        if self.note_on_threshold is None:
+            self._warmup_buffer.append(frame_diff)
+            if len(self._warmup_buffer) >= self.warmup_frames:
+                self._end_warmup()
+            return
+        self._process_frame(frame_diff)
+        if self.refit_interval and self.frame_count % self.refit_interval == 0:
+            self.fit_thresholds()
 
-def dpf_data_to_midi(source_video_fps: float, difference_per_frame: list[list[int]]):
-    converter = DpfToMidiConverter(source_video_fps, difference_per_frame)
+    def _end_warmup(self):
+        self.fit_thresholds()
+        buffer, self._warmup_buffer = self._warmup_buffer, []
+        for frame_diff in buffer:
+            self._process_frame(frame_diff)
+
+    def _process_frame(self, frame_diff: np.ndarray):
+        """Same decisions as DpfToMidiConverter.get_note_times and convert_to_midi"""
+        frame_idx = self.frame_count
+        self.frame_count += 1
+        is_note_on = frame_diff > self.note_on_threshold
+        is_note_off = frame_diff < self.note_off_threshold
+        for key_idx in np.flatnonzero(is_note_on | is_note_off).tolist():
+            note = BASE_NOTE + key_idx
+            if is_note_on[key_idx]:
+                self._note_starts[key_idx] = frame_idx
+                if self._is_on.get(note, False):
+                    self._events.append((frame_idx, False, note))
+                self._events.append((frame_idx, True, note))
+                self._is_on[note] = True
+            else:
+                if key_idx in self._note_starts:
+                    self._note_lengths[frame_idx - self._note_starts.pop(key_idx)] += 1
+                if self._is_on.get(note, False):
+                    self._events.append((frame_idx, False, note))
+                    self._is_on[note] = False
+
+    def finish(self, note_on_velocity=64, note_off_velocity=0) -> mido.MidiFile:
+        """Decides the buffered frames if the video was shorter than the warm-up and writes the midi"""
+        if self.note_on_threshold is None:
+            self._end_warmup()
+        print(f"  Note On Boundary: {format_threshold(self.note_on_threshold)}")
+        print(f"  Note Off Boundary: {format_threshold(self.note_off_threshold)}")
+
+        # the most common note length is a beat, the smallest one on ties like statistics.multimode
+        tempo = DEFAULT_TEMPO
+        if self._note_lengths:
+            max_count = max(self._note_lengths.values())
+            dominant_note_length = min(length for length, count in self._note_lengths.items() if count == max_count)
+            tempo = mido.bpm2tempo(60 / (dominant_note_length / self.source_video_fps))
+
+        midi = mido.MidiFile()
+        track = mido.MidiTrack()
+        midi.tracks.append(track)
+        track.append(mido.MetaMessage('set_tempo', tempo=tempo))
+        time_per_frame = mido.second2tick(1 / self.source_video_fps, ticks_per_beat=midi.ticks_per_beat,
+                                          tempo=tempo)
+        frames, is_note_on, notes = zip(*self._events) if self._events else ((), (), ())
+        append_note_events(track, np.array(frames, dtype=int), np.array(notes, dtype=int),
+                           np.array(is_note_on, dtype=bool), time_per_frame, note_on_velocity, note_off_velocity)
+        return midi
+
+
+class RawDifferenceStream:
+    """
+    Stands in for the FrameBuffer process_video_func appends to, pushes the difference between
+    consecutive rows (the dpf) to a StreamingDpfToMidiConverter as they are appended.
+    """
+    def __init__(self, converter: StreamingDpfToMidiConverter, first_row: np.ndarray,
+                 rows: Optional[FrameBuffer] = None):
+        """
+        :param first_row: row the first appended one is diffed against
+        :param rows: also append every row here, otherwise only the latest row is kept
+        """
+        self.converter: StreamingDpfToMidiConverter = converter
+        self._last_row: np.ndarray = first_row
+        self._rows: Optional[FrameBuffer] = rows
+
+    def append(self, row: np.ndarray):
+        self.converter.push(row - self._last_row)
+        self._last_row = row
+        if self._rows is not None:
+            self._rows.append(row)
+
+    @property
+    def latest(self) -> np.ndarray:
+        """Last row appended, the first row before that, like FrameBuffer.latest"""
+        return self._last_row
+
+    def __getitem__(self, idx):
+        if idx != -1:
+            raise IndexError("only the latest row is kept")
+        return self._last_row
+
+    def __len__(self):
+        return 1
+
+
+def dpf_data_to_midi(source_video_fps: float, difference_per_frame: Union[DpfData, np.ndarray, list[list[int]]],
+                     thresholds: Optional[tuple[float, float]] = None):
+    converter = DpfToMidiConverter(source_video_fps, difference_per_frame, thresholds)
     return converter.convert_to_midi()
+
+
+def benchmark(n_frames=20000, n_keys=88, fps=30.0):
+    """Compares DpfToMidiConverter against the frame by frame StreamingDpfToMidiConverter on a random song"""
+    import io
+    import time
+    from srcs.algo.utils import make_synthetic_dpf
+
+    difference_per_frame = make_synthetic_dpf(n_frames, n_keys).tolist()
+
+    converter = DpfToMidiConverter(fps, difference_per_frame)
+    start = time.perf_counter()
+    midi = converter.convert_to_midi()
+    vectorized_time = time.perf_counter() - start
+
+    streaming = StreamingDpfToMidiConverter(fps, warmup_frames=n_frames, refit_interval=0)
+    start = time.perf_counter()
+    for frame_diff in converter.dpf_array:
+        streaming.push(frame_diff)
+    reference = streaming.finish()
+    frame_by_frame_time = time.perf_counter() - start
+
+    midi_bytes, reference_bytes = io.BytesIO(), io.BytesIO()
+    midi.save(file=midi_bytes)
+    reference.save(file=reference_bytes)
+    if midi_bytes.getvalue() != reference_bytes.getvalue():
+        raise RuntimeError("Vectorized midi differs from frame by frame midi")
+
+    print(f"{n_frames} frames, {len(midi.tracks[0])} messages")
+    print(f"Frame by frame: {frame_by_frame_time:>7.3f}s")
+    print(f"Vectorized:     {vectorized_time:>7.3f}s ({frame_by_frame_time / vectorized_time:.1f}x)")
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,102 @@
+import time
+import tracemalloc
+from typing import Optional
+
+import numpy as np
+
+from algo.dpf_file import DPF_DTYPE
+
+MIN_CAPACITY = 1024     # rows allocated when the frame count is unknown, doubled whenever it runs out
+
+
+class FrameBuffer:
+    """
+    Frames x keys array process_video_func appends one row of key differences per frame to, preallocated
+    from the frame count and doubled when a video turns out longer, instead of a list of small arrays.
+
+    Values are stored as DPF_DTYPE, a key differs by at most 3 x 255 from its original color.
+    """
+    def __init__(self, n_columns: int, capacity: int = 0, first_row: Optional[np.ndarray] = None):
+        """
+        :param capacity: rows to allocate, e.g. the frames left in the video
+        :param first_row: row the first frame is diffed against, usually zeros
+        """
+        self._array: np.ndarray = np.empty((max(capacity, MIN_CAPACITY), n_columns), dtype=DPF_DTYPE)
+        self._length: int = 0
+        if first_row is not None:
+            self.append(first_row)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, idx):
+        return self.array[idx]
+
+    @property
+    def array(self) -> np.ndarray:
+        """View of the rows appended so far"""
+        return self._array[:self._length]
+
+    @property
+    def latest(self) -> Optional[np.ndarray]:
+        """Last row appended, read by the ui thread while frames are processed"""
+        length = self._length
+        return self._array[length - 1] if length else None
+
+    def _reserve(self, rows: int):
+        if self._length + rows <= len(self._array):
+            return
+        grown = np.empty((max(2 * len(self._array), self._length + rows), self._array.shape[1]), dtype=DPF_DTYPE)
+        grown[:self._length] = self._array[:self._length]
+        self._array = grown
+
+    def append(self, row: np.ndarray):
+        self._reserve(1)
+        self._array[self._length] = row
+        # the row is written before it becomes visible to latest
+        self._length += 1
+
+    def extend(self, rows: np.ndarray):
+        rows = np.asarray(rows).reshape(-1, self._array.shape[1])
+        self._reserve(len(rows))
+        self._array[self._length:self._length + len(rows)] = rows
+        self._length += len(rows)
+
+    def diff(self) -> np.ndarray:
+        """Difference between consecutive rows, the dpf, in one subtraction over the views"""
+        array = self.array
+        return np.subtract(array[1:], array[:-1], dtype=DPF_DTYPE)
+
+
+def benchmark(n_frames=30000, n_keys=88):
+    """Compares appending to a list of rows and converting at the end against FrameBuffer"""
+    rng = np.random.default_rng(0)
+    rows = [rng.integers(0, 766, n_keys) for _ in range(n_frames)]
+
+    def list_of_rows():
+        difference_per_frame = [np.full(n_keys, 0)]
+        for row in rows:
+            difference_per_frame.append(row.copy())
+        return np.diff(np.array(difference_per_frame), axis=0).astype(int).tolist()
+
+    def frame_buffer():
+        buffer = FrameBuffer(n_keys, n_frames + 1, np.full(n_keys, 0))
+        for row in rows:
+            buffer.append(row.copy())
+        return buffer.diff()
+
+    results = {}
+    for name, func in (("list of rows", list_of_rows), ("FrameBuffer", frame_buffer)):
+        tracemalloc.start()
+        start = time.perf_counter()
+        results[name] = func()
+        duration = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name:<14} {duration * 1000:>8.1f}ms, peak {peak / 1024 ** 2:>6.1f}MB")
+    if not np.array_equal(results["list of rows"], results["FrameBuffer"]):
+        raise RuntimeError("FrameBuffer dpf differs from the list of rows dpf")
+
+
+if __name__ == '__main__':
+    benchmark()
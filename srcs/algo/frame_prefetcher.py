@@ -0,0 +1,119 @@
+import queue
+import time
+from threading import Thread, Event
+from typing import Optional
+
+import cv2
+import numpy as np
+
+
+class PrefetchStats:
+    """Counters of a FramePrefetcher, read them from any thread"""
+    def __init__(self, buffer_size: int):
+        self.buffer_size: int = buffer_size
+        self.frames_decoded: int = 0
+        self.frames_read: int = 0
+        self.consumer_stalls: int = 0       # read() found no decoded frame waiting
+        self.consumer_stall_time: float = 0.0
+        self.producer_stalls: int = 0       # decoder found every buffer in use
+        self.producer_stall_time: float = 0.0
+        self.max_queue_depth: int = 0
+        self._queue_depth_sum: int = 0
+
+    def __repr__(self):
+        return (f"PrefetchStats(frames_read={self.frames_read}, avg_queue_depth={self.avg_queue_depth:.2f}/"
+                f"{self.buffer_size}, consumer_stalls={self.consumer_stalls} ({self.consumer_stall_time:.2f}s), "
+                f"producer_stalls={self.producer_stalls} ({self.producer_stall_time:.2f}s))")
+
+    @property
+    def avg_queue_depth(self) -> float:
+        """Average number of decoded frames waiting when a frame is read"""
+        if self.frames_read == 0:
+            return 0.0
+        return self._queue_depth_sum / self.frames_read
+
+    def record_read(self, queue_depth: int):
+        self.frames_read += 1
+        self._queue_depth_sum += queue_depth
+        self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+
+
+class FramePrefetcher:
+    """
+    Decodes frames of a cv2.VideoCapture on a producer thread into a fixed ring of preallocated buffers.
+
+    cv2 releases the GIL while decoding, so decoding overlaps with whatever the reading thread does
+    with the frames. A buffer is handed back to the decoder two reads after it was returned by read(),
+    so the current frame and the one before it stay valid for threads still drawing them.
+    """
+    HELD_FRAMES = 2
+
+    def __init__(self, cap: cv2.VideoCapture, buffer_size: int = 8):
+        if buffer_size <= self.HELD_FRAMES:
+            raise ValueError(f"buffer_size must be greater than {self.HELD_FRAMES}")
+        self.cap: cv2.VideoCapture = cap
+        self.stats: PrefetchStats = PrefetchStats(buffer_size)
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self._buffers: list[np.ndarray] = [np.empty((height, width, 3), dtype=np.uint8) for _ in range(buffer_size)]
+        self._free_slots: queue.Queue = queue.Queue()
+        self._decoded: queue.Queue = queue.Queue()  # slot indexes, None once the video ends
+        self._held_slots: list[int] = []
+        self._stop_event: Event = Event()
+        self._eof: bool = False
+        for slot in range(buffer_size):
+            self._free_slots.put(slot)
+        self._thread: Thread = Thread(target=self._decode_loop, daemon=True)
+        self._thread.start()
+
+    def _decode_loop(self):
+        while not self._stop_event.is_set():
+            try:
+                slot = self._free_slots.get_nowait()
+            except queue.Empty:
+                self.stats.producer_stalls += 1
+                start = time.perf_counter()
+                slot = self._free_slots.get()
+                self.stats.producer_stall_time += time.perf_counter() - start
+            if slot is None:  # woken up by stop()
+                break
+            buffer = self._buffers[slot]
+            success, frame = self.cap.read(buffer)
+            if not success:
+                self._decoded.put(None)
+                return
+            if frame is not buffer:  # decoder could not write in place, keep its frame for next time
+                self._buffers[slot] = frame
+            self.stats.frames_decoded += 1
+            self._decoded.put(slot)
+
+    def read(self) -> Optional[np.ndarray]:
+        """
+        Next decoded frame, blocks until one is available.
+
+        :return: the frame, valid until two more calls to read(), None at the end of the video
+        """
+        if self._eof:
+            return None
+        queue_depth = self._decoded.qsize()
+        if queue_depth == 0:
+            self.stats.consumer_stalls += 1
+            start = time.perf_counter()
+            slot = self._decoded.get()
+            self.stats.consumer_stall_time += time.perf_counter() - start
+        else:
+            slot = self._decoded.get()
+        if slot is None:
+            self._eof = True
+            return None
+        self.stats.record_read(queue_depth)
+        self._held_slots.append(slot)
+        if len(self._held_slots) > self.HELD_FRAMES:
+            self._free_slots.put(self._held_slots.pop(0))
+        return self._buffers[slot]
+
+    def stop(self):
+        """Stops the decoder thread, the capture can be used directly again afterwards"""
+        self._stop_event.set()
+        self._free_slots.put(None)
+        self._thread.join()
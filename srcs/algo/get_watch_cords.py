@@ -1,5 +1,14 @@
+import time
+
+import numpy as np
+
+from p2m import p2m_constants
 from p2m.p2m_types import *
 
+SAMPLE_START, SAMPLE_END = 0.2, 0.8     # watch cords span this part of the width and height of a key
+BLACK_KEY_MARGIN = 11                   # white key cords this close to a black key are dropped
+DEFAULT_GRID = 3                        # the 3x3 pattern every cached dpf was sampled with
+
 
 def rect_contains(rect: RectType, cord: CordType, x_margin=11, y_margin=11) -> bool:
     x, y, width, height = rect
@@ -7,29 +16,83 @@ def rect_contains(rect: RectType, cord: CordType, x_margin=11, y_margin=11) -> b
     return x - x_margin <= cord_x <= x + width + x_margin and y - y_margin <= cord_y <= y + height + y_margin
 
 
+def get_sample_fractions(grid: int) -> np.ndarray:
+    """grid evenly spaced fractions from SAMPLE_START to SAMPLE_END, the centre for a grid of 1"""
+    if grid == 1:
+        return np.array([0.5])
+    return SAMPLE_START + (SAMPLE_END - SAMPLE_START) * np.arange(grid) / (grid - 1)
+
+
+def get_watch_cord_arrays(white_keys: list[RectType], black_keys: list[RectType],
+                          grid: int = p2m_constants.WATCH_CORD_GRID
+                          ) -> tuple[list[RectType], np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Watch cords of every key as flat arrays, keys sorted by x and their cords contiguous in xs and ys,
+    the layout KeySampler indexes frames with.
+
+    :param grid: cords per key side, a grid x grid pattern minus the white key cords near a black key
+    :return: (keys, xs, ys, counts), counts[i] cords of keys[i]
+    """
+    all_keys = sorted(white_keys + black_keys, key=lambda k: k[0])
+    rects = np.array(all_keys, dtype=np.float64).reshape(-1, 4)
+    fractions = get_sample_fractions(grid)
+    # x major, the order the 3x3 pattern was listed in
+    xs = (rects[:, 0, None] + np.repeat(fractions, grid) * rects[:, 2, None]).astype(np.intp)
+    ys = (rects[:, 1, None] + np.tile(fractions, grid) * rects[:, 3, None]).astype(np.intp)
+
+    keep = np.ones(xs.shape, dtype=bool)
+    white_keys_set = set(white_keys)
+    is_white = np.array([key in white_keys_set for key in all_keys], dtype=bool)
+    if black_keys and is_white.any():
+        bx, by, bw, bh = (column[None, None] for column in np.array(black_keys, dtype=np.intp).T)
+        wx, wy = xs[is_white, :, None], ys[is_white, :, None]
+        near_black = ((bx - BLACK_KEY_MARGIN <= wx) & (wx <= bx + bw + BLACK_KEY_MARGIN) &
+                      (by - BLACK_KEY_MARGIN <= wy) & (wy <= by + bh + BLACK_KEY_MARGIN)).any(axis=2)
+        keep[is_white] = ~near_black
+    return all_keys, xs[keep], ys[keep], keep.sum(axis=1)
+
+
 # obejctive 1: no overlap
 # objective 2: large area
-def get_watch_cords_dict(white_keys: list[RectType], black_keys: list[RectType]) -> dict[RectType, list[CordType]]:
-    all_keys = sorted(white_keys + black_keys, key=lambda k: k[0])
-    ret = {}
-    for key in all_keys:
-        x, y, w, h = key
-        points = [
-            (x + 0.2 * w, y + 0.2 * h),
-            (x + 0.2 * w, y + 0.5 * h),
-            (x + 0.2 * w, y + 0.8 * h),
-            (x + 0.5 * w, y + 0.2 * h),
-            (x + 0.5 * w, y + 0.5 * h),
-            (x + 0.5 * w, y + 0.8 * h),
-            (x + 0.8 * w, y + 0.2 * h),
-            (x + 0.8 * w, y + 0.5 * h),
-            (x + 0.8 * w, y + 0.8 * h),
-        ]
-        points = [(int(p[0]), int(p[1])) for p in points]
-        curr_points = []
-        for point in points:
-            if key in white_keys and any(rect_contains(rect, point) for rect in black_keys):
-                continue
-            curr_points.append(point)
-        ret[key] = curr_points
-    return ret
+def get_watch_cords_dict(white_keys: list[RectType], black_keys: list[RectType],
+                         grid: int = p2m_constants.WATCH_CORD_GRID) -> dict[RectType, list[CordType]]:
+    """Watch cords of every key sorted by x, see get_watch_cord_arrays"""
+    all_keys, xs, ys, counts = get_watch_cord_arrays(white_keys, black_keys, grid)
+    cords = list(zip(xs.tolist(), ys.tolist()))
+    ends = np.cumsum(counts).tolist()
+    return {key: cords[end - count:end] for key, end, count in zip(all_keys, ends, counts.tolist())}
+
+
+def benchmark(grids=(3, 5, 9), repeat=20):
+    """Compares the array builder against the per point loop it replaced on a synthetic 88 key keyboard"""
+    from algo import utils
+
+    def per_point(white_keys, black_keys, grid):
+        fractions = get_sample_fractions(grid).tolist()
+        ret = {}
+        for key in sorted(white_keys + black_keys, key=lambda k: k[0]):
+            x, y, w, h = key
+            points = [(int(x + fx * w), int(y + fy * h)) for fx in fractions for fy in fractions]
+            ret[key] = [point for point in points
+                        if not (key in white_keys and any(rect_contains(rect, point) for rect in black_keys))]
+        return ret
+
+    def timed(func, *args):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            ret = func(*args)
+        return ret, (time.perf_counter() - start) / repeat
+
+    _, white_keys, black_keys = utils.draw_synthetic_keyboard()
+    print(f"{len(white_keys)} white and {len(black_keys)} black keys")
+    for grid in grids:
+        expected, loop_time = timed(per_point, white_keys, black_keys, grid)
+        watch_cords, array_time = timed(get_watch_cords_dict, white_keys, black_keys, grid)
+        if watch_cords != expected:
+            raise RuntimeError(f"array watch cords differ from the per point loop on a {grid}x{grid} grid")
+        n_cords = sum(len(cords) for cords in watch_cords.values())
+        print(f"{grid}x{grid}: {n_cords} cords, per point {loop_time * 1000:.2f}ms, arrays {array_time * 1000:.2f}ms")
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,152 @@
+import json
+import os
+import time
+from typing import Optional
+
+import cv2
+import numpy as np
+
+from algo.locate_black_and_white import locate_keys_like
+from algo.get_watch_cords import DEFAULT_GRID
+from algo.process_rects import get_bounding_rect
+from p2m import p2m_path
+from p2m.p2m_types import *
+
+LAYOUT_VERSION = 1          # bump whenever key detection finds different keys for the same frame
+MAX_LAYOUTS = 32            # layouts kept per resolution, the least recently used ones are dropped
+MAX_HASH_DISTANCE = 16      # differing bits of the 64 bit perceptual hashes of one keyboard, pressed keys included
+HASH_SIZE = 8               # the hash is the sign of the HASH_SIZE x HASH_SIZE lowest frequencies
+HASH_IMAGE_SIZE = 32        # the keyboard region is shrunk to this before the dct
+VERIFY_MARGIN = 20          # pixels around the keyboard searched for its keys
+VERIFY_TOLERANCE = 2        # pixels a key may move and still be the cached one
+MIN_KEY_SHARE = 0.5         # share of the cached keys found again, about 0.75 for the same keyboard, 0 a few pixels off
+
+
+def perceptual_hash(image: ImageType, rect: RectType) -> int:
+    """64 bit dct hash of the rect of image, nearby for the same keyboard with a few keys pressed"""
+    x, y, w, h = rect
+    region = image[y:y + h, x:x + w]
+    if region.ndim == 3:
+        region = cv2.cvtColor(region, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(region, (HASH_IMAGE_SIZE, HASH_IMAGE_SIZE), interpolation=cv2.INTER_AREA)
+    frequencies = cv2.dct(small.astype(np.float32))[:HASH_SIZE, :HASH_SIZE].flatten()
+    bits = frequencies[1:] > np.median(frequencies[1:])  # the dc term is the brightness, left out
+    return int(np.packbits(np.concatenate(([False], bits))).view(">u8")[0])
+
+
+def hash_distance(hash1: int, hash2: int) -> int:
+    return (hash1 ^ hash2).bit_count()
+
+
+def get_key_share(image: ImageType, keys: list[RectType]) -> float:
+    """Share of keys key detection finds again around their bounding rect in image"""
+    x0, y0, width, height = get_bounding_rect(keys, VERIFY_MARGIN, (image.shape[1], image.shape[0]))
+    found = np.array([(x + x0, y + y0, w, h) for x, y, w, h in locate_keys_like(image[y0:y0 + height, x0:x0 + width])],
+                     dtype=int).reshape(-1, 4)
+    if not len(found) or not keys:
+        return 0.0
+    distances = np.abs(np.array(keys, dtype=int)[:, None] - found[None]).max(axis=2)
+    return float((distances <= VERIFY_TOLERANCE).any(axis=1).mean())
+
+
+class KeyLayout:
+    """Validated keys of a video and the watch cords sampled from them, see get_watch_cords_dict"""
+    def __init__(self, white_keys: list[RectType], black_keys: list[RectType],
+                 watch_cords: dict[RectType, list[CordType]], frame_hash: int, last_used: float = 0.0,
+                 grid: int = DEFAULT_GRID):
+        """
+        :param frame_hash: perceptual_hash of the keyboard region of the frame the keys were found in
+        :param grid: watch cords per key side of watch_cords
+        """
+        self.white_keys: list[RectType] = white_keys
+        self.black_keys: list[RectType] = black_keys
+        self.watch_cords: dict[RectType, list[CordType]] = watch_cords
+        self.frame_hash: int = frame_hash
+        self.last_used: float = last_used
+        self.grid: int = grid
+
+    def __repr__(self):
+        return f"KeyLayout({len(self.white_keys)} white, {len(self.black_keys)} black, hash={self.frame_hash:016x})"
+
+    @property
+    def keyboard_rect(self) -> RectType:
+        return get_bounding_rect(self.white_keys + self.black_keys)
+
+    def matches(self, image: ImageType) -> bool:
+        """
+        True if image shows this keyboard at the same pixels. The hash rejects other scenes cheaply but barely
+        tells a keyboard from the same one a few pixels off, so the keys are then detected again in the keyboard
+        region only. Costs one detection on a crop whatever the video length.
+        """
+        if hash_distance(perceptual_hash(image, self.keyboard_rect), self.frame_hash) > MAX_HASH_DISTANCE:
+            return False
+        return get_key_share(image, self.white_keys + self.black_keys) >= MIN_KEY_SHARE
+
+    def to_dict(self) -> dict:
+        return {
+            "white_keys": [list(key) for key in self.white_keys],
+            "black_keys": [list(key) for key in self.black_keys],
+            # in key order, get_watch_cords_dict sorts them by x
+            "watch_cords": [[list(key), [list(cord) for cord in cords]] for key, cords in self.watch_cords.items()],
+            "hash": f"{self.frame_hash:016x}",
+            "last_used": self.last_used,
+            "grid": self.grid,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "KeyLayout":
+        return cls([tuple(key) for key in data["white_keys"]], [tuple(key) for key in data["black_keys"]],
+                   {tuple(key): [tuple(cord) for cord in cords] for key, cords in data["watch_cords"]},
+                   int(data["hash"], 16), data.get("last_used", 0.0), data.get("grid", DEFAULT_GRID))
+
+
+class KeyLayoutCache:
+    """
+    Key layouts found before, grouped by frame resolution. Videos of one channel or template usually
+    draw their keyboard at the same pixels, a frame showing a cached layout skips key detection.
+    """
+    def __init__(self, directory: str = p2m_path.KEY_LAYOUT_DIR, max_layouts: int = MAX_LAYOUTS):
+        self.directory: str = directory
+        self.max_layouts: int = max_layouts
+
+    def get_path(self, image: ImageType) -> str:
+        height, width = image.shape[:2]
+        return os.path.join(self.directory, f"layouts-{LAYOUT_VERSION}-{width}x{height}.json")
+
+    def _load_layouts(self, path: str) -> list[KeyLayout]:
+        try:
+            with open(path, "r") as f:
+                return [KeyLayout.from_dict(data) for data in json.load(f)]
+        except (FileNotFoundError, KeyError, TypeError, ValueError):
+            return []
+
+    def _store_layouts(self, path: str, layouts: list[KeyLayout]):
+        os.makedirs(self.directory, exist_ok=True)
+        layouts = sorted(layouts, key=lambda layout: layout.last_used, reverse=True)[:self.max_layouts]
+        # several worker processes may store layouts of the same resolution
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump([layout.to_dict() for layout in layouts], f)
+        os.replace(tmp_path, path)
+
+    def find(self, image: ImageType) -> Optional[KeyLayout]:
+        """The most recently used cached layout image shows, at most max_layouts are checked"""
+        path = self.get_path(image)
+        layouts = self._load_layouts(path)
+        for layout in sorted(layouts, key=lambda layout: layout.last_used, reverse=True):
+            if layout.matches(image):
+                layout.last_used = time.time()
+                self._store_layouts(path, layouts)
+                return layout
+        return None
+
+    def store(self, image: ImageType, white_keys: list[RectType], black_keys: list[RectType],
+              watch_cords: dict[RectType, list[CordType]], grid: int = DEFAULT_GRID) -> KeyLayout:
+        """Caches keys found in image, replacing a cached layout with the same keys"""
+        layout = KeyLayout(list(white_keys), list(black_keys), dict(watch_cords), 0, time.time(), grid)
+        layout.frame_hash = perceptual_hash(image, layout.keyboard_rect)
+        path = self.get_path(image)
+        layouts = [cached for cached in self._load_layouts(path)
+                   if (cached.white_keys, cached.black_keys) != (layout.white_keys, layout.black_keys)]
+        self._store_layouts(path, layouts + [layout])
+        return layout
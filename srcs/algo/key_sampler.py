@@ -0,0 +1,44 @@
+import numpy as np
+from algo.cord_transform import CordTransform
+from p2m.p2m_types import *
+
+
+class KeySampler:
+    """
+    Precomputed sampling index for the watch cords of every key.
+
+    All watch cords are flattened into one y and one x index array, keys are
+    contiguous segments of those arrays, so the average color of every key is
+    one fancy-index and one np.add.reduceat per frame.
+    """
+    def __init__(self, watch_cords: dict[RectType, list[CordType]], transform: Optional[CordTransform] = None):
+        """
+        :param watch_cords: output of get_watch_cords_dict, in resized frame coordinates
+        :param transform: maps watch cords to the sampled image, see VideoClass.transform
+        """
+        watch_cords_values = list(watch_cords.values())
+        flat_cords = [cord for cords in watch_cords_values for cord in cords]
+        if transform is None:
+            transform = CordTransform()
+
+        self.xs, self.ys = transform.to_source(np.array([x for x, _ in flat_cords], dtype=np.intp),
+                                               np.array([y for _, y in flat_cords], dtype=np.intp))
+        self.counts: np.ndarray = np.array([len(cords) for cords in watch_cords_values], dtype=np.int32)
+        self.starts: np.ndarray = np.concatenate(([0], np.cumsum(self.counts)[:-1])).astype(np.intp)
+        # reduceat misbehaves on empty segments, those keys are left as zero
+        self._non_empty: np.ndarray = self.counts > 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def sample(self, image: ImageType) -> np.ndarray:
+        """
+        :return: average color of every key [[b, g, r], [b, g, r], ..., [b, g, r]]
+        """
+        pixel_values = image[self.ys, self.xs]  # [[b, g, r], [b, g, r], ..., [b, g, r]] for all keys
+        average_colors = np.zeros((len(self.counts), 3), dtype=np.int32)
+        if not pixel_values.size:
+            return average_colors
+        sum_colors = np.add.reduceat(pixel_values, self.starts[self._non_empty], axis=0, dtype=np.int32)
+        average_colors[self._non_empty] = sum_colors // self.counts[self._non_empty, None]
+        return average_colors
@@ -0,0 +1,186 @@
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Optional
+
+from algo import utils
+from algo.locate_black_and_white import locate_keys_like, classify_keys
+from algo.video_class import VideoClass
+from p2m import p2m_constants
+from p2m.p2m_types import *
+
+STRIDE_SECONDS = 2.0                            # video time between the frames of the coarse pass
+SEARCH_WORKERS = min(4, os.cpu_count() or 1)    # frames detected concurrently, cv2 releases the GIL
+
+
+class KeySearchStats:
+    """Counters of a find_keys_in_video call"""
+    def __init__(self, stride: int):
+        self.stride: int = stride
+        self.frames_examined: int = 0
+        self.found_frame: Optional[int] = None     # index of the frame the keys were found in
+        self.time: float = 0.0
+
+    def __repr__(self):
+        return (f"KeySearchStats(frames_examined={self.frames_examined}, stride={self.stride}, "
+                f"found_frame={self.found_frame}, time={self.time:.2f}s)")
+
+
+def detect_keys(image: ImageType, band_limited: bool = False) -> tuple[list[RectType], Optional[KeysPairType]]:
+    """:return: (key like rectangles, (white_keys, black_keys) or None), see locate_keys_like"""
+    keys_like = locate_keys_like(image, band_limited)
+    return keys_like, classify_keys(keys_like)
+
+
+def find_keys_in_video(video: VideoClass, stride: Optional[int] = None, workers: int = SEARCH_WORKERS,
+                       is_running_func: Callable[[], bool] = lambda: True,
+                       on_examined: Callable[[list[RectType]], None] = lambda keys_like: None,
+                       band_limited: bool = p2m_constants.BAND_LIMITED_KEY_DETECTION,
+                       from_current: bool = False) -> tuple[Optional[KeysPairType], KeySearchStats]:
+    """
+    Finds the first frame from the current position on whose keys can be classified, without running
+    the detector on every frame of a long intro.
+
+    A coarse pass examines every stride-th frame, then the gap between the last miss and the first hit
+    is narrowed down by examining up to workers evenly spaced frames of it at once. This assumes the
+    keyboard stays visible once it appears, a keyboard that flickers in and out may be found up to
+    stride frames late.
+
+    :param stride: frames between the frames of the coarse pass, defaults to STRIDE_SECONDS of video,
+        1 examines every frame in order like before. Videos of unknown length are always read in order,
+        streams in order by one worker, see VideoClass.seekable
+    :param on_examined: called on the calling thread with the key like rectangles of the frame last examined,
+        video.current_frame is that frame
+    :param band_limited: only search the keyboard like rows of every frame, see locate_keys_like
+    :param from_current: examine video.current_frame first, e.g. a frame already read to look up a cached layout,
+        otherwise the search starts at the next frame
+    :return: ((white_keys, black_keys) or None, stats), on a hit video.current_frame is the frame they
+        were found in and read_next continues after it
+    """
+    if stride is None:
+        stride = max(1, round(video.fps * STRIDE_SECONDS)) if video.fps > 0 else 1
+    if video.total_frames <= 0 or not video.seekable:
+        stride = 1
+    if not video.seekable:  # frames read ahead of a hit could not be read again
+        workers = 1
+    first = None
+    if from_current and video.current_frame is not None:
+        if video.seekable and video.total_frames > 0:
+            video.seek(video.current_frame_count - 1)
+        else:  # can't be read again, handed to the search as is
+            first = (video.current_frame_count - 1, video.current_frame)
+    stats = KeySearchStats(stride)
+    start_time = time.perf_counter()
+    detect = partial(detect_keys, band_limited=band_limited)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def examine(frame_numbers: list[int]) -> list[Optional[KeysPairType]]:
+            """Classified keys of every frame, None where none or the video ended early"""
+            frames = []
+            for frame_number in frame_numbers:
+                video.skip_to_frame(frame_number)
+                if video.eof:
+                    break
+                frames.append(video.current_frame)
+            results = list(executor.map(detect, frames))
+            stats.frames_examined += len(results)
+            if results:
+                on_examined(results[-1][0])
+            return [keys for _, keys in results] + [None] * (len(frame_numbers) - len(results))
+
+        if stride == 1:
+            found = _search_in_order(video, executor, detect, stats, workers, is_running_func, on_examined, first)
+        else:
+            found = _search_strided(video, examine, stride, workers, is_running_func)
+    if found is not None:
+        stats.found_frame, keys = found
+    stats.time = time.perf_counter() - start_time
+    return (keys if found is not None else None), stats
+
+
+def _search_in_order(video: VideoClass, executor: ThreadPoolExecutor, detect: Callable, stats: KeySearchStats,
+                     workers: int, is_running_func: Callable[[], bool],
+                     on_examined: Callable[[list[RectType]], None], first: Optional[tuple[int, ImageType]] = None
+                     ) -> Optional[tuple[int, KeysPairType]]:
+    """Every frame in order, workers frames are read ahead and detected at once, starting with first if given"""
+    while is_running_func():
+        frames = [first] if first is not None else []
+        first = None
+        while len(frames) < workers and video.read_next():
+            frames.append((video.current_frame_count - 1, video.current_frame))
+        if not frames:
+            return None
+        results = list(executor.map(detect, [frame for _, frame in frames]))
+        for (frame_number, _), (keys_like, keys) in zip(frames, results):
+            stats.frames_examined += 1
+            if keys is not None:
+                if frame_number != video.current_frame_count - 1:
+                    video.skip_to_frame(frame_number)
+                on_examined(keys_like)
+                return frame_number, keys
+        on_examined(results[-1][0])
+    return None
+
+
+def _search_strided(video: VideoClass, examine: Callable[[list[int]], list[Optional[KeysPairType]]],
+                    stride: int, workers: int, is_running_func: Callable[[], bool]
+                    ) -> Optional[tuple[int, KeysPairType]]:
+    """Coarse pass every stride frames, then narrows the gap between the last miss and the first hit"""
+    last_miss = video.current_frame_count - 1
+    candidates = list(range(video.current_frame_count, video.total_frames, stride))
+    if candidates and candidates[-1] != video.total_frames - 1:
+        candidates.append(video.total_frames - 1)
+    hit: Optional[tuple[int, KeysPairType]] = None
+    for batch_start in range(0, len(candidates), workers):
+        if hit is not None or not is_running_func():
+            break
+        batch = candidates[batch_start:batch_start + workers]
+        last_miss, hit = _first_hit(batch, examine(batch), last_miss)
+    if hit is None:
+        return None
+
+    while hit[0] - last_miss > 1 and is_running_func():
+        gap = hit[0] - last_miss - 1
+        count = min(workers, gap)
+        # count frames splitting the gap into count + 1 equal parts, a bisection for one worker
+        batch = sorted({last_miss + (i + 1) * (gap + 1) // (count + 1) for i in range(count)})
+        last_miss, narrowed = _first_hit(batch, examine(batch), last_miss)
+        hit = narrowed or hit
+    if video.current_frame_count - 1 != hit[0]:
+        video.skip_to_frame(hit[0])
+    return hit
+
+
+def _first_hit(frame_numbers: list[int], results: list[Optional[KeysPairType]], last_miss: int
+               ) -> tuple[int, Optional[tuple[int, KeysPairType]]]:
+    """:return: (last miss before the first hit, (frame number, keys) of the first hit or None)"""
+    for frame_number, keys in zip(frame_numbers, results):
+        if keys is not None:
+            return last_miss, (frame_number, keys)
+        last_miss = frame_number
+    return last_miss, None
+
+
+def benchmark(intro_seconds=120, fps=30.0):
+    """Time to the first detection on a synthetic video with a long intro, every frame against strided"""
+    with tempfile.TemporaryDirectory() as directory:
+        video_path = os.path.join(directory, "synthetic_intro.mp4")
+        intro_frames = round(intro_seconds * fps)
+        utils.make_synthetic_keyboard_video(video_path, intro_frames + 60, fps, intro_frames=intro_frames)
+        results = {}
+        for name, stride, workers in (("every frame", 1, 1), ("every frame, threaded", 1, SEARCH_WORKERS),
+                                      ("strided", None, 1), ("strided, threaded", None, SEARCH_WORKERS)):
+            video = VideoClass(video_path)
+            keys, stats = find_keys_in_video(video, stride, workers)
+            video.cap.release()
+            results[name] = (keys, stats)
+            print(f"{name:<22} {stats}")
+        first_keys, first_stats = results["every frame"]
+        for name, (keys, stats) in results.items():
+            if keys != first_keys or stats.found_frame != first_stats.found_frame:
+                raise RuntimeError(f"{name} found other keys or another frame than the frame by frame search")
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -1,10 +1,24 @@
+import glob
+import os
+import time
+
 import cv2
+import numpy as np
 
 from algo import utils
 from algo.process_rects import remove_duplicate_rectangles
 from algo.validate_keys import validate_keys
+from p2m import p2m_path
 from p2m.p2m_types import *
 
+BAND_SCALE = 0.25           # downscale of the grayscale frame searched for keyboard bands
+BAND_EDGE_THRESHOLD = 20    # horizontal gradient of the downscaled frame counted as a vertical edge
+BAND_MIN_DENSITY = 0.05     # share of a row on vertical edges for it to be keyboard like, at least
+BAND_RELATIVE_DENSITY = 0.5     # and at least this share of the densest row's
+BAND_GROW_DOWN = 1.0        # band heights added below a band, white keys reach below the dense black key rows
+BAND_GROW_UP = 0.25         # band heights added above it
+BAND_MARGIN = 20            # frame pixels added above and below every band
+
 
 def preprocess_image(img: ImageType) -> ImageType:
     # Use Canny edge detection
@@ -16,7 +30,38 @@ def preprocess_image(img: ImageType) -> ImageType:
     return img
 
 
-def detect_rects(edges: ImageType) -> list[RectType]:
+def find_key_bands(image: ImageType) -> list[tuple[int, int]]:
+    """
+    Row ranges of image dense in vertical edges, where a keyboard can be, found on a downscaled grayscale copy.
+
+    :return: [(top, bottom), ...] rows of image, sorted and not overlapping
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    small = cv2.resize(gray, None, fx=BAND_SCALE, fy=BAND_SCALE, interpolation=cv2.INTER_AREA)
+    gradient = np.abs(cv2.Sobel(small, cv2.CV_16S, 1, 0, ksize=3))
+    density = np.count_nonzero(gradient > BAND_EDGE_THRESHOLD, axis=1) / small.shape[1]
+    rows = np.flatnonzero(density >= max(BAND_MIN_DENSITY, BAND_RELATIVE_DENSITY * density.max()))
+    if not len(rows):
+        return []
+    # runs of dense rows, gaps of up to 2 downscaled rows are bridged
+    breaks = np.flatnonzero(np.diff(rows) > 3)
+    starts = np.concatenate(([rows[0]], rows[breaks + 1]))
+    ends = np.concatenate((rows[breaks], [rows[-1]])) + 1
+
+    height = image.shape[0]
+    bands: list[tuple[int, int]] = []
+    for start, end in zip((starts / BAND_SCALE).astype(int), (ends / BAND_SCALE).astype(int)):
+        top = max(0, start - int(BAND_GROW_UP * (end - start)) - BAND_MARGIN)
+        bottom = min(height, end + int(BAND_GROW_DOWN * (end - start)) + BAND_MARGIN)
+        if bands and top <= bands[-1][1]:
+            bands[-1] = (bands[-1][0], max(bottom, bands[-1][1]))
+        else:
+            bands.append((top, bottom))
+    return bands
+
+
+def find_rects(edges: ImageType) -> list[RectType]:
+    """Bounding rects of the polygon like contours, duplicates included"""
     # Find contours in the edge-detected image
     contours, _ = cv2.findContours(edges, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
 
@@ -31,7 +76,11 @@ def detect_rects(edges: ImageType) -> list[RectType]:
             x, y, w, h = cv2.boundingRect(approx)
             rects.append((x, y, w, h))
 
-    return remove_duplicate_rectangles(rects)
+    return rects
+
+
+def detect_rects(edges: ImageType) -> list[RectType]:
+    return remove_duplicate_rectangles(find_rects(edges))
 
 
 def display(y_classified, yh_classified):
@@ -68,9 +117,18 @@ def classify_keys(keys: list[RectType]) -> KeysPairType:
     return ret
 
 
-def locate_keys_like(image: ImageType) -> list[RectType]:
-    image = preprocess_image(image)
-    rects = detect_rects(image)
+def locate_keys_like(image: ImageType, band_limited: bool = False) -> list[RectType]:
+    """
+    :param band_limited: only search the rows find_key_bands picks, at full resolution since downscaling
+        closes the thin gaps between white keys
+    """
+    if not band_limited:
+        rects = detect_rects(preprocess_image(image))
+    else:
+        rects = []
+        for top, bottom in find_key_bands(image):
+            rects.extend((x, y + top, w, h) for x, y, w, h in find_rects(preprocess_image(image[top:bottom])))
+        rects = remove_duplicate_rectangles(rects)
     keys_like = [k for k in rects if k[2] * 1.5 < k[3]]
     return keys_like
 
@@ -79,3 +137,45 @@ def locate_white_and_black(image: ImageType) -> KeysPairType:
     keys = locate_keys_like(image)
     ret = classify_keys(keys)
     return ret
+
+
+def _benchmark_images() -> list[tuple[str, ImageType]]:
+    """The screenshots in assets/ sized like VideoClass frames, and synthetic keyboards with falling notes"""
+    images = [(os.path.basename(path), utils.cv2_resize_to_fit(cv2.imread(path), 1280, 720))
+              for path in sorted(glob.glob(os.path.join(p2m_path.ASSETS_DIR, "*.png")))]
+    rng = np.random.default_rng(0)
+    for width, height, notes in ((1280, 720, 0), (1280, 720, 80), (854, 480, 20), (1920, 1080, 40)):
+        frame, _, _ = utils.draw_synthetic_keyboard(width, height, pressed=set(rng.choice(88, 6).tolist()))
+        for _ in range(notes):
+            x, y = rng.integers(0, width - 30), rng.integers(0, height // 2)
+            cv2.rectangle(frame, (x, y), (x + 20, y + rng.integers(20, 200)), (200, 200, 80), -1)
+        images.append((f"synthetic {width}x{height}", frame))
+    return images
+
+
+def benchmark(repeat=10):
+    """Compares the band limited locate_keys_like against the full frame one, the classified keys must match"""
+    def timed(image, band_limited):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            keys_like = locate_keys_like(image, band_limited)
+        return keys_like, (time.perf_counter() - start) / repeat
+
+    total_full = total_banded = 0.0
+    print(f"{'image':<22}{'full':>14}{'banded':>14}{'shared':>8}  keys found")
+    for name, image in _benchmark_images():
+        full, full_time = timed(image, False)
+        banded, banded_time = timed(image, True)
+        total_full += full_time
+        total_banded += banded_time
+        classified = classify_keys(full)
+        if classify_keys(banded) != classified:
+            raise RuntimeError(f"band limited detection classifies other keys in {name}")
+        print(f"{name:<22}{len(full):>4} {full_time * 1000:>6.1f}ms{len(banded):>4} {banded_time * 1000:>6.1f}ms"
+              f"{len(set(full) & set(banded)):>8}  {classified is not None}")
+    print(f"total: {total_full * 1000:.1f}ms full, {total_banded * 1000:.1f}ms banded "
+          f"({total_full / total_banded:.1f}x)")
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -1,7 +1,15 @@
+import os
+import tempfile
+import time
 import cv2
 import numpy as np
 from threading import Thread
 from p2m.p2m_types import *
+from algo import utils
+from algo.dpf_analyser import OnlineThresholdEstimator
+from algo.frame_buffer import FrameBuffer
+from algo.get_watch_cords import get_watch_cords_dict
+from algo.key_sampler import KeySampler
 from algo.video_class import VideoClass
 from p2m import p2m_constants
 
@@ -17,12 +25,19 @@ def get_average_color(image: ImageType, cords: list[CordType]) -> np.ndarray:
 #     return int(np.sum(np.abs(color1 - color2)))
 
 
-def draw_keys(img: ImageType, difference: np.ndarray, keys: list[RectType]):
+def draw_keys(img: ImageType, difference: np.ndarray, keys: list[RectType],
+              on_threshold: Union[float, np.ndarray, None] = None):
+    """
+    :param difference: latest row of the difference from the original colors, one value per key
+    :param on_threshold: value above which a key is drawn pressed, a learned note on threshold or one per key,
+        defaults to p2m_constants.ON_THRESHOLD
+    """
     WIDTH1 = 2
     WIDTH2 = 3
     COLOR1 = (0, 255, 0)  # Green
     COLOR2 = (0, 0, 255)  # Red
-    is_pressed = difference > p2m_constants.ON_THRESHOLD
+    # thresholds are fitted on the dpf, the raw difference is used so held keys stay drawn
+    is_pressed = difference > (on_threshold if on_threshold is not None else p2m_constants.ON_THRESHOLD)
 
     for idx, key in enumerate(keys):
         x, y, w, h = key
@@ -67,16 +82,27 @@ def interquartile_rgb_mean(values: np.ndarray) -> np.ndarray:
 #           note_off
 
 
+def get_cord_type(watch_cords: Iterable[RectType], black_keys: list[RectType]) -> np.ndarray:
+    """Key class of every watched key in order, 1 for black keys and 0 for white keys"""
+    return np.array([1 if cord in black_keys else 0 for cord in watch_cords])
+
+
 def process_video_func(video: VideoClass, watch_cords: dict[RectType, list[CordType]],
-                       black_keys: list[RectType], difference_per_frame: list[np.ndarray],
-                       is_running_func: Callable[[], bool] = lambda: True):
-    watch_cords_values = list(watch_cords.values())
-    cord_type = np.array([1 if cord in black_keys else 0 for cord in watch_cords])
+                       black_keys: list[RectType], difference_per_frame: Union[FrameBuffer, list[np.ndarray]],
+                       is_running_func: Callable[[], bool] = lambda: True,
+                       threshold_estimator: Optional[OnlineThresholdEstimator] = None):
+    """
+    :param difference_per_frame: every frame's difference from the original colors is appended here
+    :param threshold_estimator: fed the dpf rows as they are produced, starting from a row of zeros
+    """
+    sampler = KeySampler(watch_cords, video.transform)
+    cord_type = get_cord_type(watch_cords, black_keys)
     original_colors = np.full((len(watch_cords), 3), 0)  # [[b, g, r], [b, g, r], ..., [b, g, r]]
+    previous_difference = np.full(len(watch_cords), 0)
 
     while is_running_func() and video.read_next():
         # [[b, g, r], [b, g, r], ..., [b, g, r]]
-        current_colors = np.array([get_average_color(video.current_frame, cords) for cords in watch_cords_values])
+        current_colors = sampler.sample(video.source_frame)
 
         # Separate black and white key colors
         black_key_colors = current_colors[cord_type == 1]  # [[b, g, r], [b, g, r], ..., [b, g, r]]
@@ -94,24 +120,31 @@ def process_video_func(video: VideoClass, watch_cords: dict[RectType, list[CordT
         difference = np.sum(np.abs(current_colors - original_colors), axis=1)
         # print(difference)
         difference_per_frame.append(difference)
+        if threshold_estimator is not None:
+            threshold_estimator.push(difference - previous_difference)
+            previous_difference = difference
 
 
 def get_dpf_in_thread(video: VideoClass, watch_cords: dict[RectType, list[CordType]], keys: KeysPairType,
-                      quiet=False, show_video=True) -> list[list]:
-    difference_per_frame = [np.full(len(watch_cords), 0)]
+                      quiet=False, show_video=True) -> np.ndarray:
+    difference_per_frame = FrameBuffer(len(watch_cords), video.total_frames - video.current_frame_count + 1,
+                                       np.full(len(watch_cords), 0))
     watch_cords_list = list(watch_cords)
+    estimator = OnlineThresholdEstimator()
     processing_thread = Thread(
         target=process_video_func,
-        args=(video, watch_cords, keys[1], difference_per_frame)
+        args=(video, watch_cords, keys[1], difference_per_frame),
+        kwargs={"threshold_estimator": estimator}
     )
     video.set_start_time()
+    video.start_prefetch()
     processing_thread.start()
 
     cv2.imshow(video.name, video.current_frame)
     cv2.waitKey(1)
     while show_video and video.has_open_window() and not video.eof:
         frame = video.current_frame.copy()
-        draw_keys(frame, difference_per_frame[-1], watch_cords_list)
+        draw_keys(frame, difference_per_frame.latest, watch_cords_list, estimator.note_on_threshold)
         video.draw_info_on(frame)
         cv2.imshow(video.name, frame)
         cv2.waitKey(1)
@@ -121,7 +154,63 @@ def get_dpf_in_thread(video: VideoClass, watch_cords: dict[RectType, list[CordTy
         print(f"\033[F    Time Remaining: {video.get_time_remaining_str()}{'':10}")
 
     processing_thread.join()
-
-    dpf: np.ndarray = np.diff(np.array(difference_per_frame), axis=0)
-    list_dpf: list[list[int]] = dpf.astype(int).tolist()  # convert to list
-    return list_dpf
+    video.stop_prefetch()
+
+    return difference_per_frame.diff()
+
+
+def benchmark(n_frames=300):
+    """
+    Compares frames/sec of the per-key list comprehension sampling against KeySampler
+    on a synthetic 1280x720 keyboard video.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        video_path = os.path.join(directory, "synthetic_keyboard.mp4")
+        white_keys, black_keys = utils.make_synthetic_keyboard_video(video_path, n_frames)
+        watch_cords = get_watch_cords_dict(white_keys, black_keys)
+        watch_cords_values = list(watch_cords.values())
+        sampler = KeySampler(watch_cords)
+
+        video = VideoClass(video_path)
+        frames = [frame.copy() for frame in video]
+        video.cap.release()
+
+        start = time.perf_counter()
+        before = [np.array([get_average_color(frame, cords) for cords in watch_cords_values]) for frame in frames]
+        before_fps = len(frames) / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        after = [sampler.sample(frame) for frame in frames]
+        after_fps = len(frames) / (time.perf_counter() - start)
+
+        if not all(np.array_equal(b, a) for b, a in zip(before, after)):
+            raise RuntimeError("KeySampler output differs from get_average_color")
+
+        video = VideoClass(video_path)
+        difference_per_frame = []
+        start = time.perf_counter()
+        process_video_func(video, watch_cords, black_keys, difference_per_frame)
+        end_to_end_fps = len(difference_per_frame) / (time.perf_counter() - start)
+        video.cap.release()
+
+        video = VideoClass(video_path)
+        video.start_prefetch()
+        prefetched_difference_per_frame = []
+        start = time.perf_counter()
+        process_video_func(video, watch_cords, black_keys, prefetched_difference_per_frame)
+        prefetch_fps = len(prefetched_difference_per_frame) / (time.perf_counter() - start)
+        prefetch_stats = video.stop_prefetch()
+        video.cap.release()
+
+        if not all(np.array_equal(b, a) for b, a in zip(difference_per_frame, prefetched_difference_per_frame)):
+            raise RuntimeError("Prefetched decoding differs from synchronous decoding")
+
+    print(f"{len(watch_cords)} keys, {len(sampler.xs)} watch cords, {len(frames)} frames")
+    print(f"Sampling before: {before_fps:>10.1f} frames/s")
+    print(f"Sampling after:  {after_fps:>10.1f} frames/s ({after_fps / before_fps:.1f}x)")
+    print(f"process_video_func (decode included): {end_to_end_fps:.1f} frames/s")
+    print(f"process_video_func (prefetched):      {prefetch_fps:.1f} frames/s, {prefetch_stats}")
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,408 @@
+import itertools
+import multiprocessing
+import os
+import time
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, ProcessPoolExecutor
+from threading import Thread, Event, Lock
+from typing import Callable, Optional
+
+import cv2
+import numpy as np
+
+from srcs.algo.processing_class import ProcessingClass, ProcessStates
+from srcs.algo.threshold_profiles import ThresholdProfile
+from srcs.algo.utils import cv2_resize_to_fit
+from srcs.p2m import p2m_constants
+from srcs.p2m.p2m_exception import OperationCancelledException
+
+UPDATE_INTERVAL = 0.3       # seconds between progress and preview updates of a worker process
+PREVIEW_SIZE = (640, 360)   # previews are downscaled and jpeg encoded before leaving the worker
+# states arrive pickled from the workers, map them back to the ProcessStates objects compared with `is`
+_STATES: dict[str, str] = {v: v for k, v in vars(ProcessStates).items() if not k.startswith("_")}
+
+
+class StageStats:
+    """Queue depth and throughput of one pipeline stage, updated from any thread"""
+    def __init__(self, name: str):
+        self.name: str = name
+        self.queued: int = 0        # jobs waiting for a worker of this stage
+        self.running: int = 0
+        self.completed: int = 0
+        self.failed: int = 0        # failed or cancelled, before or after starting
+        self.bytes: int = 0         # size of the completed jobs' output, the downloaded files for downloads
+        self.last_error: Optional[BaseException] = None     # exception of the last job that raised
+        self._first_start: Optional[float] = None
+        self._lock: Lock = Lock()
+
+    def __repr__(self):
+        rate = f", {self.bytes_per_second / 1024 ** 2:.2f}MB/s" if self.bytes else ""
+        error = f", last_error={self.last_error!r}" if self.last_error is not None else ""
+        return (f"StageStats({self.name}: queued={self.queued}, running={self.running}, completed={self.completed}, "
+                f"failed={self.failed}, {self.jobs_per_minute:.2f} jobs/min{rate}{error})")
+
+    @property
+    def elapsed(self) -> float:
+        """Seconds since the first job of this stage started"""
+        return time.perf_counter() - self._first_start if self._first_start is not None else 0.0
+
+    @property
+    def jobs_per_minute(self) -> float:
+        elapsed = self.elapsed
+        return self.completed / elapsed * 60 if elapsed > 0 else 0.0
+
+    @property
+    def bytes_per_second(self) -> float:
+        elapsed = self.elapsed
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+    def record_queued(self):
+        with self._lock:
+            self.queued += 1
+
+    def record_start(self):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            if self._first_start is None:
+                self._first_start = time.perf_counter()
+
+    def record_end(self, started: bool, ok: bool, n_bytes: int = 0, error: Optional[BaseException] = None):
+        """
+        :param started: False for a job dropped from the queue
+        :param error: exception the job raised, kept as last_error
+        """
+        with self._lock:
+            if error is not None:
+                self.last_error = error
+            if started:
+                self.running -= 1
+            else:
+                self.queued -= 1
+            if ok:
+                self.completed += 1
+                self.bytes += n_bytes
+            else:
+                self.failed += 1
+
+
+class DownloadStage:
+    """
+    Downloads the videos of url jobs ahead of processing with its own concurrency limit, so the next
+    playlist item downloads while the current one is processed instead of taking a processing slot.
+    """
+    def __init__(self, max_workers: int = p2m_constants.DOWNLOAD_WORKERS,
+                 rate_limit: Optional[float] = p2m_constants.DOWNLOAD_RATE_LIMIT):
+        """
+        :param rate_limit: bytes per second of every download, None for no limit
+        """
+        self.max_workers: int = max_workers
+        self.rate_limit: Optional[float] = rate_limit
+        self.stats: StageStats = StageStats("download")
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures: set[Future] = set()
+        self._lock: Lock = Lock()
+
+    def submit(self, processor: ProcessingClass, on_start: Callable[[], None], on_end: Callable[[bool], None]):
+        """
+        Queue processor.download()
+
+        :param on_end: called with True once the video is downloaded, False if it failed or was cancelled
+        """
+        started = False
+
+        def job():
+            nonlocal started
+            started = True
+            self.stats.record_start()
+            on_start()
+            path = processor.download(self.rate_limit)
+            return os.path.getsize(path)
+
+        def done(f: Future):
+            with self._lock:
+                self._futures.discard(f)
+            error = f.exception() if not f.cancelled() else None
+            ok = not f.cancelled() and error is None
+            self.stats.record_end(started, ok, f.result() if ok else 0, error)
+            on_end(ok)
+
+        self.stats.record_queued()
+        future = self._executor.submit(job)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(done)
+
+    def cancel_queued(self):
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ProcessingBackend:
+    """
+    Runs ProcessingClass.save_as jobs submitted by the QueueManager, url jobs pass through the
+    download stage first and take a processing slot only once their video is downloaded.
+    """
+    def __init__(self, executor: Executor, download_stage: Optional[DownloadStage] = None):
+        self._executor: Executor = executor
+        self._download_stage: DownloadStage = download_stage if download_stage is not None else DownloadStage()
+        self.processing_stats: StageStats = StageStats("processing")
+        self._futures: set[Future] = set()
+        self._lock: Lock = Lock()
+
+    @property
+    def stage_stats(self) -> tuple[StageStats, StageStats]:
+        """(download, processing) queue depth and throughput"""
+        return self._download_stage.stats, self.processing_stats
+
+    def create_processor(self, src_str: str) -> ProcessingClass:
+        """Processor the ui reads state, progress and frames from, pass it back to submit"""
+        raise NotImplementedError
+
+    def submit(self, processor: ProcessingClass, save_path: str,
+               on_start: Callable[[], None], on_end: Callable[[bool], None]):
+        """
+        Queue processor.save_as(save_path), after downloading its video if it is a url
+
+        :param on_start: called once the job leaves the queue, the download queue for urls
+        :param on_end: called with True if the midi was saved, False if the job failed or was cancelled
+        """
+        self._prepare(processor)
+        if not processor.is_download_needed():
+            self._submit_processing(processor, save_path, on_start, on_end)
+            return
+
+        def downloaded(ok: bool):
+            if processor.is_cancelled():  # may have been cancelled after its download finished
+                processor.state = ProcessStates.TERMINATED
+                on_end(False)
+                return
+            if not ok:
+                on_end(False)
+                return
+            processor.state = ProcessStates.QUEUED
+            self._submit_processing(processor, save_path, lambda: None, on_end)
+
+        self._download_stage.submit(processor, on_start, downloaded)
+
+    def _prepare(self, processor: ProcessingClass):
+        """Readies processor for a new job before it is queued anywhere, so it can be cancelled from then on"""
+        processor.new_job()
+
+    def _submit_job(self, processor: ProcessingClass, save_path: str, on_start: Callable[[], None]) -> Future:
+        """Submit processor.save_as(save_path) to the executor, on_start called when it starts"""
+        raise NotImplementedError
+
+    def _submit_processing(self, processor: ProcessingClass, save_path: str,
+                           on_start: Callable[[], None], on_end: Callable[[bool], None]):
+        started = False
+
+        def start():
+            nonlocal started
+            started = True
+            self.processing_stats.record_start()
+            on_start()
+
+        def end(ok: bool, error: Optional[BaseException] = None):
+            self.processing_stats.record_end(started, ok, error=error)
+            on_end(ok)
+
+        self.processing_stats.record_queued()
+        self._track(self._submit_job(processor, save_path, start), end)
+
+    def _track(self, future: Future, on_end: Callable[[bool, Optional[BaseException]], None]):
+        def done(f: Future):
+            with self._lock:
+                self._futures.discard(f)
+            if f.cancelled():
+                on_end(False, None)
+                return
+            on_end(f.exception() is None, f.exception())
+
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(done)
+
+    def cancel_queued(self):
+        """Drop every job that has not started yet, running jobs are cancelled through their processor"""
+        self._download_stage.cancel_queued()
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+
+    def shutdown(self):
+        self._download_stage.shutdown()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ThreadBackend(ProcessingBackend):
+    """Jobs share this process, cheap to start but the numpy loops of concurrent jobs share one GIL"""
+    def __init__(self, max_workers: Optional[int] = None, download_stage: Optional[DownloadStage] = None):
+        """
+        :param max_workers: processing threads, defaults to the core count, downloads have their own
+        """
+        super().__init__(ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1), download_stage)
+
+    def create_processor(self, src_str: str) -> ProcessingClass:
+        return ProcessingClass(src_str)
+
+    def _submit_job(self, processor: ProcessingClass, save_path: str, on_start: Callable[[], None]) -> Future:
+        def job():
+            on_start()
+            processor.state = ProcessStates.RUNNING
+            processor.save_as(save_path)
+
+        return self._executor.submit(job)
+
+
+class RemoteProcessingClass(ProcessingClass):
+    """Mirror of a ProcessingClass running in a ProcessBackend worker, updated from the worker's reports"""
+    def __init__(self, src_str: str):
+        super().__init__(src_str)
+        self._remote_cancel_event = None
+        self._remote_progress: float = 0.0
+        self._preview: Optional[bytes] = None
+
+    def attach_job(self, remote_cancel_event):
+        self.new_job()
+        self._remote_cancel_event = remote_cancel_event
+        self._remote_progress = 0.0
+
+    def cancel(self):
+        if self._remote_cancel_event is not None:
+            self._remote_cancel_event.set()
+        super().cancel()
+
+    def get_displayed_frame(self):
+        preview = self._preview
+        if preview is None:
+            return super().get_displayed_frame()
+        return cv2.imdecode(np.frombuffer(preview, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    def get_progress(self) -> float:
+        if self.state is ProcessStates.DOWNLOADING_VIDEO:  # downloads run in this process
+            return super().get_progress()
+        return self._remote_progress
+
+
+def _encode_preview(processor: ProcessingClass) -> bytes:
+    frame = cv2_resize_to_fit(processor.get_displayed_frame(), *PREVIEW_SIZE)
+    _, buffer = cv2.imencode(".jpg", frame)
+    return buffer.tobytes()
+
+
+def _run_job(job_id: int, src_str: str, save_path: str, updates, cancel_event,
+             pinned_profile: Optional[ThresholdProfile] = None, video_path: Optional[str] = None):
+    """
+    Worker side of ProcessBackend, reports (job_id, kind, value) tuples through updates
+
+    :param video_path: file the download stage saved a url source to
+    """
+    if cancel_event.is_set():
+        updates.put((job_id, "done", None))
+        raise OperationCancelledException("Terminated")
+    processor = ProcessingClass(src_str)
+    processor.pinned_profile = pinned_profile
+    if video_path is not None:
+        processor.video_path = video_path
+    processor.state_hooks.hook(lambda: updates.put((job_id, "state", processor.state)))
+    updates.put((job_id, "started", None))
+    finished = Event()
+
+    def report():
+        while not finished.wait(UPDATE_INTERVAL):
+            if cancel_event.is_set():
+                processor.cancel()
+            updates.put((job_id, "progress", processor.get_progress()))
+            updates.put((job_id, "preview", _encode_preview(processor)))
+
+    reporter = Thread(target=report, daemon=True)
+    reporter.start()
+    try:
+        processor.state = ProcessStates.RUNNING
+        processor.save_as(save_path)
+    finally:
+        finished.set()
+        reporter.join()
+        updates.put((job_id, "progress", processor.get_progress()))
+        updates.put((job_id, "state", processor.state))
+        updates.put((job_id, "profile", processor.threshold_profile))
+        updates.put((job_id, "done", None))
+
+
+class ProcessBackend(ProcessingBackend):
+    """
+    Every job runs in a worker process, state, progress and a preview frame are streamed back
+    through a queue and applied to the RemoteProcessingClass the ui holds.
+    """
+    def __init__(self, max_workers: Optional[int] = None, download_stage: Optional[DownloadStage] = None):
+        """
+        :param max_workers: worker processes, defaults to the core count, downloads have their own threads
+        """
+        self.max_workers: int = max_workers if max_workers is not None else (os.cpu_count() or 1)
+        super().__init__(ProcessPoolExecutor(max_workers=self.max_workers), download_stage)
+        self._manager = multiprocessing.Manager()
+        self._updates = self._manager.Queue()
+        self._processors: dict[int, RemoteProcessingClass] = {}
+        self._start_callbacks: dict[int, Callable[[], None]] = {}
+        self._job_ids = itertools.count()
+        self._listener: Thread = Thread(target=self._listen, daemon=True)
+        self._listener.start()
+
+    def create_processor(self, src_str: str) -> RemoteProcessingClass:
+        return RemoteProcessingClass(src_str)
+
+    def _prepare(self, processor: RemoteProcessingClass):
+        processor.attach_job(self._manager.Event())
+
+    def _submit_job(self, processor: RemoteProcessingClass, save_path: str, on_start: Callable[[], None]) -> Future:
+        job_id = next(self._job_ids)
+        self._processors[job_id] = processor
+        self._start_callbacks[job_id] = on_start
+        # a url source was downloaded by the download stage, the worker processes that file
+        future = self._executor.submit(_run_job, job_id, processor.src_str, save_path, self._updates,
+                                       processor._remote_cancel_event, processor.pinned_profile,
+                                       processor._downloaded_path)
+        # jobs cancelled before starting never report "done"
+        future.add_done_callback(lambda f: f.cancelled() and self._forget(job_id))
+        return future
+
+    def _forget(self, job_id: int):
+        self._processors.pop(job_id, None)
+        self._start_callbacks.pop(job_id, None)
+
+    def _listen(self):
+        while True:
+            try:
+                update = self._updates.get()
+            except (EOFError, OSError):  # manager shut down
+                return
+            if update is None:
+                return
+            job_id, kind, value = update
+            processor = self._processors.get(job_id)
+            if processor is None:
+                continue
+            if kind == "started":
+                self._start_callbacks.pop(job_id, lambda: None)()
+            elif kind == "state":
+                processor.state = _STATES.get(value, ProcessStates.UNKNOWN)
+            elif kind == "progress":
+                processor._remote_progress = value
+            elif kind == "preview":
+                processor._preview = value
+            elif kind == "profile":
+                processor.threshold_profile = value
+            elif kind == "done":
+                self._forget(job_id)
+
+    def shutdown(self):
+        super().shutdown()
+        self._updates.put(None)
+        self._listener.join()
+        self._manager.shutdown()
@@ -1,23 +1,34 @@
-import json
 import os
 import pathlib
+import time
 from functools import wraps
-from threading import Thread
+from threading import Thread, Event
 
 import cv2
 import numpy as np
 
-from algo.dpf_to_midi import dpf_data_to_midi
+from algo.dpf_analyser import OnlineThresholdEstimator
+from algo.dpf_cache import DpfCache
+from algo.dpf_file import DpfData, DPF_SUFFIX
+from algo.dpf_to_midi import dpf_data_to_midi, StreamingDpfToMidiConverter, RawDifferenceStream
+from algo.frame_buffer import FrameBuffer
 from algo.get_watch_cords import get_watch_cords_dict
-from algo.locate_black_and_white import locate_keys_like, classify_keys
+from algo.key_layout_cache import KeyLayoutCache
+from algo.frame_prefetcher import PrefetchStats
+from algo.key_search import find_keys_in_video, KeySearchStats
 from algo.process_video import draw_keys as draw_keys_with_dpf
-from algo.process_video import process_video_func
+from algo.process_video import process_video_func, get_cord_type
+from algo.process_rects import get_bounding_rect
+from algo.segmented_process_video import SegmentedVideoProcessor
+from algo.threshold_profiles import ThresholdProfile, ThresholdProfileStore, ThresholdModes, fit_threshold_profile
 from algo.utils import SettableCachedProperty
 from algo import utils
 from algo.video_class import VideoClass
-from algo.download_videos import download_video, is_valid_url, get_video_title
+from algo.video_stream import StreamVideoClass
+from algo.download_videos import download_video, is_url_format, get_video_info, get_uploader, \
+    get_stream_command, get_stream_info
 from algo.wait_and_find_keys import draw_keys as draw_keys_raw
-from p2m import p2m_path
+from p2m import p2m_path, p2m_constants
 from p2m.p2m_exception import *
 from p2m.p2m_types import *
 
@@ -34,10 +45,10 @@ class ProcessStates:
     COMPLETED = "Completed"
     ERROR = "Error"
     UNKNOWN = "Unknown"
-    TERMINATED = "Paused"  # Only this is edited by external
+    TERMINATED = "Paused"
 
 
-def state_method(start_state: Optional[str] = None):
+def state_method(start_state: Optional[str] = None, end_state: str = ProcessStates.COMPLETED):
     state_varname = "state"
     active_calls_varname = "_active_state_calls"
 
@@ -66,7 +77,7 @@ def state_method(start_state: Optional[str] = None):
             finally:
                 setattr(self, active_calls_varname, getattr(self, active_calls_varname) - 1)
             if getattr(self, active_calls_varname) == 0:
-                setattr(self, state_varname, ProcessStates.COMPLETED)
+                setattr(self, state_varname, end_state)
             else:
                 setattr(self, state_varname, original_state)
             return ret
@@ -97,37 +108,85 @@ class HookHandler:
 
 
 class ProcessingClass:
-    def __init__(self, src_str: str):
+    def __init__(self, src_str: str, processes: int = 1, streaming_midi: bool = p2m_constants.STREAMING_MIDI,
+                 threshold_mode: str = p2m_constants.THRESHOLD_MODE,
+                 stream_input: bool = p2m_constants.STREAM_DOWNLOADS):
+        """
+        :param src_str: video path or url
+        :param processes: processes to split the video between, 1 processes it on the calling thread
+        :param streaming_midi: decide notes while the video is processed instead of after,
+            thresholds are then fitted on the first seconds and refined as it goes. Only the latest row of the
+            dpf is kept, so memory doesn't grow with the video but the dpf is neither saved nor cached.
+            Needs processes=1
+        :param threshold_mode: one of ThresholdModes, separate thresholds per key class or key need the
+            key layout and fall back to GLOBAL for a dpf read from history
+        :param stream_input: process a url while it is downloaded instead of downloading it first, the video
+            is then read once in order, by one process and without the dpf cache
+        """
         self.src_str: str = src_str
+        self.processes: int = processes
+        self.streaming_midi: bool = streaming_midi
+        self.threshold_mode: str = threshold_mode
+        self.stream_input: bool = stream_input
         self._state: str = ProcessStates.NOT_STARTED
         self.state_hooks: HookHandler = HookHandler()
 
         # self.save_as_path: str = save_as_path
         # self.fps: Optional[float] = None
         self._video_ref: Optional[VideoClass] = None
+        self._segmented_processor: Optional[SegmentedVideoProcessor] = None
         self._download_progress: float = 0.0
+        self._downloaded_path: Optional[str] = None
         self._unconfirmed_keys: list[RectType] = []
         self._white_keys: list[RectType] = []
         self._black_keys: list[RectType] = []
         self.watch_cords_dict: dict[RectType, list[CordType]] = {}
         self.watch_cords_list: list[RectType] = []
         self.watch_cords_values: list[list[CordType]] = []
-        self._dpf_raw: list[np.ndarray] = []
+        self._dpf_raw: Union[FrameBuffer, RawDifferenceStream] = FrameBuffer(0)
+        self.dpf_cache: DpfCache = DpfCache()
+        self.key_layouts: KeyLayoutCache = KeyLayoutCache()
+        self._cache_key: Optional[str] = None
+        self.dpf_cache_hit: bool = False
+        # counters of the last key search and of the frame prefetch while processing, None until they ran
+        self.key_search_stats: Optional[KeySearchStats] = None
+        self.prefetch_stats: Optional[PrefetchStats] = None
+        self.threshold_profiles: ThresholdProfileStore = ThresholdProfileStore()
+        # thresholds forced on this job, e.g. one profile for a whole batch
+        self.pinned_profile: Optional[ThresholdProfile] = None
+        # thresholds the midi was generated with
+        self.threshold_profile: Optional[ThresholdProfile] = None
+        # thresholds learned from the frames processed so far, for drawing pressed keys
+        self.threshold_estimator: Optional[OnlineThresholdEstimator] = None
         # self.diff_per_frame: list[list[int]] = []
         # self.midi: Optional[mido.MidiFile] = None
-        self._abort = False
+        self._cancel_event: Event = Event()
 
     @SettableCachedProperty
     def title(self):
         path = pathlib.Path(self.src_str)
         if path.exists() and path.is_file():
             ret = path.stem
-        elif is_valid_url(self.src_str):
-            ret = get_video_title(self.src_str)
+        elif self.url_info is not None:
+            ret = self.url_info.get('title', 'Unknown')
         else:
             ret = "Unnamed"
         return utils.clean_filename(ret)
 
+    @SettableCachedProperty
+    def uploader(self) -> Optional[str]:
+        return get_uploader(self.url_info) if self.url_info is not None else None
+
+    @SettableCachedProperty
+    def url_info(self) -> Optional[dict]:
+        """Metadata of the url source, fetched once for title, uploader and streaming, None if not a video url"""
+        if not is_url_format(self.src_str):
+            return None
+        try:
+            return get_video_info(self.src_str)
+        except ValueError:
+            return None
+
     @property
     def state(self):
         return self._state
@@ -137,16 +196,31 @@ class ProcessingClass:
         self._state = val
         self.state_hooks.call()
 
+    def new_job(self):
+        """Call before every run, a job cancelled by kill stays cancelled even if it has not started yet"""
+        self._cancel_event = Event()
+
+    def cancel(self):
+        """Cancel the current job without waiting for it"""
+        self._cancel_event.set()
+        if self.is_not_processing():
+            self.state = ProcessStates.TERMINATED
+
     def kill(self):
+        """Cancel the current job and wait until it stops"""
+        self.cancel()
         while not self.is_idle():
-            self._state = ProcessStates.TERMINATED
+            time.sleep(0.01)
+
+    def is_cancelled(self):
+        return self._cancel_event.is_set()
 
     def _raise_if_terminated(self):
-        if self._state is ProcessStates.TERMINATED:
+        if self.is_cancelled():
             raise OperationCancelledException("Terminated")
 
     def is_not_terminated(self):
-        return self._state is not ProcessStates.TERMINATED
+        return not self.is_cancelled()
 
     def is_failed(self):
         return self._state in (ProcessStates.ERROR, ProcessStates.FAILED_TO_FIND_KEYS, ProcessStates.TERMINATED)
@@ -163,26 +237,60 @@ class ProcessingClass:
     def get_dpf_filepath(self):
         filename = self.title  # self.src_str.replace(":", "").replace("\\", "_").replace("/", "_")
         filename = utils.clean_filename(filename)
-        return os.path.join(p2m_path.DPF_DIR, f'{filename}.dpf.json')
+        return os.path.join(p2m_path.DPF_DIR, f'{filename}{DPF_SUFFIX}')
 
     @state_method(start_state=ProcessStates.DOWNLOADING_VIDEO)
-    def _download_and_get_video_path(self) -> str:
+    def _download_and_get_video_path(self, rate_limit: Optional[float] = None) -> str:
         def update_progress(progress: float):
             self._download_progress = progress
-        return download_video(self.src_str, p2m_path.VIDEOS_DIR, self.title, progress_hook_func=update_progress)
+        self._downloaded_path = download_video(self.src_str, p2m_path.VIDEOS_DIR, self.title, update_progress,
+                                               rate_limit, self.is_not_terminated)
+        return self._downloaded_path
+
+    def is_download_needed(self) -> bool:
+        """True if src_str is a url that has not been downloaded yet and is not streamed instead"""
+        return not self.stream_input and self._is_undownloaded_url()
+
+    def _is_undownloaded_url(self) -> bool:
+        return self._downloaded_path is None and not os.path.exists(self.src_str) and is_url_format(self.src_str)
+
+    def _open_stream(self) -> Optional[StreamVideoClass]:
+        """The url source read while yt-dlp downloads it, None if it can't be streamed"""
+        try:
+            if self.url_info is None:
+                raise ValueError("no video info")
+            fps, total_frames = get_stream_info(self.url_info)
+            return StreamVideoClass(get_stream_command(self.src_str, p2m_constants.DOWNLOAD_RATE_LIMIT), self.title,
+                                    fps=fps, total_frames=total_frames)
+        except (ValueError, OSError) as exc:
+            print(f"unable to stream {self.src_str}, downloading it first: {exc}")
+            return None
+
+    @state_method(start_state=ProcessStates.DOWNLOADING_VIDEO, end_state=ProcessStates.QUEUED)
+    def download(self, rate_limit: Optional[float] = None) -> str:
+        """
+        Downloads the url source ahead of processing, e.g. on a download thread, video_path then returns the file.
+        The job is left queued for processing instead of completed
+
+        :param rate_limit: bytes per second, None for no limit
+        """
+        self.video_path = self._download_and_get_video_path(rate_limit)
+        return self.video_path
 
     @SettableCachedProperty
     def video_path(self):
         if os.path.exists(self.src_str):
             return self.src_str
-        elif is_valid_url(self.src_str):
+        elif self.url_info is not None:
             return self._download_and_get_video_path()
         else:
             raise RuntimeError("unable to get video path")
 
     @SettableCachedProperty
     def video(self) -> VideoClass:
-        vid = VideoClass(self.video_path)
+        vid = self._open_stream() if self.stream_input and self._is_undownloaded_url() else None
+        if vid is None:
+            vid = VideoClass(self.video_path)
         self._video_ref = vid
         return vid
 
@@ -192,45 +300,133 @@ class ProcessingClass:
 
     @state_method(start_state=ProcessStates.FINDING_KEYS)
     def find_black_and_white_keys(self):
-        while self.video.read_next():
-            self._raise_if_terminated()
-            self._unconfirmed_keys[:] = locate_keys_like(self.video.current_frame)
-            classified_keys = classify_keys(self._unconfirmed_keys)
-            if classified_keys is None:
-                continue
-            self._white_keys[:], self._black_keys[:] = classified_keys
-            # print("found keys", self.white_keys, self.black_keys)
-            return
-        raise KeysNotFoundError(self.src_str)
+        """Keys of a cached layout if the next frame shows one, otherwise searched for and cached"""
+        read = self.video.read_next()
+        if read:
+            layout = self.key_layouts.find(self.video.current_frame)
+            if layout is not None:
+                print(f"key layout cache hit {layout}")
+                self._white_keys[:], self._black_keys[:] = layout.white_keys, layout.black_keys
+                if layout.grid == p2m_constants.WATCH_CORD_GRID:  # otherwise sampled again in generate_diff_per_frame
+                    self.watch_cords_dict.update(layout.watch_cords)
+                return
+
+        def show_keys_like(keys_like: list[RectType]):
+            self._unconfirmed_keys[:] = keys_like
+
+        classified_keys, self.key_search_stats = find_keys_in_video(self.video, is_running_func=self.is_not_terminated,
+                                                                    on_examined=show_keys_like, from_current=read)
+        self._raise_if_terminated()
+        if classified_keys is None:
+            raise KeysNotFoundError(self.src_str)
+        self._white_keys[:], self._black_keys[:] = classified_keys
+        # print("found keys", self.white_keys, self.black_keys)
+        self.watch_cords_dict.update(get_watch_cords_dict(self._white_keys, self._black_keys))
+        self.key_layouts.store(self.video.current_frame, self._white_keys, self._black_keys, self.watch_cords_dict,
+                               p2m_constants.WATCH_CORD_GRID)
+
+    def get_keyboard_rect(self) -> RectType:
+        """Bounding box of the piano keys with room for the labels drawn above them"""
+        height, width = self.video.current_frame.shape[:2]
+        return get_bounding_rect(self._white_keys + self._black_keys, margin=20, bounds=(width, height))
 
     @state_method(start_state=ProcessStates.PROCESSING_VIDEO)
-    def generate_diff_per_frame(self):
+    def generate_diff_per_frame(self) -> Optional[DpfData]:
+        """The dpf of the video, None with streaming_midi, which sets midi instead of keeping the dpf"""
         if not self._white_keys or not self._black_keys:
             self.find_black_and_white_keys()
-        self.watch_cords_dict.update(get_watch_cords_dict(self._white_keys, self._black_keys))
+        if not self.watch_cords_dict:
+            self.watch_cords_dict.update(get_watch_cords_dict(self._white_keys, self._black_keys))
         self.watch_cords_list[:] = list(self.watch_cords_dict.keys())
         self.watch_cords_values[:] = list(self.watch_cords_dict.values())
-        self._dpf_raw[:] = [np.full(len(self.watch_cords_dict), 0)]
-        # TODO: move to self
-        process_video_func(self.video, self.watch_cords_dict, self._black_keys, self._dpf_raw,
-                           self.is_not_terminated)
+        # a stream has no file to fingerprint, its dpf is saved by title
+        self._cache_key = self.dpf_cache.get_key(self.video_path, self.watch_cords_list, self._black_keys) \
+            if self.video.seekable else None
+        # read into memory, the cache may evict the file while the dpf is used
+        cached = self.dpf_cache.load(self._cache_key, mmap=False) if self._cache_key is not None else None
+        if cached is not None:
+            print(f"dpf cache hit {self._cache_key}")
+            self.dpf_cache_hit = True
+            return cached
+        self.video.set_roi(self.get_keyboard_rect())
+        first_row = np.full(len(self.watch_cords_dict), 0)
+        segmented = self.processes > 1 and self.video.seekable
+        converter = None
+        if self.streaming_midi and not segmented:
+            thresholds = self.pinned_profile.get_thresholds(len(self.watch_cords_list)) \
+                if self.pinned_profile is not None else None
+            converter = StreamingDpfToMidiConverter(self.fps, thresholds=thresholds)
+            # notes are decided as rows arrive, only the latest row is kept
+            self._dpf_raw = RawDifferenceStream(converter, first_row)
+        else:
+            self._dpf_raw = FrameBuffer(len(first_row), self.video.total_frames - self.video.current_frame_count + 1,
+                                        first_row)
+        if segmented:
+            self._segmented_processor = SegmentedVideoProcessor(self.video, self.watch_cords_dict, self._black_keys,
+                                                                self.processes)
+            self._dpf_raw.extend(self._segmented_processor.run(self.is_not_terminated))
+        else:
+            # the streaming converter already counts every row
+            self.threshold_estimator = converter.estimator if converter is not None else OnlineThresholdEstimator()
+            self.video.start_prefetch()
+            try:
+                # TODO: move to self
+                process_video_func(self.video, self.watch_cords_dict, self._black_keys, self._dpf_raw,
+                                   self.is_not_terminated,
+                                   threshold_estimator=self.threshold_estimator if converter is None else None)
+            finally:
+                self.prefetch_stats = self.video.stop_prefetch()
         self._raise_if_terminated()
-        return np.diff(np.array(self._dpf_raw), axis=0).astype(int).tolist()
+        if converter is not None:
+            self.midi = converter.finish()
+            self.threshold_profile = self.pinned_profile or \
+                ThresholdProfile(converter.note_off_threshold, converter.note_on_threshold, [])
+            return None
+        return DpfData(self._dpf_raw.diff(), self.fps, self.watch_cords_list, self._black_keys)
 
     @SettableCachedProperty
-    def diff_per_frame(self):
+    def diff_per_frame(self) -> Optional[DpfData]:
         return self.generate_diff_per_frame()
 
     @state_method()
     def read_dpf_from_history(self):
-        with open(self.get_dpf_filepath(), "r") as f:
-            data = json.load(f)
-        self.fps = data['fps']
-        self.diff_per_frame = data['dpf']
+        # also finds .dpf.json written before the binary format
+        dpf = DpfData.load(self.get_dpf_filepath(), mmap=False)
+        self.fps = dpf.fps
+        self.diff_per_frame = dpf
+
+    def get_threshold_profile(self) -> ThresholdProfile:
+        """
+        The pinned profile, or the one fitted on this exact dpf before, or a new fit warm started from
+        the profile of the last video with the same uploader and key layout (GLOBAL mode only).
+        New fits are stored under both.
+        """
+        if self.pinned_profile is not None:
+            return self.pinned_profile
+        # the layout is unknown when the dpf was read from history
+        mode = self.threshold_mode if self.watch_cords_list else ThresholdModes.GLOBAL
+        cord_type = get_cord_type(self.watch_cords_list, self._black_keys) if self.watch_cords_list else None
+        dpf_key = self.threshold_profiles.get_dpf_key(self.diff_per_frame, mode, cord_type)
+        profile = self.threshold_profiles.load(dpf_key)
+        if profile is not None:
+            print(f"threshold profile hit {dpf_key}")
+            return profile
+        style_key = self.threshold_profiles.get_style_key(self.uploader, self.watch_cords_list, self._black_keys) \
+            if mode == ThresholdModes.GLOBAL and self.watch_cords_list else None
+        warm_start = self.threshold_profiles.load(style_key) if style_key is not None else None
+        profile = fit_threshold_profile(self.diff_per_frame, warm_start, mode, cord_type)
+        self.threshold_profiles.store(dpf_key, profile)
+        if style_key is not None:
+            self.threshold_profiles.store(style_key, profile)
+        return profile
 
     @state_method()
     def generate_midi(self):
-        return dpf_data_to_midi(self.fps, self.diff_per_frame)
+        if self.diff_per_frame is None:  # streamed, generating it set the midi
+            return self.midi
+        self.threshold_profile = self.get_threshold_profile()
+        thresholds = self.threshold_profile.get_thresholds(self.diff_per_frame.n_keys)
+        return dpf_data_to_midi(self.fps, self.diff_per_frame, thresholds)
 
     @SettableCachedProperty
     def midi(self):
@@ -238,18 +434,29 @@ class ProcessingClass:
 
     @state_method()
     def save_dpf_data(self):
-        filepath = self.get_dpf_filepath()
-        pathlib.Path(filepath).parent.mkdir(parents=True, exist_ok=True)
-        with open(filepath, 'w+') as f:
-            data_dict = {"fps": self.fps, "dpf": self.diff_per_frame}
-            json.dump(data_dict, f)
+        dpf = self.diff_per_frame  # generating it sets the cache key
+        if dpf is None:  # streamed to midi without keeping it
+            return
+        if self._cache_key is None:  # loaded from history, nothing to key it by
+            dpf.save(self.get_dpf_filepath())
+            return
+        self.dpf_cache.store(self._cache_key, dpf, {"title": self.title, "source": self.src_str})
 
     @state_method()
     def save_as(self, abs_path):
+        self._raise_if_terminated()
         pathlib.Path(abs_path).parent.mkdir(parents=True, exist_ok=True)
         self.save_dpf_data()
         self.midi.save(abs_path)
 
+    def get_display_threshold(self) -> Union[float, np.ndarray, None]:
+        """Note on threshold of the pinned profile, else the one learned so far, None before the first fit"""
+        if self.pinned_profile is not None:
+            return self.pinned_profile.get_thresholds(len(self.watch_cords_list))[1]
+        if self.threshold_estimator is not None:
+            return self.threshold_estimator.note_on_threshold
+        return None
+
     def get_displayed_frame(self):
         if self._video_ref is None:
             return np.zeros((720, 1280, 3), dtype=np.uint8)
@@ -257,8 +464,10 @@ class ProcessingClass:
         if img is None:
             return self._video_ref.get_thumbnail()
         img = img.copy()
-        if self.watch_cords_list and self._dpf_raw:
-            return draw_keys_with_dpf(img, self._dpf_raw[-1], self.watch_cords_list)
+        if self.watch_cords_list and len(self._dpf_raw):
+            x_offset, y_offset = self._video_ref.roi_offset
+            keys = [(x - x_offset, y - y_offset, w, h) for x, y, w, h in self.watch_cords_list]
+            return draw_keys_with_dpf(img, self._dpf_raw.latest, keys, self.get_display_threshold())
         return draw_keys_raw(img, self._white_keys, self._black_keys, self._unconfirmed_keys)
 
     def get_progress(self) -> float:
@@ -266,6 +475,8 @@ class ProcessingClass:
 
         :return: progress 0.0 - 1.0
         """
+        if self._segmented_processor:
+            return self._segmented_processor.get_progress()
         if self._video_ref:
             return self._video_ref.get_progress()
         if self._state is ProcessStates.DOWNLOADING_VIDEO:
@@ -1,6 +1,5 @@
 import os
 import easygui
-import json
 import pathlib
 from p2m import p2m_path
 from p2m.p2m_types import *
@@ -9,6 +8,7 @@ from algo.video_class import VideoClass
 from algo.wait_and_find_keys import wait_and_find_keys
 from algo.get_watch_cords import get_watch_cords_dict
 from algo.dpf_to_midi import dpf_data_to_midi
+from algo.dpf_file import DpfData, find_dpf_file, DPF_SUFFIX
 from p2m.p2m_exception import *
 from p2m import p2m_constants
 import mido
@@ -26,34 +26,28 @@ def _basename(path: str) -> str:
 
 
 def generate_p2m_dpf_filepath(video_path: str):
-    return os.path.join(p2m_path.DPF_DIR, f'{_basename(video_path)}.dpf.json')
+    return os.path.join(p2m_path.DPF_DIR, f'{_basename(video_path)}{DPF_SUFFIX}')
 
 
-def load_dpf_from_history(dpf_data_path: str):
-    with open(dpf_data_path, 'r') as f:
-        data = json.load(f)
+def load_dpf_from_history(dpf_data_path: str) -> DpfData:
+    return DpfData.load(dpf_data_path, mmap=False)
 
-    return data["fps"], data["dpf"]
 
-
-def video_to_dpf_data(video_path: str) -> tuple[float, DpfType]:
+def video_to_dpf_data(video_path: str) -> DpfData:
     video = VideoClass(video_path)
     keys = wait_and_find_keys(video)
     watch_cords_dict = get_watch_cords_dict(*keys)
-    dpf = get_dpf_in_thread(video, watch_cords_dict, keys, show_video=True)
-    diff_per_frame_data = video.fps, dpf
+    diff_per_frame_data = DpfData(get_dpf_in_thread(video, watch_cords_dict, keys, show_video=True), video.fps,
+                                  list(watch_cords_dict), keys[1])
     video.release()
 
-    filepath = generate_p2m_dpf_filepath(video_path)
-    pathlib.Path(filepath).parent.mkdir(parents=True, exist_ok=True)
-    with open(filepath, 'w+') as f:
-        data_dict = {"fps": diff_per_frame_data[0], "dpf": diff_per_frame_data[1]}
-        json.dump(data_dict, f)
+    diff_per_frame_data.save(generate_p2m_dpf_filepath(video_path))
 
     return diff_per_frame_data
 
 
-def save_dpf_data_as_midi(name: str, source_video_fps: int, difference_per_frame: list[list[int]], directory: str):
+def save_dpf_data_as_midi(name: str, source_video_fps: float, difference_per_frame: Union[DpfData, DpfType],
+                          directory: str):
     midi = dpf_data_to_midi(source_video_fps, difference_per_frame)
     filepath = f"{directory}/{name}.mid"
     midi.save(filepath)
@@ -63,10 +57,10 @@ def save_dpf_data_as_midi(name: str, source_video_fps: int, difference_per_frame
 def _convert_one(video_path: str, name: str, use_history: bool, directory: str):
     print(f"Processing {name}")
     if use_history:
-        fps, dpf = load_dpf_from_history(generate_p2m_dpf_filepath(video_path))
+        dpf = load_dpf_from_history(generate_p2m_dpf_filepath(video_path))
     else:
-        fps, dpf = video_to_dpf_data(video_path)
-    save_dpf_data_as_midi(name, fps, dpf, directory)
+        dpf = video_to_dpf_data(video_path)
+    save_dpf_data_as_midi(name, dpf.fps, dpf, directory)
 
 
 def prompt_for_details(path: str) -> tuple[str, str, bool]:
@@ -74,7 +68,7 @@ def prompt_for_details(path: str) -> tuple[str, str, bool]:
     dpf_filepath = generate_p2m_dpf_filepath(path)
 
     # Check if the file exists and prompt the user accordingly
-    if os.path.exists(dpf_filepath):
+    if find_dpf_file(dpf_filepath) is not None:
         msg = f"""History found for
 
     "{pathlib.Path(path).name}"
@@ -139,5 +133,6 @@ if __name__ == '__main__':
     # save_video_as_midi(p2m_path.DATA_DIR, [r"..\..\assets\amygdala_piano2.mp4"])
     # save_video_as_midi(p2m_path.data)
     path = r"C:\Users\DELL\PycharmProjects\pythonProject\piano_to_midi_312\data\dpf\[FULL] Ijin-tachi no Jikan - Assassins Pride ED - Piano Arrangement [Synthesia].dpf.json"
-    save_dpf_data_as_midi("assassins pride ed", *load_dpf_from_history(path), p2m_path.DATA_DIR)
+    dpf = load_dpf_from_history(path)
+    save_dpf_data_as_midi("assassins pride ed", dpf.fps, dpf, p2m_path.DATA_DIR)
 
@@ -0,0 +1,168 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_EXCEPTION
+from typing import Callable, Optional
+
+import numpy as np
+
+from algo.process_video import process_video_func
+from algo.video_class import VideoClass
+from p2m.p2m_exception import OperationCancelledException
+from p2m.p2m_types import *
+
+MIN_SEGMENT_FRAMES = 300    # shorter segments spend more time opening the video than sampling it
+PROGRESS_INTERVAL = 30      # frames between progress reports and cancellation checks of a worker
+
+
+def _process_segment(video_path: str, max_size: tuple[int, int], roi: Optional[RectType],
+                     watch_cords: dict[RectType, list[CordType]], black_keys: list[RectType],
+                     start: int, end: Optional[int], segment_idx: int, progress, cancel_event) -> np.ndarray:
+    """
+    Runs process_video_func on frames [start, end) of the video in a worker process.
+
+    :param end: None to read until the end of the video
+    :param progress: shared list, progress[segment_idx] is set to the number of frames read so far
+    :return: the per-frame differences, one row per frame
+    """
+    video = VideoClass(video_path, max_size)
+    video.set_roi(roi)
+    video.seek(start)
+    video.start_prefetch()
+    is_cancelled = False
+
+    def is_running() -> bool:
+        nonlocal is_cancelled
+        frames_read = video.current_frame_count - start
+        if frames_read % PROGRESS_INTERVAL == 0:
+            progress[segment_idx] = frames_read
+            is_cancelled = cancel_event.is_set()
+        return not is_cancelled and (end is None or video.current_frame_count < end)
+
+    difference_per_frame: list[np.ndarray] = []
+    try:
+        process_video_func(video, watch_cords, black_keys, difference_per_frame, is_running)
+    finally:
+        video.stop_prefetch()
+        video.cap.release()
+    progress[segment_idx] = video.current_frame_count - start
+    if is_cancelled:
+        raise OperationCancelledException("Terminated")
+    return np.array(difference_per_frame).reshape(-1, len(watch_cords))
+
+
+class SegmentedVideoProcessor:
+    """
+    Splits the remaining frames of a video into segments and runs process_video_func on every segment
+    in its own process with its own capture, the per-frame differences are stitched back in frame order.
+
+    Differences of a frame only depend on that frame, so the result is identical to the serial path.
+    """
+    def __init__(self, video: VideoClass, watch_cords: dict[RectType, list[CordType]], black_keys: list[RectType],
+                 processes: Optional[int] = None):
+        """
+        :param video: opened video, frames after its current position are processed. roi is kept
+        :param processes: number of worker processes, defaults to the core count
+        """
+        self.video: VideoClass = video
+        self.watch_cords: dict[RectType, list[CordType]] = watch_cords
+        self.black_keys: list[RectType] = black_keys
+        self.processes: int = processes if processes is not None else (os.cpu_count() or 1)
+        self.start_frame: int = video.current_frame_count
+        self.segments: list[tuple[int, Optional[int]]] = self.split_frames(self.start_frame, video.total_frames)
+        self._progress: Optional[list] = None
+
+    def split_frames(self, start: int, total_frames: int) -> list[tuple[int, Optional[int]]]:
+        """[(start, end), ...] covering start to the end of the video, the last segment reads until eof"""
+        remaining = max(0, total_frames - start)
+        n_segments = max(1, min(self.processes, remaining // MIN_SEGMENT_FRAMES))
+        bounds = np.linspace(start, total_frames, n_segments + 1).astype(int).tolist()
+        segments: list[tuple[int, Optional[int]]] = list(zip(bounds[:-1], bounds[1:]))
+        # frame counts are estimated by the container, never stop before eof
+        segments[-1] = (segments[-1][0], None)
+        return segments
+
+    def get_progress(self) -> float:
+        """
+        :return: progress 0.0 - 1.0
+        """
+        if self._progress is None:
+            return 0.0
+        total_frames = self.video.total_frames - self.start_frame
+        if total_frames <= 0:
+            return 1.0
+        return min(1.0, sum(self._progress) / total_frames)
+
+    def run(self, is_running_func: Callable[[], bool] = lambda: True) -> np.ndarray:
+        """
+        :param is_running_func: polled while waiting, workers are cancelled once it returns False
+        :return: per-frame differences of every frame after the start frame, one row per frame
+        """
+        with multiprocessing.Manager() as manager:
+            self._progress = manager.list([0] * len(self.segments))
+            cancel_event = manager.Event()
+            with ProcessPoolExecutor(max_workers=len(self.segments)) as executor:
+                futures = [
+                    executor.submit(_process_segment, self.video.video_path, self.video.max_size, self.video.roi,
+                                    self.watch_cords, self.black_keys, start, end, idx, self._progress,
+                                    cancel_event)
+                    for idx, (start, end) in enumerate(self.segments)
+                ]
+                try:
+                    while True:
+                        done, pending = wait(futures, timeout=0.1, return_when=FIRST_EXCEPTION)
+                        failed = next((f for f in done if f.exception() is not None), None)
+                        if failed is not None:
+                            # stop the other segments instead of waiting for them to finish
+                            cancel_event.set()
+                            for future in pending:
+                                future.cancel()
+                            raise failed.exception()
+                        if not pending:
+                            break
+                        if not is_running_func():
+                            cancel_event.set()
+                            wait(futures)
+                            break
+                finally:
+                    # keep the last reported progress once the manager is gone
+                    self._progress = list(self._progress)
+                segment_dpfs = [future.result() for future in futures]
+        return np.concatenate(segment_dpfs, axis=0)
+
+
+def benchmark(n_frames=3000, processes: Optional[int] = None):
+    """Compares the serial process_video_func against SegmentedVideoProcessor on a synthetic video"""
+    import tempfile
+    from algo import utils
+    from algo.get_watch_cords import get_watch_cords_dict
+
+    with tempfile.TemporaryDirectory() as directory:
+        video_path = os.path.join(directory, "synthetic_keyboard.mp4")
+        white_keys, black_keys = utils.make_synthetic_keyboard_video(video_path, n_frames)
+        watch_cords = get_watch_cords_dict(white_keys, black_keys)
+
+        video = VideoClass(video_path)
+        serial_difference_per_frame = []
+        start = time.perf_counter()
+        process_video_func(video, watch_cords, black_keys, serial_difference_per_frame)
+        serial_time = time.perf_counter() - start
+        video.cap.release()
+
+        video = VideoClass(video_path)
+        processor = SegmentedVideoProcessor(video, watch_cords, black_keys, processes)
+        start = time.perf_counter()
+        segmented = processor.run()
+        segmented_time = time.perf_counter() - start
+        video.cap.release()
+
+        if not np.array_equal(np.array(serial_difference_per_frame), segmented):
+            raise RuntimeError("Segmented processing differs from serial processing")
+
+    print(f"{len(segmented)} frames, {len(processor.segments)} segments")
+    print(f"Serial:    {serial_time:>7.2f}s")
+    print(f"Segmented: {segmented_time:>7.2f}s ({serial_time / segmented_time:.1f}x)")
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+from typing import Optional
+
+import numpy as np
+
+from algo.dpf_cache import layout_fingerprint
+from algo.dpf_file import DpfData, DPF_DTYPE
+from p2m import p2m_path
+from p2m.p2m_types import *
+from srcs.algo.dpf_analyser import Analyser, find_key_thresholds
+
+THRESHOLD_VERSION = 3       # bump whenever the analyser fits different thresholds for the same dpf
+
+
+class ThresholdModes:
+    GLOBAL = "global"           # one threshold pair for every key
+    KEY_CLASS = "key_class"     # one pair for white keys and one for black keys
+    KEY = "key"                 # one pair per key, refined from its class
+
+
+ThresholdType = Union[float, list[float]]
+
+
+class ThresholdProfile:
+    """Note thresholds fitted on a dpf and the mixture they were derived from"""
+    def __init__(self, note_off_threshold: ThresholdType, note_on_threshold: ThresholdType, gaussians: list[tuple],
+                 mode: str = ThresholdModes.GLOBAL):
+        """
+        :param note_off_threshold: one threshold, or one per dpf column unless mode is GLOBAL
+        :param gaussians: [(mean, covariance, weight), ...] of the analyser's global fit
+        """
+        self.note_off_threshold: ThresholdType = note_off_threshold
+        self.note_on_threshold: ThresholdType = note_on_threshold
+        self.gaussians: list[tuple] = gaussians
+        self.mode: str = mode
+
+    def __repr__(self):
+        off, on = np.asarray(self.note_off_threshold), np.asarray(self.note_on_threshold)
+        if off.ndim == 0:
+            return f"ThresholdProfile(off={off:.2f}, on={on:.2f})"
+        return f"ThresholdProfile({self.mode}, off={off.min():.2f}..{off.max():.2f}, on={on.min():.2f}..{on.max():.2f})"
+
+    @property
+    def thresholds(self) -> tuple[Union[float, np.ndarray], Union[float, np.ndarray]]:
+        """(note_off_threshold, note_on_threshold), the order find_note_thresholds returns them in"""
+        if np.ndim(self.note_off_threshold) == 0:
+            return self.note_off_threshold, self.note_on_threshold
+        return np.asarray(self.note_off_threshold), np.asarray(self.note_on_threshold)
+
+    def get_thresholds(self, n_keys: int) -> tuple[Union[float, np.ndarray], Union[float, np.ndarray]]:
+        """thresholds for a dpf of n_keys columns, per key thresholds of another layout collapse to their median"""
+        note_off, note_on = self.thresholds
+        if np.ndim(note_off) == 0 or len(note_off) == n_keys:
+            return note_off, note_on
+        return float(np.median(note_off)), float(np.median(note_on))
+
+    def to_dict(self) -> dict:
+        return {
+            "version": THRESHOLD_VERSION,
+            "mode": self.mode,
+            "note_off": self.note_off_threshold,
+            "note_on": self.note_on_threshold,
+            "gaussians": [[float(v) for v in gaussian] for gaussian in self.gaussians],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ThresholdProfile":
+        return cls(data["note_off"], data["note_on"], [tuple(gaussian) for gaussian in data["gaussians"]],
+                   data.get("mode", ThresholdModes.GLOBAL))
+
+
+def fit_threshold_profile(dpf: Union[DpfData, np.ndarray, DpfType], warm_start: Optional[ThresholdProfile] = None,
+                          mode: str = ThresholdModes.GLOBAL, cord_type: Optional[np.ndarray] = None
+                          ) -> ThresholdProfile:
+    """
+    :param warm_start: profile of a similar video, its mixture seeds the global fit instead of k-means
+    :param mode: one of ThresholdModes, anything but GLOBAL needs cord_type
+    :param cord_type: key class of every dpf column, see process_video.get_cord_type
+    """
+    dpf = np.asarray(dpf)
+    if mode != ThresholdModes.GLOBAL:
+        note_off, note_on = find_key_thresholds(dpf, cord_type, per_key=mode == ThresholdModes.KEY)
+        return ThresholdProfile(note_off.tolist(), note_on.tolist(), [], mode)
+    analyser = Analyser(dpf)
+    note_off, note_on = analyser.find_note_thresholds(
+        initial_gaussians=warm_start.gaussians if warm_start is not None else None)
+    return ThresholdProfile(float(note_off), float(note_on), [tuple(map(float, g)) for g in analyser.gaussian_list])
+
+
+def dpf_fingerprint(dpf: Union[DpfData, np.ndarray, DpfType], cord_type: Optional[np.ndarray] = None) -> str:
+    array = np.ascontiguousarray(dpf, dtype=DPF_DTYPE)
+    digest = hashlib.blake2b(str(array.shape).encode(), digest_size=20)
+    digest.update(array.tobytes())
+    if cord_type is not None:
+        digest.update(np.asarray(cord_type, dtype=np.int8).tobytes())
+    return digest.hexdigest()
+
+
+def style_fingerprint(uploader: Optional[str], keys: list[RectType], black_keys: list[RectType]) -> str:
+    """Videos of one channel recorded with the same keyboard layout are expected to share thresholds"""
+    return hashlib.blake2b(f"{uploader}:{layout_fingerprint(keys, black_keys)}".encode(), digest_size=20).hexdigest()
+
+
+class ThresholdProfileStore:
+    """
+    Fitted thresholds keyed by the exact dpf, reusable as is, and by uploader and key layout,
+    used to warm start the fit of a new video from the same source.
+    """
+    def __init__(self, directory: str = p2m_path.THRESHOLD_PROFILE_DIR):
+        self.directory: str = directory
+
+    @staticmethod
+    def get_dpf_key(dpf: Union[DpfData, np.ndarray, DpfType], mode: str = ThresholdModes.GLOBAL,
+                    cord_type: Optional[np.ndarray] = None) -> str:
+        if mode == ThresholdModes.GLOBAL:
+            return f"dpf-{THRESHOLD_VERSION}-{dpf_fingerprint(dpf)}"
+        return f"dpf-{mode}-{THRESHOLD_VERSION}-{dpf_fingerprint(dpf, cord_type)}"
+
+    @staticmethod
+    def get_style_key(uploader: Optional[str], keys: list[RectType], black_keys: list[RectType]) -> str:
+        return f"style-{THRESHOLD_VERSION}-{style_fingerprint(uploader, keys, black_keys)}"
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def load(self, key: str) -> Optional[ThresholdProfile]:
+        try:
+            with open(self.get_path(key), "r") as f:
+                data = json.load(f)
+            if data.get("version") != THRESHOLD_VERSION:
+                return None
+            return ThresholdProfile.from_dict(data)
+        except (FileNotFoundError, KeyError, TypeError, json.decoder.JSONDecodeError):
+            return None
+
+    def store(self, key: str, profile: ThresholdProfile):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.get_path(key)
+        # several worker processes may store the same style key
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(profile.to_dict(), f)
+        os.replace(tmp_path, path)
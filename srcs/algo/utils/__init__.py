@@ -5,4 +5,5 @@ from .interquartile import *
 from .draw_keys import *
 from .cv2_utils import *
 from .decorators import *
-from .clean_filename import *
\ No newline at end of file
+from .clean_filename import *
+from .synthetic_video import *
\ No newline at end of file
@@ -0,0 +1,78 @@
+import cv2
+import numpy as np
+
+
+def draw_synthetic_keyboard(width=1280, height=720, white_count=52, pressed: set[int] = frozenset()):
+    """
+    Draws a Synthesia-like keyboard at the bottom of an otherwise dark frame.
+
+    Returns:
+        tuple: (frame, white_keys, black_keys), keys are (x, y, w, h) rects in frame coordinates.
+    """
+    frame = np.full((height, width, 3), 30, dtype=np.uint8)
+    white_w = width // white_count
+    white_h = height // 4
+    white_y = height - white_h - 10
+    black_w = white_w * 3 // 5
+    black_h = white_h * 3 // 5
+
+    white_keys = []
+    for i in range(white_count):
+        white_keys.append((i * white_w, white_y, white_w - 2, white_h))
+    black_keys = []
+    for i in range(white_count - 1):
+        if i % 7 in (1, 4):  # no black key between B-C and E-F, starting from A
+            continue
+        black_keys.append((i * white_w + white_w - black_w // 2, white_y, black_w, black_h))
+
+    cv2.rectangle(frame, (0, white_y - 8), (width, white_y - 1), (40, 40, 160), -1)  # felt strip above the keys
+    for idx, (x, y, w, h) in enumerate(white_keys):
+        color = (80, 200, 80) if idx in pressed else (235, 235, 235)
+        cv2.rectangle(frame, (x, y), (x + w, y + h), color, -1)
+    for idx, (x, y, w, h) in enumerate(black_keys):
+        color = (40, 120, 40) if idx + len(white_keys) in pressed else (15, 15, 15)
+        cv2.rectangle(frame, (x, y), (x + w, y + h), color, -1)
+    return frame, white_keys, black_keys
+
+
+def make_synthetic_keyboard_video(path: str, n_frames=300, fps=30.0, width=1280, height=720, seed=0,
+                                  intro_frames=0):
+    """
+    Writes a synthetic keyboard video where a few random keys are pressed in every frame.
+    The first intro_frames of n_frames show a title card without any keyboard.
+
+    Returns:
+        tuple: (white_keys, black_keys) of the drawn keyboard.
+    """
+    rng = np.random.default_rng(seed)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    white_keys, black_keys = [], []
+    pressed: set[int] = set()
+    for frame_idx in range(n_frames):
+        if frame_idx < intro_frames:
+            frame = np.full((height, width, 3), 30, dtype=np.uint8)
+            cv2.putText(frame, "Intro", (width // 3, height // 2), cv2.FONT_HERSHEY_SIMPLEX, 4, (200, 200, 200), 8)
+            writer.write(frame)
+            continue
+        if frame_idx % 5 == 0:
+            pressed = set(rng.choice(88, size=4, replace=False).tolist())
+        frame, white_keys, black_keys = draw_synthetic_keyboard(width, height, pressed=pressed)
+        writer.write(frame)
+    writer.release()
+    return white_keys, black_keys
+
+
+def make_synthetic_dpf(n_frames=7200, n_keys=88, seed=0) -> np.ndarray:
+    """
+    Differences per frame of a random song, keys brightened for 3 to 40 frames over a slightly noisy background.
+
+    Returns:
+        np.ndarray: (n_frames, n_keys) int differences, one row per frame.
+    """
+    rng = np.random.default_rng(seed)
+    brightness = np.full((n_frames + 1, n_keys), 100)
+    for _ in range(n_frames // 3):
+        key, start, length = rng.integers(n_keys), rng.integers(n_frames), rng.integers(3, 40)
+        brightness[start:start + length, key] += rng.integers(60, 200)
+    brightness += rng.integers(-3, 4, brightness.shape)
+    return np.diff(brightness, axis=0)
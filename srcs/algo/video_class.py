@@ -1,26 +1,42 @@
+import math
 import cv2
 import time
 import numpy as np
 import pathlib
 from algo import utils
 from typing import Optional
+from algo.cord_transform import CordTransform
+from algo.frame_prefetcher import FramePrefetcher, PrefetchStats
+from p2m.p2m_types import RectType
 
 
 class VideoClass:
+    seekable = True     # frames can be read again, False for a stream, see video_stream.StreamVideoClass
+
     def __init__(self, video_path: str, max_size=(1280, 720)):
         self.video_path = video_path
         self.name: str = pathlib.Path(video_path).stem
-        self.cap: cv2.VideoCapture = cv2.VideoCapture(video_path)
+        self.cap: cv2.VideoCapture = self._open_capture(video_path)
         if not self.cap.isOpened():
             raise ValueError(f"Invalid video path: {video_path}")
         self.max_size = max_size
         self.eof: bool = False
         self.fps: float = self.cap.get(cv2.CAP_PROP_FPS)
         self.total_frames: int = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.width: int = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height: int = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
         self.current_frame_count: int = 0
-        self._current_frame: Optional[np.ndarray] = None
+        self._roi: Optional[RectType] = None
+        self._roi_slices: Optional[tuple[slice, slice]] = None
+        # (frame count, frame) pairs so readers on other threads never pair a frame with a stale resize
+        self._source: tuple[int, Optional[np.ndarray]] = (0, None)
+        self._resized: tuple[int, Optional[np.ndarray]] = (0, None)
         self._start_time: float = time.time()
         self._start_frame_count: int = 0
+        self._prefetcher: Optional[FramePrefetcher] = None
+
+    def _open_capture(self, video_path: str) -> cv2.VideoCapture:
+        return cv2.VideoCapture(video_path)
 
     def __iter__(self):
         while self.read_next():
@@ -28,31 +44,143 @@ class VideoClass:
 
     def read_next(self):
         """Read the next frame from the video."""
-        success, frame = self.cap.read()
+        if self._prefetcher is not None:
+            frame = self._prefetcher.read()
+            success = frame is not None
+        else:
+            success, frame = self.cap.read()
         if success:
             self.current_frame_count += 1
-            self._current_frame = utils.cv2_resize_to_fit(frame, *self.max_size)
+            if self._roi_slices is not None:
+                frame = frame[self._roi_slices]  # view, no copy
+            # frames are only resized when current_frame is accessed, see source_frame
+            self._source = (self.current_frame_count, frame)
             self.eof = False
         else:
             self.eof = True
         return not self.eof
 
+    def start_prefetch(self, buffer_size: int = 8):
+        """
+        Decode frames on a background thread into a ring of buffer_size reused frame buffers.
+
+        read_next keeps the same semantics, source_frame stays valid until the read_next after next.
+        """
+        if self._prefetcher is None:
+            self._prefetcher = FramePrefetcher(self.cap, buffer_size)
+
+    def stop_prefetch(self) -> Optional[PrefetchStats]:
+        """Stop decoding in the background, the capture is moved back to the next unread frame"""
+        if self._prefetcher is None:
+            return None
+        prefetcher = self._prefetcher
+        self._prefetcher = None
+        prefetcher.stop()
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.current_frame_count)
+        return prefetcher.stats
+
+    @property
+    def prefetch_stats(self) -> Optional[PrefetchStats]:
+        """Queue depth and stall counters of the running prefetch, None when not prefetching"""
+        if self._prefetcher is None:
+            return None
+        return self._prefetcher.stats
+
+    def get_scale(self) -> float:
+        """Scale factor from source resolution to the resized frame, same as utils.cv2_resize_to_fit"""
+        max_width, max_height = self.max_size
+        if self.width == max_width and self.height == max_height:
+            return 1.0
+        return min(max_width / self.width, max_height / self.height)
+
+    @property
+    def transform(self) -> CordTransform:
+        """Maps resized frame coordinates to indices of source_frame"""
+        if self._roi_slices is None:
+            return CordTransform(self.get_scale(), (0, 0), (self.width, self.height))
+        y_slice, x_slice = self._roi_slices
+        return CordTransform(self.get_scale(), (x_slice.start, y_slice.start),
+                             (x_slice.stop - x_slice.start, y_slice.stop - y_slice.start))
+
+    @property
+    def roi(self) -> Optional[RectType]:
+        return self._roi
+
     @property
-    def current_frame(self) -> np.ndarray:
-        return self._current_frame
+    def roi_offset(self) -> tuple[int, int]:
+        """Top left of the current frame in resized frame coordinates"""
+        if self._roi is None:
+            return 0, 0
+        return self._roi[0], self._roi[1]
+
+    def set_roi(self, roi: Optional[RectType]):
+        """
+        Only keep the region of interest of every frame read afterwards.
+
+        :param roi: (x, y, w, h) in resized frame coordinates, None to keep the full frame
+        """
+        if roi is None:
+            self._roi = None
+            self._roi_slices = None
+            return
+        scale = self.get_scale()
+        x, y, w, h = roi
+        # map back to source resolution, rounding outwards so the roi is always covered
+        src_x0 = max(0, math.floor(x / scale))
+        src_y0 = max(0, math.floor(y / scale))
+        src_x1 = min(self.width, math.ceil((x + w) / scale))
+        src_y1 = min(self.height, math.ceil((y + h) / scale))
+        if src_x0 >= src_x1 or src_y0 >= src_y1:
+            raise ValueError(f"Region of interest {roi} is outside of the video")
+        self._roi = (x, y, w, h)
+        self._roi_slices = (slice(src_y0, src_y1), slice(src_x0, src_x1))
+
+    def _resize(self, frame: np.ndarray) -> np.ndarray:
+        if self._roi is None:
+            return utils.cv2_resize_to_fit(frame, *self.max_size)
+        _, _, w, h = self._roi
+        if frame.shape[1] == w and frame.shape[0] == h:
+            return frame
+        return cv2.resize(frame, (w, h))
+
+    @property
+    def source_frame(self) -> Optional[np.ndarray]:
+        """Current frame in source resolution (cropped to roi if set), sample it through transform"""
+        return self._source[1]
+
+    @property
+    def current_frame(self) -> Optional[np.ndarray]:
+        """Current frame resized to max_size, resized on first access only"""
+        frame_count, source = self._source
+        if source is None:
+            return None
+        resized_frame_count, resized = self._resized
+        if resized_frame_count != frame_count:
+            resized = self._resize(source)
+            self._resized = (frame_count, resized)
+        return resized
 
     @current_frame.setter
     def current_frame(self, img: np.ndarray):
         if not isinstance(img, np.ndarray):
             raise ValueError("current frame must be image")
-        self._current_frame = img
+        self._resized = (self._source[0], img)
 
-    def skip_to_frame(self, frame_number: int):
-        """Skip to a specific frame in the video."""
+    def seek(self, frame_number: int):
+        """Position the video so the next read_next reads frame_number, without reading it."""
         if not (0 <= frame_number < self.total_frames):
             raise ValueError("Frame number out of range")
+        prefetching = self._prefetcher is not None
+        if prefetching:
+            self.stop_prefetch()
         self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
         self.current_frame_count = frame_number
+        if prefetching:
+            self.start_prefetch()
+
+    def skip_to_frame(self, frame_number: int):
+        """Skip to a specific frame in the video."""
+        self.seek(frame_number)
         self.read_next()
 
     def reset(self):
@@ -78,10 +206,10 @@ class VideoClass:
 
     def display_current_frame(self, delay=1, show_info=True):
         """Display the current frame using OpenCV."""
-        if self._current_frame is None:
+        if self.current_frame is None:
             raise ValueError("No frame data available to display")
 
-        frame = self._current_frame.copy()
+        frame = self.current_frame.copy()
         if show_info:
             self.draw_info_on(frame)
 
@@ -119,6 +247,7 @@ class VideoClass:
 
     def release(self):
         """Release the video capture object."""
+        self.stop_prefetch()
         self.cap.release()
         cv2.destroyAllWindows()
 
@@ -0,0 +1,83 @@
+import subprocess
+
+import cv2
+import numpy as np
+
+from algo.video_class import VideoClass
+
+
+class StreamVideoClass(VideoClass):
+    """
+    Video read from the stdout of a command while the command is still writing it, e.g. yt-dlp downloading
+    to "-", so the first frames are analysed seconds after the download starts instead of after the whole file.
+
+    The pipe is handed to the ffmpeg backend of cv2 as "pipe:<fd>", the container has to be streamable
+    (webm, mkv or fragmented mp4). A stream can only be read forwards, see seekable.
+    """
+    seekable = False
+
+    def __init__(self, command: list[str], name: str, max_size=(1280, 720), fps: float = 0.0, total_frames: int = 0):
+        """
+        :param command: writes the video to its stdout, see download_videos.get_stream_command
+        :param fps: used when the container doesn't tell, like total_frames
+        :param total_frames: expected frame count for progress, 0 if unknown
+        """
+        self.command: list[str] = command
+        self._process: subprocess.Popen = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            super().__init__(name, max_size)
+        except ValueError:
+            self._close_process()
+            raise ValueError(f"Unable to stream {name}: {self._process.stderr.read().decode(errors='replace')}")
+        self.name = name
+        if self.fps <= 0:
+            self.fps = fps
+        if self.total_frames <= 0:
+            self.total_frames = total_frames
+
+    def _open_capture(self, video_path: str) -> cv2.VideoCapture:
+        return cv2.VideoCapture(f"pipe:{self._process.stdout.fileno()}", cv2.CAP_FFMPEG)
+
+    def _close_process(self):
+        self._process.stdout.close()
+        if self._process.poll() is None:
+            self._process.terminate()
+        self._process.wait()
+
+    def stop_prefetch(self):
+        """Stop decoding in the background, frames decoded ahead of current_frame are dropped"""
+        if self._prefetcher is None:
+            return None
+        prefetcher = self._prefetcher
+        self._prefetcher = None
+        prefetcher.stop()
+        return prefetcher.stats
+
+    def seek(self, frame_number: int):
+        """Reads up to frame_number, a stream can't go back"""
+        if frame_number < self.current_frame_count:
+            raise ValueError(f"Unable to seek back to frame {frame_number} of a stream")
+        while self.current_frame_count < frame_number and self.read_next():
+            pass
+
+    def get_progress(self):
+        if self.total_frames - self._start_frame_count <= 0:
+            return 0.0
+        return min(1.0, super().get_progress())
+
+    def release(self):
+        try:
+            super().release()
+        finally:
+            self._close_process()
+
+    def __del__(self):
+        # a job dropped mid stream would leave yt-dlp blocked on the full pipe
+        if getattr(self, "_process", None) is not None and self._process.poll() is None:
+            self._close_process()
+
+    def get_thumbnail(self, thumbnail_progress_ratio: float = 0.1) -> np.ndarray:
+        """Frames passed can't be read again, black until the first frame is read"""
+        if self.current_frame is not None:
+            return self.current_frame
+        return np.zeros((self.max_size[1], self.max_size[0], 3), dtype=np.uint8)
@@ -1,15 +1,14 @@
 import cv2
 from p2m.p2m_types import *
+from algo.key_search import find_keys_in_video
 from algo.video_class import VideoClass
-from algo.locate_black_and_white import locate_white_and_black, preprocess_image, classify_keys, detect_rects
+from algo.locate_black_and_white import preprocess_image, classify_keys, detect_rects
 
 
 def wait_and_find_keys(video: VideoClass) -> KeysPairType:
-    while video.read_next():
-        ret = locate_white_and_black(video.current_frame)
-        if ret is not None:
-            return ret
-        video.display_current_frame()
+    ret, _ = find_keys_in_video(video, on_examined=lambda keys_like: video.display_current_frame())
+    if ret is not None:
+        return ret
 
     raise RuntimeError("piano to midi: Failed to locate keys")
 
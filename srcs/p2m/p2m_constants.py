@@ -1,2 +1,10 @@
 ON_THRESHOLD = 50
 OFF_THRESHOLD = 30
+THRESHOLD_MODE = "global"  # "global", "key_class" or "key", see threshold_profiles.ThresholdModes
+BAND_LIMITED_KEY_DETECTION = False  # search keys only in keyboard like rows, see locate_black_and_white.find_key_bands
+STREAMING_MIDI = False  # decide notes while a video is processed, memory stays bounded but no dpf is kept
+WATCH_CORD_GRID = 3  # watch cords per key side, see get_watch_cords.get_watch_cord_arrays
+DOWNLOAD_WORKERS = 2  # videos downloaded at once, apart from the processing workers
+DOWNLOAD_RATE_LIMIT = None  # bytes per second of each download or stream, None for no limit
+DOWNLOAD_VIDEO_ONLY = True  # download the video track only, the audio is never used
+STREAM_DOWNLOADS = False  # process url videos while yt-dlp downloads them instead of after, see video_stream
@@ -7,3 +7,5 @@ ASSETS_DIR = join(ROOT_DIR, "assets")
 DATA_DIR = join(ROOT_DIR, "data")
 VIDEOS_DIR = join(DATA_DIR, "videos")
 DPF_DIR = join(DATA_DIR, "dpf")
+THRESHOLD_PROFILE_DIR = join(DATA_DIR, "threshold_profiles")
+KEY_LAYOUT_DIR = join(DATA_DIR, "key_layouts")
@@ -1,13 +1,13 @@
-import concurrent
 import pathlib
 import os
-from concurrent.futures import ThreadPoolExecutor
-from typing import Callable, Iterable, Any
+from typing import Callable, Iterable, Any, Optional
 
 import customtkinter as ctk
 from p2m import p2m_path
 from srcs.algo.video_class import VideoClass
 from srcs.algo.processing_class import ProcessingClass, ProcessStates
+from srcs.algo.processing_backends import ProcessingBackend, ProcessBackend
+from srcs.algo.threshold_profiles import ThresholdProfile
 from srcs.algo.download_videos import get_playlist_urls, UrlData, get_video_title
 from srcs.algo.utils import SettableCachedProperty
 from .process_display_frame import CtkProcessDisplayFrame
@@ -16,12 +16,12 @@ from .interval_caller import IntervalCaller
 
 class QueueData:
     def __init__(self, master, _str: str,
-                 submit_to_executor: Callable[[Callable], Any], interval_caller: IntervalCaller,
+                 backend: ProcessingBackend, interval_caller: IntervalCaller,
                  title=None, is_url=False):
         _str = str(_str)
         self.master: ctk.CTk = master
         self.src_str: str = _str
-        self._submit_to_executor: Callable[[Callable], Any] = submit_to_executor
+        self._backend: ProcessingBackend = backend
         self.interval_caller: IntervalCaller = interval_caller
         self._is_url: bool = is_url
         self._is_running: bool = False
@@ -29,7 +29,7 @@ class QueueData:
         self._end_hooks: set[tuple[Callable, Any]] = set()
         if title is not None:
             self.default_title = title
-        self.processor: ProcessingClass = ProcessingClass(self.src_str)
+        self.processor: ProcessingClass = backend.create_processor(self.src_str)
 
         # vars
         # once set to true, queue manager will add it to processing queue
@@ -89,40 +89,39 @@ selected={self.is_selected_var.get()}, status={self.processor.state}]"
     def hook_end_func(self, func: Callable, *args):
         self._end_hooks.add((func, args))
 
-    def save_at_save_path(self):
+    def _on_start(self):
         self._is_running = True
-        self.processor.state = ProcessStates.RUNNING
         print("started saving")
         for func, args in self._start_hooks:
             print(f"called {func.__name__}")
             self.master.after(100, func, *args)
-        try:
-            print("getting midi")
-            print(self.processor.midi)
-            self.processor.save_as(self.save_path_var.get())
-        except BaseException as exc:
-            print(exc)
+
+    def _on_end(self, saved: bool):
+        self._is_running = False
+        if not saved:
             return
-        finally:
-            self._is_running = False
         for func, args in self._end_hooks:
             self.master.after(0, func, *args)
 
     def start_processing(self):
         self.processor.state = ProcessStates.QUEUED
-        self._submit_to_executor(self.save_at_save_path)
+        self._backend.submit(self.processor, self.save_path_var.get(), self._on_start, self._on_end)
 
     def cancel_processing(self):
         self.processor.kill()
 
 
 class QueueManager:
-    def __init__(self, master: ctk.CTk):
+    def __init__(self, master: ctk.CTk, backend: Optional[ProcessingBackend] = None):
+        """
+        :param backend: runs the jobs, defaults to one worker process per core
+        """
         self.master: ctk.CTk = master
         self.interval_caller: IntervalCaller = IntervalCaller(self.master, interval=30)
         self._queue_list: list[QueueData] = []
-        self._max_threads: int = 10
-        self._executor = ThreadPoolExecutor(max_workers=self._max_threads)
+        self._backend: ProcessingBackend = backend if backend is not None else ProcessBackend()
+        # thresholds every job of the batch uses instead of fitting its own
+        self._pinned_profile: Optional[ThresholdProfile] = None
 
     def __repr__(self) -> str:
         return f"{{QueueManager: {len(self._queue_list)}}}: {self._queue_list}"
@@ -143,14 +142,33 @@ class QueueManager:
         return [q for q in self._queue_list if q.is_selected()]
 
     def _add_queue_data(self, data: QueueData):
+        data.processor.pinned_profile = self._pinned_profile
         self._queue_list.append(data)
 
+    @property
+    def pinned_profile(self) -> Optional[ThresholdProfile]:
+        return self._pinned_profile
+
+    def pin_threshold_profile(self, profile: Optional[ThresholdProfile]):
+        """
+        Use profile for every job started from now on, None to let every job fit its own thresholds again
+        """
+        self._pinned_profile = profile
+        for q in self._queue_list:
+            q.processor.pinned_profile = profile
+
+    def pin_threshold_profile_of(self, data: QueueData):
+        """Pin the thresholds a completed job generated its midi with"""
+        if data.processor.threshold_profile is None:
+            raise ValueError(f"{data.title_var.get()} has no thresholds yet")
+        self.pin_threshold_profile(data.processor.threshold_profile)
+
     def add_path(self, path: str) -> None:
         srcs_dict = self.srcs_dict
         if path in srcs_dict:
             srcs_dict[path].is_selected_var.set(True)
             return
-        data = QueueData(self.master, path, self.submit_to_executor, self.interval_caller)
+        data = QueueData(self.master, path, self._backend, self.interval_caller)
         self._add_queue_data(data)
 
     def add_url(self, url: str):
@@ -160,7 +178,7 @@ class QueueManager:
             return
         datas = get_playlist_urls(url)
         for url_data in datas:
-            data = QueueData(self.master, url_data.url, self.submit_to_executor, self.interval_caller,
+            data = QueueData(self.master, url_data.url, self._backend, self.interval_caller,
                              url_data.title, is_url=True)
             self._add_queue_data(data)
 
@@ -173,18 +191,18 @@ class QueueManager:
     def has_running_task(self) -> bool:
         return bool(self.get_running_tasks)
 
-    def submit_to_executor(self, func: Callable):
-        self._executor.submit(func)
-
     def terminate_all(self):
         self.interval_caller.stop()
-        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._backend.cancel_queued()
         for q in self.get_running_tasks():
             q.cancel_processing()
         for q in self._queue_list:
             if q.processor.state is ProcessStates.QUEUED:
                 q.processor.state = ProcessStates.NOT_STARTED
-        self._executor = ThreadPoolExecutor(max_workers=self._max_threads)
+
+    def shutdown(self):
+        """Stops the backend, call once after terminate_all when closing"""
+        self._backend.shutdown()
 
     def __len__(self):
         return self._queue_list.__len__()
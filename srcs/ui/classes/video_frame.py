@@ -28,13 +28,15 @@ class CtkVideoFrame(ctk.CTkFrame):
     def update_frame(self):
         """Update the canvas with the current frame from the video."""
         # self.video.read_next()
-        if self.video.current_frame is None:
+        source_frame = self.video.source_frame
+        if source_frame is None:
             return
 
         self.width = self.canvas.winfo_width()
         self.height = self.canvas.winfo_height()
         try:
-            frame = cv2_resize_to_fit(self.video.current_frame, self.width, self.height)
+            # resize straight from source resolution, the video never resizes frames it does not display
+            frame = cv2_resize_to_fit(source_frame, self.width, self.height)
         except cv2.error:
             return
         frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
@@ -73,6 +73,7 @@ class App(ScalableApp):
 
     def end_app(self):
         self.queue_manager.terminate_all()
+        self.queue_manager.shutdown()
         self.destroy()
 
     def choose_frame(self, ret_val):
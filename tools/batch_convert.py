@@ -0,0 +1,16 @@
+"""
+Converts videos, directories, glob patterns and playlist urls to midi without a gui, see algo.batch_convert.
+
+usage: py tools/batch_convert.py SOURCE [SOURCE ...] [-o DIRECTORY] [-j WORKERS] [--summary PATH] [--overwrite]
+"""
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT_DIR, "srcs"), ROOT_DIR]
+
+from algo.batch_convert import main
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+"""
+Converts the .dpf.json cache files in data/dpf to the binary .dpf.npy format.
+
+usage: py tools/migrate_dpf_cache.py [directory] [--remove-json]
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "srcs"))
+
+from algo.dpf_file import migrate_dpf_dir
+from p2m import p2m_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert .dpf.json cache files to .dpf.npy")
+    parser.add_argument("directory", nargs="?", default=p2m_path.DPF_DIR)
+    parser.add_argument("--remove-json", action="store_true", help="delete json files once converted")
+    args = parser.parse_args()
+
+    migrated = migrate_dpf_dir(args.directory, remove_legacy=args.remove_json)
+    for path in migrated:
+        print(f"converted {path}")
+    print(f"{len(migrated)} file(s) converted")
+
+
+if __name__ == '__main__':
+    main()